@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Local aggregates of the ingests for the reports."""
+
+from datetime import datetime
+
+from requests import codes
+from sqlalchemy.exc import OperationalError
+
+from SPARMETSViewer import app, db
+
+from .models import ReportAggregate, AggregateWatermark
+from .rdfquery import sparql_get, iter_sparql_results
+
+WATERMARK = 'ingest'
+
+# Number of (channel, month) recomputed by each query
+MONTHS_BATCH_SIZE = 100
+
+# Months of all the ingests of the packages ingested after the watermark:
+# a package is counted in the month of its latest ingest, which moves
+AFFECTED_QUERY = """SELECT ?c ?month (MAX(STR(?new_date)) AS ?last)
+        WHERE {
+        GRAPH ?g {
+          ?p sparcontext:isMemberOf ?c.
+          ?p sparprovenance:hasEvent ?new_e.
+          ?new_e a sparprovenance:ingestCompletion.
+          ?new_e dc:date ?new_date.
+          FILTER (STR(?new_date) > %s)
+          ?p sparprovenance:hasEvent ?e.
+          ?e a sparprovenance:ingestCompletion.
+          ?e dc:date ?date.
+        }
+        ?c a sparcontext:channel.
+        BIND (SUBSTR(STR(?date), 1, 7) AS ?month)
+        } GROUP BY ?c ?month"""
+
+# Packages by channel and month of their latest ingest (as the live report)
+AGGREGATES_QUERY = """SELECT ?c (SAMPLE(?uri) AS ?name) ?month
+        (COUNT(?p) AS ?packages) (SUM(xsd:integer(?n_files)) AS ?files)
+        (SUM(xsd:integer(?size_p)) AS ?size) (MAX(?dc) AS ?last)
+        WHERE {
+        { SELECT ?c ?uri ?p ?n_files ?size_p (MAX(STR(?date)) AS ?dc)
+          WHERE {
+          GRAPH ?g {
+            ?p sparcontext:isMemberOf ?c.
+            OPTIONAL { ?p sparfixity:size ?size_p }
+            OPTIONAL { ?p sparfixity:fileCount ?n_files }
+            ?p sparprovenance:hasEvent ?e.
+            ?e a sparprovenance:ingestCompletion.
+            ?e dc:date ?date.
+          }
+          ?c a sparcontext:channel. ?c owl:sameAs ?uri.
+          } GROUP BY ?c ?uri ?p ?n_files ?size_p }
+        BIND (SUBSTR(?dc, 1, 7) AS ?month)
+        %s
+        } GROUP BY ?c ?month"""
+
+
+def as_int(value):
+    """Convert a SPARQL value (possibly missing) to an integer"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def sparql_literal(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def query_rows(endpoint, query):
+    """Give the rows of an aggregates query"""
+    app.logger.debug("AGGREGATES query %s", query)
+    response = sparql_get(endpoint, query)
+    if response.status_code != codes.ok:
+        raise ValueError("Aggregates query failed with %s" % response.status_code)
+    return list(iter_sparql_results(response.json()))
+
+
+def refresh_aggregates(endpoint=None):
+    """
+    Recompute the aggregates of the months changed since the watermark.
+
+    A package is counted in the month of its latest ingest, so an ingest
+    after the watermark changes the month of the package and the month of
+    its former latest ingest: the months of all the ingests of these
+    packages are computed again in full. The first refresh computes all
+    the months. The watermark is moved to the most recent ingest seen. Give
+    the number of (channel, month) rows recomputed.
+    """
+    if endpoint is None:
+        endpoint = app.config['ACCESS_ENDPOINT']
+    watermark = AggregateWatermark.query.get(WATERMARK)
+    last = watermark.date if watermark is not None else None
+
+    if last:
+        affected = query_rows(endpoint, AFFECTED_QUERY % sparql_literal(last))
+        months = sorted(set((row['c'], row['month']) for row in affected
+                            if row.get('c') and row.get('month')))
+        for row in affected:
+            if row.get('last') and row['last'] > last:
+                last = row['last']
+        rows = []
+        for i in range(0, len(months), MONTHS_BATCH_SIZE):
+            values = "VALUES (?c ?month) { %s }" % " ".join(
+                "(<%s> %s)" % (channel, sparql_literal(month))
+                for channel, month in months[i:i + MONTHS_BATCH_SIZE])
+            rows += query_rows(endpoint, AGGREGATES_QUERY % values)
+    else:
+        months = None
+        rows = query_rows(endpoint, AGGREGATES_QUERY % "")
+
+    # The recomputed months replace the stored ones
+    if months is None:
+        ReportAggregate.query.delete()
+    else:
+        for channel, month in months:
+            ReportAggregate.query.filter_by(channel=channel, month=month).delete()
+    updated = 0
+    for row in rows:
+        if not row.get('c') or not row.get('month'):
+            continue
+        name = row.get('name') or row['c']
+        aggregate = ReportAggregate(row['c'], row['month'], name.split('context/')[-1])
+        aggregate.packages = as_int(row.get('packages'))
+        aggregate.files = as_int(row.get('files'))
+        aggregate.size = as_int(row.get('size'))
+        db.session.add(aggregate)
+        updated += 1
+        if row.get('last') and (last is None or row['last'] > last):
+            last = row['last']
+
+    if watermark is None:
+        watermark = AggregateWatermark(WATERMARK, last, datetime.now())
+        db.session.add(watermark)
+    else:
+        watermark.date = last
+        watermark.refreshed = datetime.now()
+    db.session.commit()
+    app.logger.debug("AGGREGATES %d rows recomputed up to %s", updated, last)
+    return updated
+
+
+def report_from_aggregates(channel, period=None):
+    """
+    Give the report of a channel (for a year or a month) from the aggregates.
+
+    Give None when the aggregates cannot answer: never refreshed, or a
+    period finer than a month.
+    """
+    if period and len(period) > 7:
+        return None
+    if get_watermark() is None:
+        return None
+    query = ReportAggregate.query.filter(ReportAggregate.channel == channel)
+    if period:
+        query = query.filter(ReportAggregate.month.startswith(period))
+    report = None
+    for aggregate in query:
+        if report is None:
+            report = {'channel': aggregate.name, 'packages': 0, 'files': 0, 'size': 0}
+        report['packages'] += aggregate.packages
+        report['files'] += aggregate.files
+        report['size'] += aggregate.size
+    return [report] if report is not None else []
+
+
+def get_watermark():
+    """Give the watermark of the aggregates (None if never refreshed)"""
+    try:
+        return AggregateWatermark.query.get(WATERMARK)
+    except OperationalError:
+        # Database not yet migrated to the aggregates tables
+        db.session.rollback()
+        return None
+
+
+def aggregates_status():
+    """Give the date of the last refresh and of the last ingest aggregated"""
+    watermark = get_watermark()
+    if watermark is None:
+        return None
+    return {
+        'last_ingest': watermark.date,
+        'refreshed': watermark.refreshed.isoformat() if watermark.refreshed else None,
+    }
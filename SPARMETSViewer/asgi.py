@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous proxy routes, served by an ASGI server.
+
+The routes which only wait for the SPARQL and SRU endpoints are answered
+on an event loop with a pooled asynchronous HTTP client, so that a few
+workers hold hundreds of slow upstream calls; all the other routes are
+given to the Flask application. Run with:
+uvicorn SPARMETSViewer.asgi:application
+"""
+
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from lxml import etree
+from requests import codes
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from SPARMETSViewer import app
+
+from .metrics import count_cache, observe_upstream
+from .outbound import CircuitOpenError, UNHEALTHY_STATUSES, backoff, get_breaker
+from .slowqueries import is_slow_query, log_slow_query
+from .rdfquery import SPARQL_HEADERS, sparql_params, aiter_sparql_response
+from .rdfquery import label_sparql, test_label_result, empty_label_result
+from .sru import SRU
+from .sruunimarc import SRUUnimarc
+from .views import GRAPH_QUERY, custom_query_plan, custom_query_total, custom_query_count
+from .views import custom_query_result, catalog_sru_query, catalog_sru_row
+from .views import gallica_sru_query, gallica_sru_row, sru_paging
+
+# Pooled client shared by all the requests (opened by the lifespan)
+CLIENT = None
+# Identical SPARQL queries in flight, sharing the same upstream call
+FLIGHTS = {}
+# Labels already retrieved, by SPARQL query
+LABELS = {}
+LABELS_SIZE = 128
+
+
+@asynccontextmanager
+async def lifespan(application):
+    """Open the pooled HTTP client while the server runs"""
+    global CLIENT
+    limits = httpx.Limits(max_connections=app.config['ASYNC_MAX_CONNECTIONS'],
+                          max_keepalive_connections=app.config['ASYNC_MAX_KEEPALIVE'])
+    CLIENT = httpx.AsyncClient(limits=limits)
+    try:
+        yield
+    finally:
+        await CLIENT.aclose()
+        CLIENT = None
+
+
+def flask_context(request):
+    """Flask request context (for the locale) used to build the queries"""
+    return app.test_request_context(
+        request.url.path, headers={'Accept-Language': request.headers.get('accept-language', '')})
+
+
+async def log_slow_query_async(upstream, url, params, seconds, *args):
+    """Log a slow query (see slowqueries.log_slow_query) without blocking the event loop"""
+    # Most queries are not slow: only those leave the event loop
+    if not is_slow_query(upstream, seconds):
+        return
+    await asyncio.get_running_loop().run_in_executor(
+        None, log_slow_query, upstream, url, params, seconds, *args)
+
+
+async def async_get(upstream, url, params=None, headers=None, stream=False):
+    """
+    Send a GET to an upstream with its timeout, retries and circuit breaker.
+
+    Same policy as outbound.http_get, without holding a thread while waiting.
+    """
+    breaker = get_breaker(upstream, url)
+    breaker.before()
+    try:
+        return await send_with_retries(breaker, upstream, url, params, headers, stream)
+    except httpx.TransportError:
+        # Already recorded
+        raise
+    except httpx.HTTPError:
+        breaker.failure()
+        raise
+    except BaseException:
+        # Such as the cancellation of the call when the client went away
+        breaker.release()
+        raise
+
+
+async def send_with_retries(breaker, upstream, url, params, headers, stream):
+    """Send a GET (see async_get), recording the outcome in the circuit breaker"""
+    timeouts = app.config['OUTBOUND_TIMEOUTS']
+    connect, read = timeouts.get(upstream, timeouts['default'])
+    retries = app.config['OUTBOUND_RETRIES']
+    attempt = 0
+    while True:
+        request = CLIENT.build_request('GET', url, params=params, headers=headers,
+                                       timeout=httpx.Timeout(read, connect=connect))
+        start = time.perf_counter()
+        try:
+            response = await CLIENT.send(request, stream=stream)
+        except httpx.TransportError as e:
+            elapsed = time.perf_counter() - start
+            observe_upstream(upstream, url, elapsed, 'error')
+            await log_slow_query_async(upstream, url, params, elapsed, 'error')
+            app.logger.debug("GET %s failed (attempt %d): %s", upstream, attempt + 1, e)
+            if attempt >= retries:
+                breaker.failure()
+                raise
+        else:
+            elapsed = time.perf_counter() - start
+            observe_upstream(upstream, url, elapsed, response.status_code)
+            await log_slow_query_async(upstream, url, params, elapsed, response.status_code,
+                                       response, stream)
+            if response.status_code not in UNHEALTHY_STATUSES:
+                breaker.success()
+                return response
+            app.logger.debug("GET %s answered %s (attempt %d)",
+                             upstream, response.status_code, attempt + 1)
+            if attempt >= retries:
+                breaker.failure()
+                return response
+            await response.aclose()
+        await asyncio.sleep(backoff(attempt))
+        attempt += 1
+
+
+async def sparql_get(endpoint, query):
+    """Send a SPARQL query, identical queries in flight sharing the same call"""
+    key = (endpoint, query)
+    task = FLIGHTS.get(key)
+    if task is None:
+        task = asyncio.ensure_future(async_get(
+            'sparql', endpoint, params=sparql_params(query), headers=SPARQL_HEADERS))
+        FLIGHTS[key] = task
+        task.add_done_callback(lambda done: FLIGHTS.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def sparql_stream(endpoint, query):
+    """Send a SPARQL query and return the response unread"""
+    return await async_get('sparql', endpoint, params=sparql_params(query),
+                           headers=SPARQL_HEADERS, stream=True)
+
+
+async def request_params(request):
+    """Give the parameters of a GET (query string) or of a POST (form)"""
+    if request.method == 'POST':
+        body = await request.body()
+        return dict(parse_qsl(body.decode('utf-8')))
+    return request.query_params
+
+
+async def json_content(request):
+    """Give the json body of a request (None if it is not json)"""
+    if not request.headers.get('content-type', '').startswith('application/json'):
+        return None
+    return await request.json()
+
+
+def bad_request(message):
+    return Response(message, status_code=codes.bad_request, media_type="text/plain")
+
+
+def no_platform():
+    return Response("No access platform", status_code=codes.not_found, media_type="text/plain")
+
+
+async def upstream_error(response):
+    """Forward an unsuccessful upstream response to the client"""
+    content = await response.aread()
+    await response.aclose()
+    return Response(content, status_code=response.status_code,
+                    media_type=response.headers.get('Content-Type', 'text/plain'))
+
+
+async def stream_upstream(response):
+    """Forward the body of an upstream response to the client as it arrives"""
+    if response.status_code != codes.ok:
+        return await upstream_error(response)
+
+    async def generate():
+        try:
+            async for chunk in response.aiter_bytes(app.config['STREAM_CHUNK_SIZE']):
+                yield chunk
+        finally:
+            await response.aclose()
+    return StreamingResponse(generate(), status_code=response.status_code,
+                             media_type=response.headers.get('Content-Type', 'application/json'))
+
+
+async def custom_query_json(request):
+    """Make a SPARQL query and get back a simple json for table"""
+    content = await json_content(request)
+    if content is None:
+        return bad_request("No json parameters")
+    platform = app.config['ACCESS_PLATFORM']
+    if platform is None:
+        return no_platform()
+
+    endpoint = app.config['ACCESS_ENDPOINT']
+    with flask_context(request):
+        try:
+            plan = custom_query_plan(content)
+        except ValueError as e:
+            return bad_request(str(e))
+        total = custom_query_total(content, platform, plan)
+
+    # Count (if not known) while the page is queried
+    count = None
+    if total is None:
+        count = asyncio.ensure_future(sparql_get(endpoint, plan['count_query']))
+    if platform == "TEST":  # long queries on TEST
+        await asyncio.sleep(5)
+    page = asyncio.ensure_future(sparql_get(endpoint, plan['query']))
+
+    if count is not None:
+        response = await count
+        if response.status_code != codes.ok:
+            page.cancel()
+            return await upstream_error(response)
+        total = custom_query_count(plan, response.json())
+
+    response = await page
+    app.logger.debug("THL SPARQL %s response %s", endpoint, response.status_code)
+    if response.status_code != codes.ok:
+        return await upstream_error(response)
+    return JSONResponse(custom_query_result(content, plan, response.json(), total))
+
+
+async def get_uri(request):
+    """Retrieve the nodes directly linked to a uri"""
+    uri = (await request_params(request)).get("uri")
+    if uri is None:
+        return bad_request("No uri")
+    platform = app.config['ACCESS_PLATFORM']
+    if platform is None:
+        return no_platform()
+    endpoint = app.config['ACCESS_ENDPOINT']
+    if platform == 'TEST':
+        endpoint = app.config['NODES_TESTFILE']
+    query = """SELECT DISTINCT ?s ?p ?o WHERE {
+          ?s ?p ?o.
+          VALUES ?s {<%s>}
+        }""" % uri
+    return await stream_upstream(await sparql_stream(endpoint, query))
+
+
+async def get_graph(request):
+    """Retrieve the full graph for a given ark"""
+    ark = (await request_params(request)).get("ark")
+    if ark is None:
+        return bad_request("No ark")
+    ark = app.config['ARK_PREFIX'] + ark.strip()
+    platform = app.config['ACCESS_PLATFORM']
+    if platform is None:
+        return no_platform()
+    endpoint = app.config['ACCESS_ENDPOINT']
+    if platform == 'TEST':
+        endpoint = app.config['GRAPH_TESTFILE']
+    return await stream_upstream(await sparql_stream(endpoint, GRAPH_QUERY % ark))
+
+
+async def query_json(request):
+    """Make a SPARQL query and get back a simple json for table"""
+    query = (await request_params(request)).get("query")
+    if query is None:
+        return bad_request("No query")
+    platform = app.config['ACCESS_PLATFORM']
+    if platform is None:
+        return no_platform()
+    endpoint = app.config['ACCESS_ENDPOINT']
+    if platform == 'TEST':
+        if "SUM(" in query:
+            endpoint = app.config['REPORT_ENDPOINT']
+
+    response = await sparql_stream(endpoint, query)
+    app.logger.debug("THL SPARQL response %s", response.status_code)
+    if response.status_code != codes.ok:
+        return await upstream_error(response)
+
+    async def generate():
+        # Rows parsed and sent as the upstream body arrives, as by the Flask route
+        try:
+            yield '['
+            separator = ''
+            async for row in aiter_sparql_response(response):
+                yield separator + json.dumps(row)
+                separator = ','
+            yield ']'
+        finally:
+            await response.aclose()
+    return StreamingResponse(generate(), media_type='application/json')
+
+
+async def sru_page(sru, startrecord):
+    """Get and parse a page of a SRU search"""
+    endpoint = "%s/SRU" % sru.endpoint
+    response = await async_get('sru', endpoint, params=sru.query_params(startrecord))
+    if response.status_code != codes.ok:
+        raise Exception('Error while getting data from %s' % endpoint)
+    return etree.fromstring(response.content)
+
+
+async def sru_rows(sru, query, startrecord, maximumrecords, row, columns):
+    """
+    Give the total and the rows of a SRU search.
+
+    The first page gives the number of records, the following pages needed
+    are then requested together (at most SRU_PREFETCH_PAGES + 1 at a time).
+    """
+    pagesize = app.config['SRU_PAGE_SIZE']
+    if maximumrecords != -1:
+        pagesize = min(maximumrecords, pagesize)
+    sru.query = query
+    sru.startrecord = startrecord
+    sru.maximumrecords = pagesize
+    sru.recordschema = sru.RECORD_SCHEMA
+
+    first = await sru_page(sru, startrecord)
+    sru.read_response(first)
+    total = sru.num_records
+    if total == 0:
+        return total, []
+    if maximumrecords == -1:
+        maximumrecords = total
+    last = min(startrecord + maximumrecords, total + 1)
+
+    semaphore = asyncio.Semaphore(app.config['SRU_PREFETCH_PAGES'] + 1)
+
+    async def page(start):
+        async with semaphore:
+            return await sru_page(sru, start)
+    pages = [first] + list(await asyncio.gather(
+        *[page(start) for start in range(startrecord + pagesize, last, pagesize)]))
+
+    rows = []
+    for record_data in pages:
+        for r in sru.page_records(record_data):
+            if len(rows) >= maximumrecords:
+                break
+            rows.append(row(r, columns))
+    return total, rows
+
+
+async def catalog_sru(request):
+    """Access to the SRU endpoint of the catalog"""
+    content = await json_content(request)
+    if content is None:
+        return bad_request("No json parameters")
+    if app.config['ACCESS_PLATFORM'] is None:
+        return no_platform()
+    with flask_context(request):
+        query = catalog_sru_query(content['filter'])
+        startrecord, maximumrecords = sru_paging(content, 10)
+    endpoint = SRUUnimarc()
+    endpoint.DEBUG = False
+    total, rows = await sru_rows(endpoint, query, startrecord, maximumrecords,
+                                 catalog_sru_row, content['columns'])
+    return JSONResponse({'total': total, 'rows': rows})
+
+
+async def gallica_sru(request):
+    """Access to the SRU endpoint of Gallica"""
+    content = await json_content(request)
+    if content is None:
+        return bad_request("No json parameters")
+    if app.config['ACCESS_PLATFORM'] is None:
+        return no_platform()
+    with flask_context(request):
+        query = gallica_sru_query(content['filter'])
+        startrecord, maximumrecords = sru_paging(content, -1)
+    endpoint = SRU("gallica")
+    endpoint.DEBUG = False
+    total, rows = await sru_rows(endpoint, query, startrecord, maximumrecords,
+                                 gallica_sru_row, content['columns'])
+    return JSONResponse({'total': total, 'rows': rows})
+
+
+async def label_access(request):
+    """Make a SPARQL query to retrieve a label"""
+    label = request.path_params['label']
+    platform = app.config['ACCESS_PLATFORM']
+    if platform is None:
+        return no_platform()
+    if platform == "TEST":
+        return JSONResponse(test_label_result(label))
+    with flask_context(request):
+        query = label_sparql(label)
+    if query is None:
+        return JSONResponse(empty_label_result())
+    count_cache('label', query in LABELS)
+    if query not in LABELS:
+        response = await sparql_get(app.config['ACCESS_ENDPOINT'], query)
+        if response.status_code != codes.ok:
+            app.logger.debug("Bad response for query %s", query)
+            return await upstream_error(response)
+        if len(LABELS) >= LABELS_SIZE:
+            del LABELS[next(iter(LABELS))]
+        LABELS[query] = response.json()
+    return JSONResponse(LABELS[query])
+
+
+async def upstream_unavailable(request, error):
+    """Fail fast while an upstream is unhealthy"""
+    return Response(str(error), status_code=codes.service_unavailable, media_type="text/plain",
+                    headers={'Retry-After': str(error.retry_after)})
+
+
+async def upstream_timeout(request, error):
+    """An upstream did not answer in time"""
+    return Response("Upstream timeout", status_code=codes.gateway_timeout,
+                    media_type="text/plain")
+
+
+async def upstream_connection_error(request, error):
+    """An upstream could not be reached"""
+    return Response("Upstream unreachable", status_code=codes.bad_gateway,
+                    media_type="text/plain")
+
+
+application = Starlette(
+    routes=[
+        Route("/customquery", custom_query_json, methods=['POST']),
+        Route("/uri", get_uri, methods=['GET', 'POST']),
+        Route("/graph", get_graph, methods=['GET', 'POST']),
+        Route("/query", query_json, methods=['GET', 'POST']),
+        Route("/srucatalogquery", catalog_sru, methods=['POST']),
+        Route("/srugallicaquery", gallica_sru, methods=['POST']),
+        Route("/labels/{label:path}", label_access, methods=['GET']),
+        # Everything else (pages, uploads, exports...) is served by Flask
+        Mount("/", app=WSGIMiddleware(app, workers=app.config['QUERY_WORKERS'])),
+    ],
+    exception_handlers={
+        CircuitOpenError: upstream_unavailable,
+        httpx.TimeoutException: upstream_timeout,
+        httpx.TransportError: upstream_connection_error,
+    },
+    lifespan=lifespan,
+)
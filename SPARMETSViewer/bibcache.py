@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Cache of the bib records shown by the popovers of the AIP page."""
+
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from SPARMETSViewer import app
+
+from .metrics import REGISTRY, cache_counters
+from .srusimple import SRUSimple
+from .ttlcache import TTLCache
+
+# Link added around the known arks by add_naan
+LINK_REGEX = re.compile(r'<a[^>]+>(.+)<\/a>')
+# Arks having a record in the catalogue (cb) or in Gallica (b...)
+BIB_ARK_REGEX = re.compile(r'ark:/12148/(cb|b)[0-9a-z]+$')
+
+BIB_CACHE = TTLCache(
+    'bibrecord', app.config['BIB_CACHE_TIMEOUT'],
+    app.config['BIB_CACHE_NEGATIVE_TIMEOUT'], app.config['BIB_CACHE_SIZE'])
+REGISTRY.add_collector(lambda: cache_counters('bibrecord', BIB_CACHE.hits, BIB_CACHE.misses))
+# Threads used to send the batches of bib records queries
+WARMUP_EXECUTOR = ThreadPoolExecutor(max_workers=app.config['QUERY_WORKERS'])
+
+
+def clean_ark(ark):
+    """Remove the link around an ark"""
+    return LINK_REGEX.sub(r'\1', ark).strip()
+
+
+def fetch_bib_record(ark):
+    """Query the catalogue (or Gallica) for the bib record of an ark"""
+    if ark.startswith('ark:/12148/b'):
+        query = '(dc.identifier all "%s")' % ark
+        endpoint = SRUSimple("gallica")
+    else:
+        query = '(bib.ark all "%s")' % ark
+        endpoint = SRUSimple("catalogue")
+    response = endpoint.search(query)
+    return endpoint.from_oai_to_array(response)
+
+
+def get_bib_record(ark):
+    """Give the bib record of an ark (raise ValueError if not found)"""
+    return BIB_CACHE.get(clean_ark(ark), fetch_bib_record, clean_ark(ark))
+
+
+def relation_arks(*metadata):
+    """Give the arks of the bib records related to some dc metadata (and divs)"""
+    arks = []
+
+    def walk(data):
+        if isinstance(data, list):
+            for item in data:
+                walk(item)
+        elif isinstance(data, dict):
+            if data.get('element') in ('relation', 'ark identifier') and data.get('value'):
+                ark = clean_ark(data['value'])
+                if BIB_ARK_REGEX.match(ark) and ark not in arks:
+                    arks.append(ark)
+            for value in data.values():
+                if isinstance(value, (list, dict)):
+                    walk(value)
+
+    for data in metadata:
+        walk(data)
+    return arks
+
+
+def fetch_bib_records(arks):
+    """
+    Query the catalogue and Gallica for the bib records of several arks.
+
+    The arks are sent by batches of BIB_BATCH_SIZE with one query per
+    batch; the records found are kept in the cache. The arks not matched
+    by a complete batch are kept as not found; only when the batch was
+    truncated (more records than its page) are they looked up one by one.
+    """
+    batch_size = app.config['BIB_BATCH_SIZE']
+    gallica = [ark for ark in arks if ark.startswith('ark:/12148/b')]
+    catalogue = [ark for ark in arks if not ark.startswith('ark:/12148/b')]
+    batches = []
+    for kind, kind_arks in (("gallica", gallica), ("catalogue", catalogue)):
+        for i in range(0, len(kind_arks), batch_size):
+            batches.append((kind, kind_arks[i:i + batch_size]))
+
+    def fetch(batch):
+        kind, batch_arks = batch
+        endpoint = SRUSimple(kind)
+        try:
+            found = endpoint.search_many(batch_arks)
+        except Exception as e:
+            app.logger.debug("Batch of %d bib records failed: %s", len(batch_arks), e)
+            return {}
+        records = {}
+        for ark in batch_arks:
+            if ark in found:
+                records[ark] = endpoint.from_oai_to_array(found[ark])
+                BIB_CACHE.store(ark, records[ark])
+                continue
+            if not endpoint.truncated:
+                # All the records of the batch were given: the ark has none
+                BIB_CACHE.store(ark, error=ValueError("Not found"))
+                continue
+            # Record maybe past the page of the batch
+            try:
+                records[ark] = BIB_CACHE.get(ark, fetch_bib_record, ark)
+            except ValueError:
+                continue
+            except Exception as e:
+                app.logger.debug("Bib record of %s failed: %s", ark, e)
+        return records
+
+    records = {}
+    for found in WARMUP_EXECUTOR.map(fetch, batches):
+        records.update(found)
+    return records
+
+
+def warm_bib_records(arks):
+    """Fetch in one batch the bib records of the arks which are not cached"""
+    missing = [ark for ark in arks if ark not in BIB_CACHE]
+    app.logger.debug("Warm up %d bib records of %d", len(missing), len(arks))
+    fetch_bib_records(missing)
+    return len(missing)
+
+
+def warm_up_aip(mets_instance, background=True):
+    """Prefetch the bib records related to an AIP"""
+    return warm_up_aips([mets_instance], background)
+
+
+def warm_up_aips(mets_instances, background=True):
+    """Prefetch the bib records related to some AIPs"""
+    arks = []
+    for mets_instance in mets_instances:
+        for ark in relation_arks(mets_instance.dcmetadata, mets_instance.divs):
+            if ark not in arks:
+                arks.append(ark)
+    if background:
+        threading.Thread(target=warm_bib_records, args=(arks,), daemon=True).start()
+        return len(arks)
+    return warm_bib_records(arks)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Retrieval of the manifests of many arks at once."""
+
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from SPARMETSViewer import app, db
+
+from .bibcache import warm_up_aips
+from .identifiers import from_ark_to_name
+from .ingestqueue import PROCESS_CONTEXT, PROGRESS_INTERVAL, new_job_id, job_folder, job_status
+from .ingestqueue import manifest_url, download_manifest
+from .metrics import record_ingest
+from .models import IngestJob, METS
+from .parsemets import METSFile
+
+# Columns of a METS row, in the order of its constructor
+METS_COLUMNS = ('metsfile', 'nickname', 'level', 'metslist', 'dcmetadata', 'divs',
+                'originalfilecount', 'manifest', 'detailed', 'timings')
+
+
+def parse_manifest(path, metsfile, nickname):
+    """Parse a manifest (in a parser process) and give the columns of its METS row"""
+    with app.app_context():
+        mets = METSFile(path, metsfile, nickname)
+        mets_instance = mets.extract()
+        mets.log_stats(mets_instance.metsfile, mets_instance.originalfilecount)
+    return dict((column, getattr(mets_instance, column)) for column in METS_COLUMNS)
+
+
+class BulkRetrieval(object):
+    """
+    Class retrieving the manifests of the arks of a batch.
+
+    Up to downloads manifests are downloaded at the same time; each one is
+    given to a pool of parsers processes as soon as it is there, and the
+    parsed METS are stored by batches of batch_size rows.
+    """
+
+    def __init__(self, batch, downloads=None, parsers=None, batch_size=None, report=None):
+        self.batch = batch
+        self.downloads = downloads or app.config['BULK_DOWNLOADS']
+        self.parsers = parsers or app.config['BULK_PARSERS']
+        self.batch_size = batch_size or app.config['BULK_INSERT_BATCH']
+        # Called with each job when it is finished
+        self.report = report
+        self.jobs = {}
+        self.started = set()
+        self.parsed = []
+        self.saved = 0
+
+    def __str__(self):
+        return "%s [%d arks]" % (self.batch, len(self.jobs))
+
+    def fetch(self, job_id, url, path):
+        """Download a manifest (in a download thread)"""
+        self.started.add(job_id)
+        return download_manifest(url, path)
+
+    def finish(self, job, error=None):
+        """Record the end of a job"""
+        job.status = 'failed' if error else 'done'
+        job.phase = job.phase if error else 'done'
+        job.error = str(error)[:255] if error else None
+        job.updated = datetime.now()
+        if self.report is not None:
+            self.report(job)
+
+    def save(self, force=False):
+        """Save the progress of the jobs, at most every PROGRESS_INTERVAL"""
+        now = time.time()
+        if not force and now - self.saved < PROGRESS_INTERVAL:
+            return
+        for job_id in list(self.started):
+            job = self.jobs[job_id]
+            if job.phase == 'queued':
+                job.phase = 'downloading'
+        db.session.commit()
+        self.saved = now
+
+    def store(self):
+        """Add the parsed METS to the database in one transaction"""
+        parsed, self.parsed = self.parsed, []
+        if not parsed:
+            return
+        self.save(force=True)
+        stored = [METS(*[row[column] for column in METS_COLUMNS]) for job, row in parsed]
+        db.session.add_all(stored)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            # Store them one by one to find the METS already there
+            stored = []
+            for job, row in parsed:
+                mets_instance = METS(*[row[column] for column in METS_COLUMNS])
+                db.session.add(mets_instance)
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    self.finish(job, "METS already exists")
+                else:
+                    stored.append(mets_instance)
+                    self.finish(job)
+                    record_ingest(row['originalfilecount'], row['timings'])
+                db.session.commit()
+        else:
+            for job, row in parsed:
+                self.finish(job)
+                record_ingest(row['originalfilecount'], row['timings'])
+        app.logger.debug("Bulk %s: %d METS stored", self.batch, len(parsed))
+        self.save(force=True)
+        # Prefetch the bib records shown by the pages of the AIPs
+        warm_up_aips(stored)
+
+    def run(self):
+        """Retrieve the queued arks of the batch"""
+        jobs = IngestJob.query.filter_by(batch=self.batch, status='queued') \
+            .order_by(IngestJob.created).all()
+        for job in jobs:
+            job.status = 'running'
+            job.worker = os.getpid()
+            self.jobs[job.id] = job
+        self.save(force=True)
+        folder = job_folder(self.batch)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        pending = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.downloads) as downloaders, \
+                    ProcessPoolExecutor(max_workers=self.parsers, mp_context=PROCESS_CONTEXT) as parsers:
+                for job in jobs:
+                    path = os.path.join(folder, job.metsfile)
+                    future = downloaders.submit(self.fetch, job.id, job.source, path)
+                    pending[future] = ('downloading', job, path)
+                while pending:
+                    done, _ = wait(pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        phase, job, path = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            app.logger.debug("Bulk %s: %s failed: %s", self.batch, job.ark, e)
+                            self.finish(job, e)
+                            if os.path.exists(path):
+                                os.remove(path)
+                            continue
+                        if phase == 'downloading':
+                            # Parse it while the other manifests are downloaded
+                            job.bytes_done = job.bytes_total = result
+                            job.phase = 'parsing'
+                            future = parsers.submit(parse_manifest, path, job.metsfile,
+                                                    job.nickname)
+                            pending[future] = ('parsing', job, path)
+                        else:
+                            os.remove(path)
+                            job.phase = 'storing'
+                            job.files_done = job.files_total = result['originalfilecount']
+                            self.parsed.append((job, result))
+                    if len(self.parsed) >= self.batch_size:
+                        self.store()
+                    self.save()
+                self.store()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            db.session.rollback()
+            for job in jobs:
+                if job.status == 'running':
+                    self.finish(job, "Interrupted")
+            db.session.commit()
+        return bulk_counts(jobs)
+
+
+def bulk_counts(jobs):
+    """Give the number of jobs by status"""
+    counts = {}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return counts
+
+
+def normalize_ark(ark):
+    """Give the ark with the prefix of the platform (an uri, or a bare ark id, accepted)"""
+    ark = ark.strip()
+    prefix = app.config['ARK_PREFIX']
+    if prefix in ark:
+        return ark[ark.index(prefix):]
+    return prefix + ark
+
+
+def queue_bulk(arks, nickname=None):
+    """Create the jobs retrieving the manifests of some arks, give the batch id and their number"""
+    batch = new_job_id()
+    name = app.config['ACCESS_PLATFORM']
+    if nickname:
+        name += " - " + nickname
+    now = datetime.now()
+    seen = set()
+    for ark in arks:
+        ark = normalize_ark(ark)
+        if ark in seen:
+            continue
+        seen.add(ark)
+        db.session.add(IngestJob(new_job_id(), 'bulk', manifest_url(ark), from_ark_to_name(ark),
+                                 name, now, ark=ark, batch=batch))
+    db.session.commit()
+    app.logger.debug("Bulk retrieval of %d arks queued as %s", len(seen), batch)
+    return batch, len(seen)
+
+
+def start_bulk(batch):
+    """Run the retrieval of a batch in the background"""
+    def run():
+        with app.app_context():
+            BulkRetrieval(batch).run()
+    thread = threading.Thread(target=run, name='bulk-%s' % batch, daemon=True)
+    thread.start()
+    return thread
+
+
+def bulk_status(batch):
+    """Give the status of each ark of a batch (None if the batch is unknown)"""
+    jobs = IngestJob.query.filter_by(batch=batch).order_by(IngestJob.created).all()
+    if not jobs:
+        return None
+    return {
+        'batch': batch,
+        'total': len(jobs),
+        'counts': bulk_counts(jobs),
+        'arks': [job_status(job) for job in jobs],
+    }
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Streaming export of the search results."""
+
+import csv
+import io
+import json
+
+from flask import Response, stream_with_context
+
+# Formats of export: mimetype and delimiter (None for JSON lines)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', ','),
+    'tsv': ('text/tab-separated-values', '\t'),
+    'ndjson': ('application/x-ndjson', None),
+}
+
+
+def export_lines(rows, columns, format):
+    """Give one at a time the lines of the export of rows (dictionaries)"""
+    delimiter = EXPORT_FORMATS[format][1]
+    if delimiter is None:
+        for row in rows:
+            yield json.dumps(dict((col, row.get(col, "")) for col in columns),
+                             ensure_ascii=False) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator="\n")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([row.get(col, "") for col in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header of an empty export
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_response(rows, columns, format, name):
+    """Stream the export of rows as an attachment"""
+    mimetype = EXPORT_FORMATS[format][0]
+    lines = stream_with_context(export_lines(rows, columns, format))
+    response = Response(lines, mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename="%s.%s"' % (name, format)
+    return response
@@ -88,3 +88,11 @@ def add_naan(ark):
         }
         return "<a href=\"%s\" target=\"_blank\">%s</a>" % (url + urlencode(params), ark)
     return ark
+
+
+def from_ark_to_name(ark):
+    """Transform an ark in a name"""
+    name = ark.replace(":", "-").replace("/", "-").replace("--", "-")
+    if name.endswith(".xml"):
+        return name
+    return name + ".xml"
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""Queue of the ingests (download and parsing of METS files) run by worker processes."""
+
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from requests import codes
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from SPARMETSViewer import app, db
+
+from .bibcache import warm_up_aip
+from .models import IngestJob, METS
+from .outbound import http_get
+from .parsemets import METSFile
+from .ttlcache import TTLCache
+
+# Minimum time (in seconds) between two saves of the progress of a job
+PROGRESS_INTERVAL = 0.5
+ACTIVE = ('queued', 'running')
+# Kinds of the jobs run by the ingest workers (the others are run by a bulk retrieval)
+WORKER_KINDS = ('ark', 'upload')
+
+# Worker processes started by the application
+WORKERS = []
+WORKERS_LOCK = threading.Lock()
+# Jobs done whose bib records were prefetched by this process (the latest ones only),
+# and the thread looking for them
+WARMED_JOBS = TTLCache('warmedjobs', 3600, 3600, 1000)
+WARMER = []
+# Context of the worker processes: spawned, since a child forked from the threaded web
+# server would inherit the locks (logging, metrics, circuit breakers) held by other threads
+PROCESS_CONTEXT = multiprocessing.get_context('spawn')
+
+
+class JobProgress(object):
+    """Class saving the progress of a job, at most every PROGRESS_INTERVAL"""
+
+    def __init__(self, job):
+        self.job = job
+        self.saved = 0
+
+    def save(self, force=False):
+        now = time.time()
+        if force or now - self.saved >= PROGRESS_INTERVAL:
+            self.job.updated = datetime.now()
+            db.session.commit()
+            self.saved = now
+
+    def phase(self, phase):
+        """Start a new phase of the job"""
+        self.job.phase = phase
+        self.save(force=True)
+
+    def bytes(self, done, total):
+        """Bytes of the manifest downloaded"""
+        self.job.bytes_done = done
+        self.job.bytes_total = total
+        self.save()
+
+    def files(self, phase, done, total):
+        """Progress of the parsing (see METSFile.progress)"""
+        changed = phase != self.job.phase
+        self.job.phase = phase
+        self.job.files_done = done
+        self.job.files_total = total
+        self.save(force=changed)
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def job_folder(job_id):
+    """Folder of the files of a job (removed when the job ends)"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], job_id)
+
+
+def manifest_url(ark):
+    """Url of the manifest of an ark in the access module"""
+    if app.config['ACCESS_PLATFORM'] == 'TEST':
+        return app.config['ACCESS_URL']
+    return '%s/access/referenceDocumentRepository/%s.manifest' % (app.config['ACCESS_URL'], ark)
+
+
+def enqueue_job(job_id, kind, source, metsfile, nickname, ark=None):
+    """
+    Queue the ingest of a METS file and give the id of the job.
+
+    kind is 'ark' (source is the url of the manifest to download) or
+    'upload' (source is the path of the file, in the folder of the job).
+    """
+    job = IngestJob(job_id, kind, source, metsfile, nickname, datetime.now(), ark=ark)
+    db.session.add(job)
+    db.session.commit()
+    app.logger.debug("Ingest of %s queued as job %s", metsfile, job_id)
+    if app.config['INGEST_WORKERS'] > 0:
+        start_workers()
+    return job_id
+
+
+def get_job(job_id):
+    return IngestJob.query.get(job_id)
+
+
+def active_jobs():
+    """Give the jobs not yet finished, the oldest first"""
+    try:
+        return IngestJob.query.filter(IngestJob.status.in_(ACTIVE)) \
+            .order_by(IngestJob.created).all()
+    except OperationalError:
+        # Database not yet migrated to the jobs table
+        db.session.rollback()
+        return []
+
+
+def recent_jobs(limit=20):
+    """Give the last jobs queued, the most recent first"""
+    return IngestJob.query.order_by(IngestJob.created.desc()).limit(limit).all()
+
+
+def job_status(job):
+    """Give the status and the progress of a job"""
+    return {
+        'id': job.id,
+        'ark': job.ark,
+        'metsfile': job.metsfile,
+        'status': job.status,
+        'phase': job.phase,
+        'bytes_done': job.bytes_done,
+        'bytes_total': job.bytes_total,
+        'files_done': job.files_done,
+        'files_total': job.files_total,
+        'error': job.error,
+        'created': job.created.isoformat() if job.created else None,
+        'updated': job.updated.isoformat() if job.updated else None,
+    }
+
+
+def queue_stats():
+    """Give the number of jobs by status"""
+    try:
+        counts = db.session.query(IngestJob.status, func.count(IngestJob.id)) \
+            .group_by(IngestJob.status).all()
+    except OperationalError:
+        db.session.rollback()
+        return None
+    return dict(counts)
+
+
+def download_manifest(url, path, progress=None):
+    """Download a manifest in the given file, give its size"""
+    response = http_get('access', url, stream=True)
+    try:
+        if response.status_code != codes.ok:
+            raise ValueError("METS not found")
+        total = int(response.headers.get('Content-Length') or 0)
+        done = 0
+        with open(path, "wb") as file:
+            for chunk in response.iter_content(app.config['STREAM_CHUNK_SIZE']):
+                file.write(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress.bytes(done, total)
+        if progress is not None:
+            progress.bytes(done, done)
+    finally:
+        response.close()
+    return done
+
+
+def claim_job():
+    """Take the oldest queued job (None if there is none, or another worker took it)"""
+    job = IngestJob.query.filter_by(status='queued') \
+        .filter(IngestJob.kind.in_(WORKER_KINDS)).order_by(IngestJob.created).first()
+    if job is None:
+        return None
+    claimed = IngestJob.query.filter_by(id=job.id, status='queued').update(
+        {'status': 'running', 'worker': os.getpid(), 'updated': datetime.now()},
+        synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return None
+    return IngestJob.query.get(job.id)
+
+
+def run_job(job):
+    """Download (for an ark) and parse the METS file of a job"""
+    progress = JobProgress(job)
+    folder = job_folder(job.id)
+    app.logger.debug("Job %s: ingest of %s", job.id, job.metsfile)
+    try:
+        if job.kind == 'ark':
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            path = os.path.join(folder, job.metsfile)
+            progress.phase('downloading')
+            download_manifest(job.source, path, progress)
+        else:
+            path = job.source
+        mets = METSFile(path, job.metsfile, job.nickname, progress=progress.files)
+        if not mets.parse_mets():
+            raise ValueError("METS already exists")
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning("Job %s failed: %s", job.id, e)
+        job.status = 'failed'
+        job.error = str(e)[:255]
+    else:
+        job.status = 'done'
+        job.phase = 'done'
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    job.updated = datetime.now()
+    db.session.commit()
+
+
+def pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def requeue_lost_jobs():
+    """Queue again the jobs left running by a worker which died"""
+    for job in IngestJob.query.filter_by(status='running'):
+        if pid_alive(job.worker):
+            continue
+        if job.kind not in WORKER_KINDS:
+            # A bulk retrieval is not resumed
+            job.status = 'failed'
+            job.error = "Interrupted"
+            continue
+        app.logger.warning("Job %s lost by worker %s, queued again", job.id, job.worker)
+        job.status = 'queued'
+        job.phase = 'queued'
+    db.session.commit()
+
+
+def work():
+    """Run the queued jobs one after the other (loop of a worker process)"""
+    with app.app_context():
+        # Do not share the connections of the parent process
+        db.engine.dispose()
+        requeue_lost_jobs()
+        while True:
+            try:
+                job = claim_job()
+            except OperationalError as e:
+                # Database locked by another process
+                app.logger.debug("Claim of a job failed: %s", e)
+                db.session.rollback()
+                job = None
+            if job is None:
+                time.sleep(app.config['INGEST_POLL_INTERVAL'])
+                continue
+            run_job(job)
+
+
+def start_workers(count=None):
+    """Start the worker processes which are not (or no longer) running"""
+    if count is None:
+        count = app.config['INGEST_WORKERS']
+    with WORKERS_LOCK:
+        WORKERS[:] = [worker for worker in WORKERS if worker.is_alive()]
+        while len(WORKERS) < count:
+            worker = PROCESS_CONTEXT.Process(target=work, name='ingest-worker', daemon=True)
+            worker.start()
+            WORKERS.append(worker)
+        return list(WORKERS)
+
+
+def warm_up_done_jobs(since):
+    """
+    Prefetch the bib records of the AIPs of the jobs done since a date (once
+    each), give the date of the last one
+    """
+    jobs = IngestJob.query.filter(IngestJob.status == 'done', IngestJob.kind.in_(WORKER_KINDS),
+                                  IngestJob.updated >= since).all()
+    for job in jobs:
+        since = max(since, job.updated)
+        if job.id in WARMED_JOBS:
+            continue
+        WARMED_JOBS.store(job.id, True)
+        mets_instance = METS.query.filter_by(metsfile=job.metsfile).first()
+        if mets_instance is not None:
+            warm_up_aip(mets_instance)
+    return since
+
+
+def warm_up_loop():
+    """Look for the jobs done by the workers (loop of the warmer thread)"""
+    since = datetime.now()
+    while True:
+        time.sleep(app.config['JOB_WARMUP_INTERVAL'])
+        with app.app_context():
+            try:
+                since = warm_up_done_jobs(since)
+            except OperationalError as e:
+                app.logger.debug("Jobs done not read: %s", e)
+                db.session.rollback()
+
+
+@app.before_request
+def start_job_warmer():
+    """
+    Start (once) the thread of the web process prefetching the bib records
+    of the jobs done: the workers run in other processes, whose cache does
+    not serve /bibrecord
+    """
+    if WARMER or not app.config['JOB_WARMUP_INTERVAL']:
+        return
+    with WORKERS_LOCK:
+        if not WARMER:
+            warmer = threading.Thread(target=warm_up_loop, name='job-warmer', daemon=True)
+            warmer.start()
+            WARMER.append(warmer)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Store of the raw manifests, compressed and addressed by the hash of their content."""
+
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+
+from SPARMETSViewer import app
+
+
+def file_hash(path):
+    """Give the SHA-256 of the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path(digest):
+    """Path of a stored manifest"""
+    return os.path.join(app.config['MANIFEST_STORE'], digest[:2], digest + '.xml.gz')
+
+
+def store_manifest(path):
+    """Keep a copy of a manifest in the store (if any), give its hash"""
+    if not app.config['MANIFEST_STORE']:
+        return None
+    digest = file_hash(path)
+    target = manifest_path(digest)
+    if os.path.exists(target):
+        return digest
+    folder = os.path.dirname(target)
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    # Written apart then renamed, as other processes may store the same manifest
+    fd, temp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    try:
+        with open(path, 'rb') as source, os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as stored:
+                shutil.copyfileobj(source, stored)
+        os.replace(temp, target)
+    except BaseException:
+        os.remove(temp)
+        raise
+    app.logger.debug("Manifest %s stored as %s", path, digest)
+    return digest
+
+
+def has_manifest(digest):
+    return bool(digest) and os.path.exists(manifest_path(digest))
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""Counters and latency histograms, exposed in the Prometheus text format."""
+
+import atexit
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from SPARMETSViewer import app
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Known metrics: type and help
+METRICS = {
+    'metsviewer_requests_total': ('counter', "Requests answered, by route, method and status"),
+    'metsviewer_request_seconds': ('histogram', "Time to answer a request, by route"),
+    'metsviewer_upstream_requests_total': ('counter', "Calls to the upstreams, by outcome"),
+    'metsviewer_upstream_seconds': ('histogram', "Time of the calls to the upstreams"),
+    'metsviewer_cache_requests_total': ('counter', "Lookups in the caches, by result"),
+    'metsviewer_ingested_total': ('counter', "METS files ingested"),
+    'metsviewer_ingested_files_total': ('counter', "Files of the METS ingested"),
+    'metsviewer_ingested_bytes_total': ('counter', "Bytes of the manifests ingested"),
+    'metsviewer_parse_seconds': ('histogram', "Time to parse a METS file"),
+    'metsviewer_db_query_seconds': ('histogram', "Time of the database statements, by verb"),
+}
+# Prefix of the files of the metrics of each process
+FILE_PREFIX = 'metrics-'
+# Verbs of the database statements told apart
+DB_VERBS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+
+def upstream_host(url):
+    """Host of an upstream URL (telling apart the endpoints of a same upstream)"""
+    return urlsplit(url).hostname or ''
+
+
+class Registry(object):
+    """
+    Class keeping the metrics of this process.
+
+    With METRICS_DIR, the metrics of each process are saved in a file of this
+    folder every METRICS_SAVE_INTERVAL seconds (and at exit), and collect
+    sums the files of all the processes; otherwise only the metrics of this
+    process are given. Callables added by add_collector give counters read
+    when collecting (such as the hits of a cache).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collectors = []
+        self.reset()
+
+    def reset(self):
+        """Forget the metrics (in a new process, those of the parent are not its own)"""
+        self.pid = os.getpid()
+        self.counters = {}
+        self.histograms = {}
+        self.dirty = False
+        self.saver = None
+
+    def check_process(self):
+        if self.pid != os.getpid():
+            self.reset()
+        if self.saver is None and app.config['METRICS_DIR']:
+            self.saver = threading.Thread(target=self.save_loop, name='metrics-saver')
+            self.saver.daemon = True
+            self.saver.start()
+
+    def inc(self, name, labels=None, value=1):
+        """Add value to a counter"""
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.check_process()
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.dirty = True
+
+    def observe(self, name, seconds, labels=None):
+        """Add a duration to a histogram"""
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.check_process()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Count of each bucket, then the count and the sum of the durations
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += 1
+            histogram[-1] += seconds
+            self.dirty = True
+
+    def add_collector(self, collector):
+        """Add a callable giving a list of (name, labels, value) counters"""
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        """Give the metrics of this process, as saved in its file"""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            counters = [[name, list(labels), value]
+                        for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), list(values)]
+                          for (name, labels), values in self.histograms.items()]
+            self.dirty = False
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                counters.append([name, sorted(labels.items()), value])
+        return {'counters': counters, 'histograms': histograms}
+
+    def save(self):
+        """Save the metrics of this process in its file of METRICS_DIR"""
+        folder = app.config['METRICS_DIR']
+        if not folder:
+            return
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp, os.path.join(folder, '%s%d.json' % (FILE_PREFIX, os.getpid())))
+
+    def save_loop(self):
+        while True:
+            time.sleep(app.config['METRICS_SAVE_INTERVAL'])
+            if self.dirty:
+                try:
+                    self.save()
+                except OSError as e:
+                    app.logger.warning("Metrics not saved: %s", e)
+
+    def collect(self):
+        """Give the metrics of all the processes, summed"""
+        folder = app.config['METRICS_DIR']
+        if folder:
+            # The latest ones of this process
+            self.save()
+            snapshots = []
+            for path in glob.glob(os.path.join(folder, FILE_PREFIX + '*.json')):
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    app.logger.warning("Metrics of %s not read: %s", path, e)
+        else:
+            snapshots = [self.snapshot()]
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+        return counters, histograms
+
+    def render(self):
+        """Give the metrics in the Prometheus text format"""
+        counters, histograms = self.collect()
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append((name, labels, value))
+        for (name, labels), values in histograms.items():
+            cumulated = 0
+            lines = samples.setdefault(name, [])
+            for bound, count in zip(LATENCY_BUCKETS, values):
+                cumulated += count
+                lines.append((name + '_bucket', labels + (('le', str(bound)),), cumulated))
+            lines.append((name + '_bucket', labels + (('le', '+Inf'),), values[-2]))
+            lines.append((name + '_count', labels, values[-2]))
+            lines.append((name + '_sum', labels, values[-1]))
+        output = []
+        for name in sorted(samples):
+            kind, help_text = METRICS.get(name, ('untyped', name))
+            output.append("# HELP %s %s" % (name, help_text))
+            output.append("# TYPE %s %s" % (name, kind))
+            for sample, labels, value in samples[name]:
+                output.append("%s%s %s" % (sample, format_labels(labels), format_value(value)))
+        return "\n".join(output) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# Metrics of this process
+REGISTRY = Registry()
+
+
+def observe_upstream(upstream, url, seconds, outcome):
+    """Record a call to an upstream (outcome: the status of the answer, or error)"""
+    labels = {'upstream': upstream, 'host': upstream_host(url)}
+    REGISTRY.observe('metsviewer_upstream_seconds', seconds, labels)
+    labels['outcome'] = str(outcome)
+    REGISTRY.inc('metsviewer_upstream_requests_total', labels)
+
+
+def count_cache(cache, hit):
+    """Record a lookup in a cache"""
+    REGISTRY.inc('metsviewer_cache_requests_total',
+                 {'cache': cache, 'result': 'hit' if hit else 'miss'})
+
+
+def cache_counters(cache, hits, misses):
+    """Counters of a cache keeping its own hits and misses, for a collector"""
+    return [
+        ('metsviewer_cache_requests_total', {'cache': cache, 'result': 'hit'}, hits),
+        ('metsviewer_cache_requests_total', {'cache': cache, 'result': 'miss'}, misses),
+    ]
+
+
+def record_ingest(files, timings):
+    """Record a METS ingested, with its timings (see METSFile.parse_stats)"""
+    REGISTRY.inc('metsviewer_ingested_total')
+    REGISTRY.inc('metsviewer_ingested_files_total', value=files or 0)
+    if timings:
+        REGISTRY.inc('metsviewer_ingested_bytes_total', value=timings['counters'].get('bytes', 0))
+        REGISTRY.observe('metsviewer_parse_seconds', sum(timings['phases'].values()))
+
+
+@app.before_request
+def start_request_timer():
+    g.metrics_start = time.perf_counter()
+
+
+@app.after_request
+def keep_request_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request(error=None):
+    """
+    Record the time to answer a request (until its headers, for a streamed
+    response); recorded at teardown so that the unhandled errors count too
+    """
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    # No response when an error was not handled (or raised by an after_request)
+    status = g.pop('metrics_status', None)
+    if status is None or error is not None:
+        status = 500
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REGISTRY.observe('metsviewer_request_seconds', time.perf_counter() - start,
+                     {'route': route, 'method': request.method})
+    REGISTRY.inc('metsviewer_requests_total',
+                 {'route': route, 'method': request.method, 'status': status})
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    """Record the time of a database statement"""
+    starts = conn.info.get('metrics_start')
+    if not starts:
+        return
+    verb = statement.lstrip()[:6].upper()
+    REGISTRY.observe('metsviewer_db_query_seconds', time.perf_counter() - starts.pop(),
+                     {'verb': verb if verb in DB_VERBS else 'OTHER'})
+
+
+@event.listens_for(Engine, 'handle_error')
+def forget_statement(context):
+    starts = context.connection.info.get('metrics_start') if context.connection else None
+    if starts:
+        starts.pop()
+
+
+@atexit.register
+def save_at_exit():
+    if REGISTRY.dirty and REGISTRY.pid == os.getpid():
+        try:
+            REGISTRY.save()
+        except OSError:
+            pass
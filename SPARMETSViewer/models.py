@@ -13,8 +13,15 @@ class METS(db.Model):
     dcmetadata = db.Column(db.PickleType)
     divs = db.Column(db.PickleType)
     originalfilecount = db.Column(db.Integer())
+    # Hash of the raw manifest in the manifest store
+    manifest = db.Column(db.String(64), index=True)
+    # False while only a summary is extracted (see LAZY_PARSING)
+    detailed = db.Column(db.Boolean(), default=True)
+    # Timings of the parsing phases and counters (see METSFile.parse_stats)
+    timings = db.Column(db.PickleType)
 
-    def __init__(self, metsfile, nickname, level, metslist, dcmetadata, divs, originalfilecount):
+    def __init__(self, metsfile, nickname, level, metslist, dcmetadata, divs, originalfilecount,
+                 manifest=None, detailed=True, timings=None):
         self.metsfile = metsfile
         self.nickname = nickname
         self.level = level
@@ -22,6 +29,144 @@ class METS(db.Model):
         self.dcmetadata = dcmetadata
         self.divs = divs
         self.originalfilecount = originalfilecount
+        self.manifest = manifest
+        self.detailed = detailed
+        self.timings = timings
 
     def __repr__(self):
         return '<File %r>' % self.metsfile
+
+
+class ReportAggregate(db.Model):
+    """Counts of the packages ingested in a channel during a month"""
+    channel = db.Column(db.String(255), primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)
+    name = db.Column(db.String(120))
+    packages = db.Column(db.Integer(), default=0)
+    files = db.Column(db.BigInteger(), default=0)
+    size = db.Column(db.BigInteger(), default=0)
+
+    def __init__(self, channel, month, name):
+        self.channel = channel
+        self.month = month
+        self.name = name
+        self.packages = 0
+        self.files = 0
+        self.size = 0
+
+    def __repr__(self):
+        return '<Aggregate %r %r>' % (self.channel, self.month)
+
+
+class AggregateWatermark(db.Model):
+    """Date of the last ingest taken into account by the aggregates"""
+    name = db.Column(db.String(120), primary_key=True)
+    date = db.Column(db.String(64))
+    refreshed = db.Column(db.DateTime())
+
+    def __init__(self, name, date, refreshed):
+        self.name = name
+        self.date = date
+        self.refreshed = refreshed
+
+    def __repr__(self):
+        return '<Watermark %r %r>' % (self.name, self.date)
+
+
+class IngestJob(db.Model):
+    """Download and parsing of a METS file, run by an ingest worker"""
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(16))
+    source = db.Column(db.String(1024))
+    ark = db.Column(db.String(120))
+    # Jobs of a bulk retrieval share the same batch
+    batch = db.Column(db.String(32), index=True)
+    metsfile = db.Column(db.String(120))
+    nickname = db.Column(db.String(120))
+    # queued, running, done or failed
+    status = db.Column(db.String(16), index=True)
+    # queued, downloading, parsing, storing or done
+    phase = db.Column(db.String(16))
+    bytes_done = db.Column(db.BigInteger(), default=0)
+    bytes_total = db.Column(db.BigInteger(), default=0)
+    files_done = db.Column(db.Integer(), default=0)
+    files_total = db.Column(db.Integer(), default=0)
+    error = db.Column(db.String(255))
+    worker = db.Column(db.Integer())
+    created = db.Column(db.DateTime())
+    updated = db.Column(db.DateTime())
+
+    def __init__(self, id, kind, source, metsfile, nickname, created, ark=None, batch=None):
+        self.id = id
+        self.kind = kind
+        self.source = source
+        self.ark = ark
+        self.batch = batch
+        self.metsfile = metsfile
+        self.nickname = nickname
+        self.status = 'queued'
+        self.phase = 'queued'
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.files_done = 0
+        self.files_total = 0
+        self.created = created
+        self.updated = created
+
+    def __repr__(self):
+        return '<Job %r %r>' % (self.id, self.status)
+
+
+class WatchedFile(db.Model):
+    """Manifest found in the watch folder, known by the hash of its content"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    path = db.Column(db.String(1024))
+    job = db.Column(db.String(32))
+    # queued, done or failed
+    status = db.Column(db.String(16), index=True)
+    error = db.Column(db.String(255))
+    created = db.Column(db.DateTime())
+    updated = db.Column(db.DateTime())
+
+    def __init__(self, sha256, path, job, created):
+        self.sha256 = sha256
+        self.path = path
+        self.job = job
+        self.status = 'queued'
+        self.created = created
+        self.updated = created
+
+    def __repr__(self):
+        return '<Watched %r %r>' % (self.path, self.status)
+
+
+class SlowQuery(db.Model):
+    """Call to a SPARQL or SRU endpoint slower than SLOW_QUERY_THRESHOLD"""
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime(), index=True)
+    upstream = db.Column(db.String(16))
+    host = db.Column(db.String(255))
+    # SHA-1 of the normalized query, the same for the queries differing only by their values
+    fingerprint = db.Column(db.String(40), index=True)
+    normalized = db.Column(db.Text())
+    # Text of the query as sent
+    text = db.Column(db.Text())
+    duration = db.Column(db.Float())
+    size = db.Column(db.BigInteger())
+    # HTTP status, or error
+    status = db.Column(db.String(16))
+
+    def __init__(self, created, upstream, host, fingerprint, normalized, text, duration, size,
+                 status):
+        self.created = created
+        self.upstream = upstream
+        self.host = host
+        self.fingerprint = fingerprint
+        self.normalized = normalized
+        self.text = text
+        self.duration = duration
+        self.size = size
+        self.status = status
+
+    def __repr__(self):
+        return '<SlowQuery %r %r>' % (self.upstream, self.duration)
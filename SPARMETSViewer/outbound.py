@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Outbound HTTP calls: timeouts, retries and circuit breaking."""
+
+import random
+import threading
+import time
+
+import requests
+from requests import codes
+
+from SPARMETSViewer import app
+
+from .metrics import observe_upstream, upstream_host
+from .slowqueries import log_slow_query
+
+# Statuses of an upstream which is (maybe temporarily) unhealthy
+UNHEALTHY_STATUSES = (codes.bad_gateway, codes.service_unavailable, codes.gateway_timeout)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream known to be unhealthy"""
+
+    def __init__(self, name, retry_after):
+        Exception.__init__(self, "%s is unavailable (retry in %ds)" % (name, retry_after))
+        self.name = name
+        self.retry_after = retry_after
+
+
+class UpstreamStatusError(Exception):
+    """Raised when an upstream answers with an unsuccessful status in the middle of a work"""
+
+    def __init__(self, name, response):
+        Exception.__init__(self, "%s answered %s" % (name, response.status_code))
+        self.name = name
+        self.status_code = response.status_code
+        self.content = response.content
+        self.mimetype = response.headers.get('Content-Type', 'text/plain')
+
+
+class CircuitBreaker(object):
+    """
+    Class failing fast while an upstream is unhealthy.
+
+    After failures consecutive failed calls the circuit opens: calls are
+    refused during reset_timeout seconds, then one trial call is let through
+    (half open), which closes the circuit if it succeeds and opens it again
+    otherwise.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failures, reset_timeout):
+        self.name = name
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial = False
+        self.rejected = 0
+
+    def __str__(self):
+        return "%s [%s]" % (self.name, self.state)
+
+    def before(self):
+        """Check that a call can be sent (raise CircuitOpenError otherwise)"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            elapsed = time.time() - self.opened_at
+            if self.state == self.OPEN and elapsed >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial = False
+            if self.state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError(self.name, max(1, int(self.reset_timeout - elapsed)))
+
+    def success(self):
+        """Record a successful call"""
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial = False
+
+    def release(self):
+        """Give back the trial call, ended without telling whether the upstream is healthy"""
+        with self.lock:
+            self.trial = False
+
+    def failure(self):
+        """Record a failed call"""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+                if self.state != self.OPEN:
+                    app.logger.debug("Circuit %s opened after %d failures",
+                                     self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.trial = False
+
+    def stats(self):
+        """Give the state of the circuit"""
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'rejected': self.rejected,
+            }
+
+
+# Known circuit breakers, by upstream and host
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(upstream, url):
+    """Retrieve (or create) the circuit breaker of the host of an upstream"""
+    name = "%s %s" % (upstream, upstream_host(url))
+    with BREAKERS_LOCK:
+        if name not in BREAKERS:
+            BREAKERS[name] = CircuitBreaker(
+                name, app.config['BREAKER_FAILURES'], app.config['BREAKER_RESET_TIMEOUT'])
+        return BREAKERS[name]
+
+
+def breakers_stats():
+    """Give the state of all the circuit breakers"""
+    with BREAKERS_LOCK:
+        breakers = list(BREAKERS.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+def backoff(attempt):
+    """Time to wait before a retry (exponential backoff with full jitter)"""
+    return random.uniform(0, app.config['OUTBOUND_BACKOFF'] * (2 ** attempt))
+
+
+def http_get(upstream, url, **kwargs):
+    """
+    Send a GET to an upstream with its timeout, retries and circuit breaker.
+
+    upstream is a key of OUTBOUND_TIMEOUTS (sparql, sru, access). Connection
+    errors, timeouts and 502/503/504 answers are retried OUTBOUND_RETRIES
+    times; the last answer is given back (or the last error raised). Each
+    host of an upstream has its own circuit breaker.
+    """
+    breaker = get_breaker(upstream, url)
+    breaker.before()
+    try:
+        return send_with_retries(breaker, upstream, url, **kwargs)
+    except (requests.ConnectionError, requests.Timeout):
+        # Already recorded
+        raise
+    except requests.RequestException:
+        breaker.failure()
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+
+
+def send_with_retries(breaker, upstream, url, **kwargs):
+    """Send a GET (see http_get), recording the outcome in the circuit breaker"""
+    timeouts = app.config['OUTBOUND_TIMEOUTS']
+    kwargs.setdefault('timeout', timeouts.get(upstream, timeouts['default']))
+    retries = app.config['OUTBOUND_RETRIES']
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            response = requests.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            elapsed = time.perf_counter() - start
+            observe_upstream(upstream, url, elapsed, 'error')
+            log_slow_query(upstream, url, kwargs.get('params'), elapsed, 'error')
+            app.logger.debug("GET %s failed (attempt %d): %s", upstream, attempt + 1, e)
+            if attempt >= retries:
+                breaker.failure()
+                raise
+        else:
+            elapsed = time.perf_counter() - start
+            observe_upstream(upstream, url, elapsed, response.status_code)
+            log_slow_query(upstream, url, kwargs.get('params'), elapsed, response.status_code,
+                           response, kwargs.get('stream', False))
+            if response.status_code not in UNHEALTHY_STATUSES:
+                breaker.success()
+                return response
+            app.logger.debug("GET %s answered %s (attempt %d)",
+                             upstream, response.status_code, attempt + 1)
+            if attempt >= retries:
+                breaker.failure()
+                return response
+            response.close()
+        time.sleep(backoff(attempt))
+        attempt += 1
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 """How to parse a METS file."""
 
+import copy
+import gzip
 import os
 import sys
+import time
+from contextlib import contextmanager
 
 from flask_babel import gettext
 from lxml import etree, objectify
 from sqlalchemy.exc import IntegrityError
 
-from SPARMETSViewer import db
+from SPARMETSViewer import app, db
+from .manifeststore import store_manifest, manifest_path, has_manifest
+from .metrics import record_ingest
 from .models import METS
 from .identifiers import convert_size, extract_date, add_naan
 
@@ -53,6 +59,25 @@ class METSFile(object):
         gettext('structMap'), gettext('set'), gettext('group'), gettext('object'),
         gettext('file')
     ]
+    # Phases of the parsing which are timed, and their labels
+    PARSE_PHASES = [
+        ('store', gettext('Manifest storage')),
+        ('xml', gettext('XML parse')),
+        ('namespaces', gettext('Namespace stripping')),
+        ('files', gettext('Files extraction')),
+        ('structmap', gettext('structMap extraction')),
+        ('dc', gettext('Dublin Core extraction')),
+        ('group_events', gettext('Group events extraction')),
+        ('insert', gettext('Database insert')),
+        ('commit', gettext('Database commit')),
+        ('details', gettext('Details extraction')),
+    ]
+    # Counters of the parsing, and their labels
+    PARSE_COUNTERS = [
+        ('sections', gettext('Sections resolved')),
+        ('events', gettext('Events parsed')),
+        ('bytes', gettext('Bytes read')),
+    ]
     # Compression decoder (MIX 6.1.3.1 Compression scheme value labels.)
     MIX_COMPRESSION = {
         "1": "uncompressed", "2": "CCITT 1D",
@@ -71,15 +96,92 @@ class METSFile(object):
         "34712": "JPEG 2000"
     }
 
-    def __init__(self, path, dip_id, nickname):
+    # Sections of the amdSec of a file and their extractor (the first found is used)
+    FILE_SECTIONS = [
+        ("./mdWrap[@MDTYPE='PREMIS:OBJECT']/xmlData", 'parse_file_premis_object'),
+        ("./mdWrap[@MDTYPE='DC']/xmlData", 'parse_file_dc'),
+        ("./mdWrap[@MDTYPE='PREMIS:EVENT']/xmlData", 'parse_file_premis_event'),
+        ("./mdWrap[@MDTYPE='NISOIMG']/xmlData", 'parse_file_mix'),
+        ("./mdWrap[@MDTYPE='TEXTMD']/xmlData", 'parse_file_textmd'),
+        ("./mdWrap[@OTHERMDTYPE='MPEG7']/xmlData", 'parse_file_mpeg7'),
+        ("./mdWrap[@OTHERMDTYPE='containerMD']/xmlData", 'parse_file_containermd'),
+        ("./mdWrap[@OTHERMDTYPE='XMP']/xmlData", 'parse_file_xmp'),
+    ]
+    # Extractors which can be run again on a stored manifest (the events are only added)
+    REEXTRACTORS = [extractor for xpath, extractor in FILE_SECTIONS
+                    if extractor != 'parse_file_premis_event']
+    # Extractors run at ingest in summary mode (LAZY_PARSING), the others on demand
+    SUMMARY_EXTRACTORS = ['parse_file_premis_object']
+    DETAIL_EXTRACTORS = [extractor for xpath, extractor in FILE_SECTIONS
+                         if extractor != 'parse_file_premis_object']
+
+    def __init__(self, path, dip_id, nickname, progress=None, summary=None):
         self.path = os.path.abspath(path)
         self.dip_id = dip_id
         self.nickname = nickname
         self.ark = ''
+        # Extract only a summary, the details coming later from the stored manifest
+        self.summary = app.config['LAZY_PARSING'] if summary is None else summary
+        # Sections of the METS file by kind and ID, see find_section
+        self.sections = None
+        self.sections_root = None
+        # Called with (phase, files done, files total) while parsing
+        self.progress = progress
+        # Seconds spent in each phase, and counters (see parse_stats)
+        self.timings = {}
+        self.counters = dict((counter, 0) for counter, label in self.PARSE_COUNTERS)
 
     def __str__(self):
         return self.path
 
+    def report(self, phase, files_done=0, files_total=0):
+        """Give the progress of the parsing to the progress callback, if any"""
+        if self.progress is not None:
+            self.progress(phase, files_done, files_total)
+
+    @contextmanager
+    def timed(self, phase):
+        """Add the time spent in the block to the phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.0) + time.perf_counter() - start
+
+    def parse_stats(self):
+        """Give the timings of the phases (in seconds) and the counters, as kept with the METS"""
+        return {
+            'phases': dict((phase, round(self.timings[phase], 4))
+                           for phase, label in self.PARSE_PHASES if phase in self.timings),
+            'counters': dict(self.counters),
+        }
+
+    def log_stats(self, mets_filename, files):
+        """Log the timings and the counters of the parsing"""
+        stats = self.parse_stats()
+        app.logger.info(
+            "Parsed %s (%d files) in %.3f s: %s; %s", mets_filename, files,
+            sum(stats['phases'].values()),
+            " ".join("%s=%.3f" % item for item in stats['phases'].items()),
+            " ".join("%s=%d" % item for item in stats['counters'].items()))
+
+    def find_section(self, mets_root, kind, section_id):
+        """Give the dmdSec, or the amdSec child, with the given ID (the first one, or None)"""
+        if self.sections_root is not mets_root:
+            # Indexed once, instead of a search of the whole tree at each reference
+            self.sections = {}
+            for section in mets_root.iter('dmdSec'):
+                self.sections.setdefault(('dmdSec', section.get('ID')), section)
+            for amdsec in mets_root.iter('amdSec'):
+                for section in amdsec:
+                    if isinstance(section.tag, str):
+                        self.sections.setdefault(('amdSec', section.get('ID')), section)
+            self.sections_root = mets_root
+        section = self.sections.get((kind, section_id))
+        if section is not None:
+            self.counters['sections'] += 1
+        return section
+
     def strip_prefix(self, value):
         i = value.find(':')
         if i >= 0:
@@ -254,6 +356,7 @@ class METSFile(object):
             'object_value': './linkingObjectIdentifierValue',
             'object_role': './linkingObjectRole'
         }
+        self.counters['events'] += 1
         # create dict to store data
         premis_event = dict()
         # iterate over elements and write key, value for each to premis_event dictionary
@@ -290,6 +393,10 @@ class METSFile(object):
 
         return premis_event
 
+    def parse_file_premis_event(self, element, file_data):
+        """parse premis event related to file"""
+        file_data['premis_events'].append(self.parse_premis_event(element))
+
     def parse_file_mix(self, element, file_data):
         """parse mix element related to file"""
         # create dict for names and xpaths of desired elements
@@ -408,10 +515,8 @@ class METSFile(object):
         dmdsec_ids = target.attrib.get('DMDID')
         if dmdsec_ids is not None:
             for dmdsec_id in dmdsec_ids.split(" "):
-                # parse dmdSec
-                dmdsec_xpath = ".//dmdSec[@ID='{}']".format(dmdsec_id)
-                # Only one section per ID
-                section = mets_root.find(dmdsec_xpath)
+                # parse dmdSec (only one section per ID)
+                section = self.find_section(mets_root, 'dmdSec', dmdsec_id)
                 if section is None:
                     continue
                 dc_xml = section.find('mdWrap/xmlData/spar_dc')
@@ -428,10 +533,8 @@ class METSFile(object):
         if amdsec_ids is not None:
             object_data['premis_events'] = []
             for amdsec_id in amdsec_ids.split(" "):
-                # parse amdSec
-                amdsec_xpath = ".//amdSec/*[@ID='{}']".format(amdsec_id)
-                # Only one section per ID
-                section = mets_root.find(amdsec_xpath)
+                # parse amdSec (only one section per ID)
+                section = self.find_section(mets_root, 'amdSec', amdsec_id)
                 if section is None:
                     continue
                 # parse premis events related to file
@@ -458,10 +561,8 @@ class METSFile(object):
         dmdsec_ids = set_element.attrib.get('DMDID')
         if dmdsec_ids is not None:
             for dmdsec_id in dmdsec_ids.split(" "):
-                # parse dmdSec
-                dmdsec_xpath = ".//dmdSec[@ID='{}']".format(dmdsec_id)
-                # Only one section per ID
-                section = mets_root.find(dmdsec_xpath)
+                # parse dmdSec (only one section per ID)
+                section = self.find_section(mets_root, 'dmdSec', dmdsec_id)
                 if section is None:
                     continue
                 dc_xml = section.find('mdWrap/xmlData/spar_dc')
@@ -498,8 +599,37 @@ class METSFile(object):
         group_data['objects'] = objects_data
         return div_data
 
-    def extract_file_info(self, target, mets_root):
-        """extract information about the file in target"""
+    def extract_file_amdsec(self, target, mets_root, file_data, extractors=None):
+        """Run the extractors (all if None) on the amdSec sections of the file in target"""
+        for amdsec_id in target.get('ADMID', '').split(" "):
+            # parse amdSec (only one section per ID)
+            section = self.find_section(mets_root, 'amdSec', amdsec_id)
+            if section is None:
+                continue
+            for xpath, extractor in self.FILE_SECTIONS:
+                element = section.find(xpath)
+                if element is None:
+                    continue
+                if extractors is None or extractor in extractors:
+                    getattr(self, extractor)(element, file_data)
+                break
+
+    def extract_file_dmdsec(self, target, mets_root, file_data, extractors=None):
+        """Run parse_file_dc (if in extractors) on the dmdSec sections of the file in target"""
+        if extractors is not None and 'parse_file_dc' not in extractors:
+            return
+        for dmdsec_id in target.get('DMDID', '').split(" "):
+            # parse dmdSec (only one section per ID)
+            section = self.find_section(mets_root, 'dmdSec', dmdsec_id)
+            if section is None:
+                continue
+            # parse DC related to file
+            dc = section.find("./mdWrap[@MDTYPE='DC']/xmlData")
+            if dc is not None:
+                self.parse_file_dc(dc, file_data)
+
+    def extract_file_info(self, target, mets_root, extractors=None):
+        """extract information about the file in target (with the extractors, all if None)"""
         # create new dictionary for this item's info
         file_data = dict()
         # Add information from the file
@@ -515,56 +645,8 @@ class METSFile(object):
         file_data['premis_events'] = list()
 
         # gather amdsec id from filesec
-        amdsec_ids = target.get('ADMID', '')
-        file_data['amdsec_id'] = amdsec_ids
-        for amdsec_id in amdsec_ids.split(" "):
-            # parse amdSec
-            amdsec_xpath = ".//amdSec/*[@ID='{}']".format(amdsec_id)
-            # Only one section per ID
-            section = mets_root.find(amdsec_xpath)
-            if section is None:
-                continue
-            # is it a PREMIS:OBJECT section
-            premis_object = section.find("./mdWrap[@MDTYPE='PREMIS:OBJECT']/xmlData")
-            if premis_object is not None:
-                self.parse_file_premis_object(premis_object, file_data)
-                continue
-            # is it a sourceMD section
-            sourcemd = section.find("./mdWrap[@MDTYPE='DC']/xmlData")
-            if sourcemd is not None:
-                self.parse_file_dc(sourcemd, file_data)
-                continue
-            # parse premis events related to file
-            premis_event = section.find("./mdWrap[@MDTYPE='PREMIS:EVENT']/xmlData")
-            if premis_event is not None:
-                file_data['premis_events'].append(self.parse_premis_event(premis_event))
-                continue
-            # parse mix related to file
-            mix = section.find("./mdWrap[@MDTYPE='NISOIMG']/xmlData")
-            if mix is not None:
-                self.parse_file_mix(mix, file_data)
-                # file_data['mix_rawoutput'] = etree.tostring(mix, pretty_print=True)
-                continue
-            # parse textMD related to file
-            textmd = section.find("./mdWrap[@MDTYPE='TEXTMD']/xmlData")
-            if textmd is not None:
-                self.parse_file_textmd(textmd, file_data)
-                # file_data['textmd_rawoutput'] = etree.tostring(textmd, pretty_print=True)
-                continue
-            # parse mpeg7 related to file
-            mpeg7 = section.find("./mdWrap[@OTHERMDTYPE='MPEG7']/xmlData")
-            if mpeg7 is not None:
-                self.parse_file_mpeg7(mpeg7, file_data)
-                continue
-            # parse containerMD related to file
-            containermd = section.find("./mdWrap[@OTHERMDTYPE='containerMD']/xmlData")
-            if containermd is not None:
-                self.parse_file_containermd(containermd, file_data)
-                continue
-            # parse XMP related to file
-            xmp = section.find("./mdWrap[@OTHERMDTYPE='XMP']/xmlData")
-            if xmp is not None:
-                self.parse_file_xmp(xmp, file_data)
+        file_data['amdsec_id'] = target.get('ADMID', '')
+        self.extract_file_amdsec(target, mets_root, file_data, extractors)
 
         # Sort the premis events by datetime
         file_data['premis_events'].sort(key=lambda event: event["event_datetime"])
@@ -576,19 +658,8 @@ class METSFile(object):
             file_data['size'] = convert_size(file_data['bytes'])
 
         # gather dmdsec id from filesec
-        dmdsec_ids = target.get('DMDID', '')
-        file_data['dmdsec_id'] = dmdsec_ids
-        for dmdsec_id in dmdsec_ids.split(" "):
-            # parse dmdSec
-            dmdsec_xpath = ".//dmdSec[@ID='{}']".format(dmdsec_id)
-            # Only one section per ID
-            section = mets_root.find(dmdsec_xpath)
-            if section is None:
-                continue
-            # parse DC related to file
-            dc = section.find("./mdWrap[@MDTYPE='DC']/xmlData")
-            if dc is not None:
-                self.parse_file_dc(dc, file_data)
+        file_data['dmdsec_id'] = target.get('DMDID', '')
+        self.extract_file_dmdsec(target, mets_root, file_data, extractors)
 
         # Return the build dictionnary
         return file_data
@@ -605,10 +676,8 @@ class METSFile(object):
         amdsec_ids = div.get('ADMID', '')
         events = []
         for amdsec_id in amdsec_ids.split(" "):
-            # parse amdSec
-            amdsec_xpath = ".//amdSec/*[@ID='{}']".format(amdsec_id)
-            # Only one section per ID
-            section = mets_root.find(amdsec_xpath)
+            # parse amdSec (only one section per ID)
+            section = self.find_section(mets_root, 'amdSec', amdsec_id)
             if section is None:
                 continue
             # parse premis events related to group
@@ -622,9 +691,66 @@ class METSFile(object):
         for event in events:
             dcmetadata.append(event)
 
-    def parse_mets(self):
+    def read_root(self):
+        """Parse the METS file (gzipped or not), give its root without namespaces"""
+        # open xml file and strip namespaces
+        # TODO: use namespaces everywhere...
+        with self.timed('xml'):
+            if self.path.endswith('.gz'):
+                with gzip.open(self.path, 'rb') as f:
+                    tree = etree.parse(f)
+                    self.counters['bytes'] += f.tell()
+            else:
+                tree = etree.parse(self.path)
+                self.counters['bytes'] += os.path.getsize(self.path)
+            root = tree.getroot()
+
+        with self.timed('namespaces'):
+            for elem in root.getiterator():
+                if not hasattr(elem.tag, 'find'):
+                    continue
+                i = elem.tag.find('}')
+                if i >= 0:
+                    # strip the namespace...
+                    elem.tag = elem.tag[i+1:]
+            objectify.deannotate(root, cleanup_namespaces=True, xsi=False)
+        return root
+
+    def reextract(self, original_files, extractors):
         """
-        Parse METS file and save data to METS model
+        Run again some extractors (see REEXTRACTORS) on the files of the METS
+        file, updating the given files info, in the order of the fileSec
+        """
+        mets_root = self.read_root()
+        targets = mets_root.findall(".//fileGrp/file")
+        if len(targets) != len(original_files):
+            raise ValueError("Manifest does not match the METS")
+        for target, file_data in zip(targets, original_files):
+            self.extract_file_amdsec(target, mets_root, file_data, extractors)
+            self.extract_file_dmdsec(target, mets_root, file_data, extractors)
+        return original_files
+
+    def extract_details(self, original_files):
+        """
+        Extract what a summary leaves out: give the files info completed by
+        the DETAIL_EXTRACTORS, and the structMap divs
+        """
+        mets_root = self.read_root()
+        targets = mets_root.findall(".//fileGrp/file")
+        if len(targets) != len(original_files):
+            raise ValueError("Manifest does not match the METS")
+        for target, file_data in zip(targets, original_files):
+            file_data['premis_events'] = []
+            self.extract_file_amdsec(target, mets_root, file_data, self.DETAIL_EXTRACTORS)
+            file_data['premis_events'].sort(key=lambda event: event["event_datetime"])
+            self.extract_file_dmdsec(target, mets_root, file_data, self.DETAIL_EXTRACTORS)
+        divs = [self.extract_div_info(target, mets_root)
+                for target in mets_root.findall(".//structMap")]
+        return original_files, divs
+
+    def extract(self):
+        """
+        Parse METS file and give the METS model (not saved)
         """
         # create list
         original_files = []
@@ -635,40 +761,44 @@ class METSFile(object):
         # get METS file name
         mets_filename = os.path.basename(self.path)
 
-        # open xml file and strip namespaces
-        # TODO: use namespaces everywhere...
-        tree = etree.parse(self.path)
-        root = tree.getroot()
-
-        for elem in root.getiterator():
-            if not hasattr(elem.tag, 'find'):
-                continue
-            i = elem.tag.find('}')
-            if i >= 0:
-                # strip the namespace...
-                elem.tag = elem.tag[i+1:]
-        objectify.deannotate(root, cleanup_namespaces=True, xsi=False)
+        # keep the raw manifest, which is deleted after the ingest
+        with self.timed('store'):
+            manifest = store_manifest(self.path)
+        # the details can be extracted later only from a stored manifest
+        summary = self.summary and manifest is not None
+        extractors = self.SUMMARY_EXTRACTORS if summary else None
 
-        # build xml document root
-        mets_root = root
+        self.report('parsing')
+        mets_root = self.read_root()
+        root = mets_root
 
         # gather info for each file
-        for target in mets_root.findall(".//fileGrp/file"):
-            original_file_count += 1
-            # create new dictionary for this item's info
-            file_data = self.extract_file_info(target, mets_root)
-            # append file_data to original files
-            original_files.append(file_data)
-
-        # gather info for each structmap
-        for target in mets_root.findall(".//structMap"):
-            div = self.extract_div_info(target, mets_root)
-            divs.append(div)
+        targets = mets_root.findall(".//fileGrp/file")
+        self.report('parsing', 0, len(targets))
+        with self.timed('files'):
+            for target in targets:
+                original_file_count += 1
+                # create new dictionary for this item's info
+                file_data = self.extract_file_info(target, mets_root, extractors)
+                # append file_data to original files
+                original_files.append(file_data)
+                self.report('parsing', original_file_count, len(targets))
+
+        # gather info for each structmap (later for a summary)
+        if summary:
+            divs = None
+        else:
+            with self.timed('structmap'):
+                for target in mets_root.findall(".//structMap"):
+                    div = self.extract_div_info(target, mets_root)
+                    divs.append(div)
 
         # gather dublin core metadata from most recent dmdSec
-        dc_metadata = self.parse_dc(root)
+        with self.timed('dc'):
+            dc_metadata = self.parse_dc(root)
         # gather event at the group level
-        self.extract_group_event(root, dc_metadata)
+        with self.timed('group_events'):
+            self.extract_group_event(root, dc_metadata)
 
         # add file info to database
         if not self.ark:
@@ -679,15 +809,61 @@ class METSFile(object):
             self.nickname += " - " + self.ark
 
         # print("THL JSON ", json.dumps(dc_metadata, sort_keys=True, indent=2), file=sys.stderr)
-        mets_instance = METS(mets_filename, self.nickname, principal_level,
-                             original_files, dc_metadata, divs, original_file_count)
+        return METS(mets_filename, self.nickname, principal_level,
+                    original_files, dc_metadata, divs, original_file_count, manifest,
+                    detailed=not summary, timings=self.parse_stats())
+
+    def parse_mets(self):
+        """
+        Parse METS file and save data to METS model
+        """
+        mets_instance = self.extract()
+        self.report('storing', mets_instance.originalfilecount, mets_instance.originalfilecount)
         isSuccess = True
         try:
-            db.session.add(mets_instance)
-            db.session.flush()
+            with self.timed('insert'):
+                db.session.add(mets_instance)
+                db.session.flush()
         except IntegrityError:
             isSuccess = False
             db.session.rollback()
         else:
-            db.session.commit()
+            # Saved with the same commit as the METS
+            mets_instance.timings = self.parse_stats()
+            with self.timed('commit'):
+                db.session.commit()
+            record_ingest(mets_instance.originalfilecount, mets_instance.timings)
+        self.log_stats(mets_instance.metsfile, mets_instance.originalfilecount)
         return isSuccess
+
+
+def complete_mets(mets_instance):
+    """
+    Extract (once) the details of a METS ingested in summary mode from its
+    stored manifest; they stay unavailable (detailed is still False) if the
+    manifest is missing or cannot be read
+    """
+    # Rows older than the summary mode have no flag, and are complete
+    if mets_instance.detailed is not False:
+        return mets_instance
+    if not has_manifest(mets_instance.manifest):
+        app.logger.warning("Details of %s unavailable: manifest not stored",
+                           mets_instance.metsfile)
+        return mets_instance
+    mets = METSFile(manifest_path(mets_instance.manifest), mets_instance.metsfile, None)
+    # On a copy, so that the change of the pickled column is seen
+    try:
+        with mets.timed('details'):
+            original_files, divs = mets.extract_details(copy.deepcopy(mets_instance.metslist))
+    except (OSError, ValueError, etree.LxmlError) as e:
+        app.logger.warning("Details of %s unavailable: %s", mets_instance.metsfile, e)
+        return mets_instance
+    mets_instance.metslist = original_files
+    mets_instance.divs = divs
+    mets_instance.detailed = True
+    timings = copy.deepcopy(mets_instance.timings) or {'phases': {}, 'counters': {}}
+    timings['phases']['details'] = round(mets.timings['details'], 4)
+    mets_instance.timings = timings
+    db.session.commit()
+    app.logger.debug("Details of %s extracted", mets_instance.metsfile)
+    return mets_instance
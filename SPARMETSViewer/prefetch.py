@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Prefetching of the pages of a paged search."""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from SPARMETSViewer import app
+
+# Threads shared by all the prefetchers, which bounds the parallel requests
+EXECUTOR = ThreadPoolExecutor(max_workers=app.config['SRU_PREFETCH_WORKERS'])
+
+
+class PagePrefetcher(object):
+    """
+    Class fetching in advance the next pages of a search.
+
+    fetch(startrecord) gives the page beginning at startrecord. When a page
+    is asked, the depth following pages are requested in parallel so that
+    they are ready when the current one is consumed, up to last_record (the
+    last record wanted). Pages are always given back in the order they are
+    asked for.
+    """
+
+    def __init__(self, fetch, pagesize, last_record, depth):
+        self.fetch = fetch
+        self.pagesize = pagesize
+        self.last_record = last_record
+        self.depth = depth
+        self.futures = OrderedDict()
+        self.next_start = None
+
+    def __str__(self):
+        return "prefetch %d pages of %d [%d in flight]" % (
+            self.depth, self.pagesize, len(self.futures))
+
+    def schedule(self, startrecord):
+        """Request the page at startrecord and the depth following ones"""
+        if self.next_start is None or self.next_start < startrecord:
+            self.next_start = startrecord
+        limit = startrecord + (self.depth + 1) * self.pagesize
+        while self.next_start < limit and self.next_start <= self.last_record:
+            self.futures[self.next_start] = EXECUTOR.submit(self.fetch, self.next_start)
+            self.next_start += self.pagesize
+
+    def get(self, startrecord):
+        """Give the page beginning at startrecord"""
+        self.schedule(startrecord)
+        # Forget the pages which have been skipped
+        for start in [start for start in self.futures if start < startrecord]:
+            self.futures.pop(start).cancel()
+        future = self.futures.pop(startrecord, None)
+        if future is None:
+            return self.fetch(startrecord)
+        return future.result()
+
+    def close(self):
+        """Cancel the pages not yet requested"""
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Profiling of the requests asked by a header or a parameter, or sampled."""
+
+import cProfile
+import glob
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import parse_qs, parse_qsl, urlencode
+
+from werkzeug.exceptions import HTTPException
+
+from SPARMETSViewer import app
+
+# Header, and parameter of the query string, asking the profile of a request (given PROFILE_TOKEN)
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAMETER = 'profile'
+# Pages of the profiles and of the slow queries, never profiled
+UNPROFILED_PATHS = ('/profiles', '/slowqueries')
+
+
+def function_name(function):
+    """Readable name of a function of the pstats"""
+    filename, line, name = function
+    if filename == '~':
+        # Built-in function
+        return name
+    parts = filename.replace(os.sep, '/').split('/')
+    return '%s:%d(%s)' % ('/'.join(parts[-2:]), line, name)
+
+
+def token_given(environ):
+    """Tell whether a request gives PROFILE_TOKEN (header X-Profile or parameter profile)"""
+    token = app.config['PROFILE_TOKEN']
+    if not token:
+        return False
+    if environ.get(PROFILE_HEADER) == token:
+        return True
+    parameters = parse_qs(environ.get('QUERY_STRING', ''))
+    return token in parameters.get(PROFILE_PARAMETER, [])
+
+
+def public_query(query_string):
+    """Query string of a request without the profile parameter (and its token)"""
+    parameters = parse_qsl(query_string, keep_blank_values=True)
+    return urlencode([(name, value) for name, value in parameters if name != PROFILE_PARAMETER])
+
+
+def top_functions(stats, count, by_own=False):
+    """Give the functions taking the most time (cumulated, or own) in pstats"""
+    column = 2 if by_own else 3
+    functions = sorted(stats.items(), key=lambda item: item[1][column], reverse=True)
+    return [{
+        'function': function_name(function),
+        'calls': calls,
+        'own': round(own, 6),
+        'cumulative': round(cumulative, 6),
+    } for function, (primitive, calls, own, cumulative, callers) in functions[:count]]
+
+
+class RequestProfiler(object):
+    """
+    WSGI middleware profiling some requests with cProfile.
+
+    A request is profiled when it has the header X-Profile, or the parameter
+    profile, equal to PROFILE_TOKEN, or else with the probability
+    PROFILE_SAMPLE_RATE. Its profile is saved in PROFILE_DIR (.prof, read by
+    pstats or snakeviz) with a .json giving the route, the duration and the
+    top functions; only the PROFILE_KEEP latest are kept. The body of a
+    profiled response is profiled while the server reads it (so a streamed
+    response is not buffered), the profile being saved when the response is
+    closed. One request is profiled at a time. The functions are given by
+    cumulated time, and by own time (hotspots).
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.lock = threading.Lock()
+
+    def asked(self, environ):
+        """Tell whether a request must be profiled"""
+        if environ.get('PATH_INFO', '').startswith(UNPROFILED_PATHS):
+            return False
+        if token_given(environ):
+            return True
+        rate = app.config['PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def __call__(self, environ, start_response):
+        if not app.config['PROFILE_DIR'] or not self.asked(environ):
+            return self.wsgi_app(environ, start_response)
+        # Another profile running: not this one
+        if not self.lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+        # The lock is released when the profile is saved
+        return self.profile(environ, start_response)
+
+    def profile(self, environ, start_response):
+        """Answer a request while profiling it"""
+        answer = {}
+
+        def catch_start_response(status, headers, exc_info=None):
+            answer['status'] = status
+            return start_response(status, headers, exc_info)
+
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active (with sys.monitoring)
+            self.lock.release()
+            return self.wsgi_app(environ, start_response)
+        try:
+            app_iter = self.wsgi_app(environ, catch_start_response)
+        except BaseException:
+            self.finish(environ, answer, start, profile)
+            raise
+        profile.disable()
+        return ProfiledBody(self, environ, answer, start, profile, app_iter)
+
+    def finish(self, environ, answer, start, profile):
+        """Save the profile of a request answered, and let another request be profiled"""
+        profile.disable()
+        duration = time.perf_counter() - start
+        try:
+            self.save(environ, answer.get('status', ''), duration, profile)
+        except OSError as e:
+            app.logger.warning("Profile not saved: %s", e)
+        finally:
+            self.lock.release()
+
+    def save(self, environ, status, duration, profile):
+        """Save a profile and its description in PROFILE_DIR"""
+        folder = app.config['PROFILE_DIR']
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        now = datetime.now()
+        name = '%s-%s' % (now.strftime('%Y%m%d%H%M%S%f'), uuid.uuid4().hex[:8])
+        profile.dump_stats(os.path.join(folder, name + '.prof'))
+        description = {
+            'name': name,
+            'date': now.isoformat(timespec='seconds'),
+            'method': environ.get('REQUEST_METHOD', ''),
+            'path': environ.get('PATH_INFO', ''),
+            'query': public_query(environ.get('QUERY_STRING', '')),
+            'route': route_of(environ),
+            'status': status.split(' ', 1)[0],
+            'duration': round(duration, 6),
+            'pid': os.getpid(),
+        }
+        stats = pstats.Stats(profile).stats
+        description['functions'] = top_functions(stats, app.config['PROFILE_TOP'])
+        description['hotspots'] = top_functions(stats, app.config['PROFILE_TOP'], by_own=True)
+        with open(os.path.join(folder, name + '.json'), 'w') as f:
+            json.dump(description, f, indent=1)
+        app.logger.info("Profile %s: %s %s in %.3f s", name, description['method'],
+                        description['path'], duration)
+        prune_profiles(folder, app.config['PROFILE_KEEP'])
+
+
+class ProfiledBody(object):
+    """Body of a profiled response, profiled while the server reads it"""
+
+    def __init__(self, profiler, environ, answer, start, profile, app_iter):
+        self.profiler = profiler
+        self.environ = environ
+        self.answer = answer
+        self.start = start
+        self.profile = profile
+        self.app_iter = app_iter
+        self.closed = False
+
+    def __iter__(self):
+        chunks = iter(self.app_iter)
+        while True:
+            self.profile.enable()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.profile.disable()
+            yield chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.profile.enable()
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.profiler.finish(self.environ, self.answer, self.start, self.profile)
+
+
+def route_of(environ):
+    """Rule of the Flask route of a request"""
+    try:
+        rule, arguments = app.url_map.bind_to_environ(environ).match(return_rule=True)
+    except HTTPException:
+        return 'unmatched'
+    return rule.rule
+
+
+def prune_profiles(folder, keep):
+    """Delete the oldest profiles, keeping the keep latest"""
+    descriptions = sorted(glob.glob(os.path.join(folder, '*.json')))
+    for path in descriptions[:max(0, len(descriptions) - keep)]:
+        for extension in ('.json', '.prof'):
+            try:
+                os.remove(path[:-len('.json')] + extension)
+            except OSError:
+                pass
+
+
+def recent_profiles(limit=None):
+    """Give the descriptions of the latest profiles (latest first)"""
+    folder = app.config['PROFILE_DIR']
+    if not folder or not os.path.exists(folder):
+        return []
+    profiles = []
+    for path in sorted(glob.glob(os.path.join(folder, '*.json')), reverse=True)[:limit]:
+        try:
+            with open(path) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def get_profile(name):
+    """Give the description of a profile (None if unknown)"""
+    folder = app.config['PROFILE_DIR']
+    if not folder or os.path.basename(name) != name:
+        return None
+    try:
+        with open(os.path.join(folder, name + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+app.wsgi_app = RequestProfiler(app.wsgi_app)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Compact representation of a RDF graph for the network views."""
+
+import re
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+# Known namespaces and their prefixes (same as translateNs in myCommons.js)
+PREFIXES = [
+    ("info:bnf/spar/structure#", "sparstructure:"),
+    ("info:bnf/spar/context#", "sparcontext:"),
+    ("info:bnf/spar/provenance#", "sparprovenance:"),
+    ("info:bnf/spar/representation#", "sparrepresentation:"),
+    ("info:bnf/spar/reference#", "sparreference:"),
+    ("info:bnf/spar/fixity#", "sparfixity:"),
+    ("info:bnf/spar/textmd#", "textmd:"),
+    ("http://www.openarchives.org/ore/terms/", "oai-ore:"),
+    ("http://purl.org/dc/elements/1.1/", "dc:"),
+    ("http://www.w3.org/2000/01/rdf-schema#", "rdfs:"),
+    ("http://www.w3.org/2002/07/owl#", "owl:"),
+    ("http://xmlns.com/foaf/0.1/", "foaf:"),
+    ("info:bnf/spar/provenance/", "event:"),
+]
+
+# Numbered part of an ark (f1, f2, ...) which is repeated for each object
+NUMBERED_REGEX = re.compile(r'/([a-z]+)\d+([\./])')
+
+
+def translate_ns(uri):
+    """Simplify an URI with the known prefixes"""
+    if uri == RDF_TYPE:
+        return "a"
+    for namespace, prefix in PREFIXES:
+        if uri.startswith(namespace):
+            return prefix + uri[len(namespace):]
+    if uri.startswith("ark:/"):
+        return uri.replace(".version", ".V").replace(".release", ".R")
+    return uri
+
+
+def collapse_uri(uri):
+    """Give the same uri to all the members of a numbered enumeration"""
+    if not uri.startswith("ark:/"):
+        return uri
+    return NUMBERED_REGEX.sub(r'/\1XXX\2', uri, count=1)
+
+
+def build_compact_graph(bindings, collapse=False, max_nodes=0, max_literals=10, labels=None):
+    """
+    Build a compact graph from the ?s ?p ?o bindings of a SPARQL response.
+
+    Nodes are deduplicated and referenced by their index; edges are given as
+    [from, to, predicate, count] and literals as [node, predicate, value],
+    predicates being indexes in the predicates table. With collapse, all
+    the members of a numbered enumeration (files, objects...) become one
+    aggregate node whose count is the number of members. labels is an
+    optional function giving the labels of a list of uris in one call; it is
+    used for the nodes which are only objects (formats, agents, channels...).
+    """
+    nodes = []
+    node_index = {}
+    members = {}
+    predicates = []
+    predicate_index = {}
+    edges = {}
+    literals = {}
+    subjects = set()
+    truncated = False
+
+    def get_node(uri):
+        key = collapse_uri(uri) if collapse else uri
+        index = node_index.get(key)
+        if index is None:
+            if max_nodes and len(nodes) >= max_nodes:
+                return None
+            index = len(nodes)
+            node_index[key] = index
+            nodes.append({'uri': key, 'label': translate_ns(key), 'count': 1})
+        if collapse and key != uri:
+            members.setdefault(index, set()).add(uri)
+        return index
+
+    def get_predicate(uri):
+        index = predicate_index.get(uri)
+        if index is None:
+            index = len(predicates)
+            predicate_index[uri] = index
+            predicates.append(translate_ns(uri))
+        return index
+
+    for binding in bindings:
+        s = get_node(binding['s']['value'])
+        if s is None:
+            truncated = True
+            continue
+        subjects.add(s)
+        p = binding['p']['value']
+        o = binding['o']
+        if p == RDF_TYPE:
+            if 'type' not in nodes[s]:
+                nodes[s]['type'] = translate_ns(o['value'])
+            continue
+        if o.get('type') in ('uri', 'bnode'):
+            target = get_node(o['value'])
+            if target is None:
+                truncated = True
+                continue
+            edge = (s, target, get_predicate(p))
+            edges[edge] = edges.get(edge, 0) + 1
+        else:
+            values = literals.setdefault(s, [])
+            literal = (get_predicate(p), o.get('value'))
+            if literal in values:
+                continue
+            if len(values) >= max_literals:
+                nodes[s]['more'] = nodes[s].get('more', 0) + 1
+                continue
+            values.append(literal)
+
+    for index, uris in members.items():
+        nodes[index]['count'] = len(uris)
+
+    if labels is not None:
+        targets = [node['uri'] for index, node in enumerate(nodes) if index not in subjects]
+        if targets:
+            names = labels(targets)
+            for node in nodes:
+                if node['uri'] in names:
+                    node['name'] = names[node['uri']]
+
+    return {
+        'nodes': nodes,
+        'predicates': predicates,
+        'edges': [[s, o, p, count] for (s, o, p), count in edges.items()],
+        'literals': [[node, p, value]
+                     for node, values in literals.items() for p, value in values],
+        'truncated': truncated,
+    }
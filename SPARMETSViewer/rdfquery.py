@@ -1,15 +1,37 @@
 # -*- coding: utf-8 -*-
 """Queries to rdf endpoint."""
 
+import json
+import re
 import sys
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
 from functools import lru_cache
 # from flask import jsonify
 from flask_babel import gettext
-from requests import get, codes
+from requests import codes
 
 from SPARMETSViewer import app
 
+try:
+    import ijson
+except ImportError:  # incremental parsing is optional
+    ijson = None
+
 from .identifiers import abstract_ark, is_uuid
+from .metrics import REGISTRY, cache_counters
+from .outbound import http_get
+from .singleflight import get_flight
+
+SPARQL_FLIGHT = get_flight('sparql')
+SPARQL_HEADERS = {'Accept': 'application/sparql-results+json'}
+
+
+# Variables used as keys (in that order) by the keyset pagination
+KEYSET_ORDERS = {
+    'ark': ['ark'],
+    'ingest_date': ['ingest_date', 'ark'],
+}
 
 
 def __fake_literal_result(value):
@@ -29,43 +51,70 @@ def __fake_empty_result():
     }
 
 
+def sparql_params(query):
+    """Give the parameters of the GET sending a SPARQL query"""
+    return {'query': query, 'format': 'application/sparql-results+json'}
+
+
+def sparql_get(endpoint, query):
+    """Send a SPARQL query to the endpoint and return the raw response.
+
+    Identical queries sent at the same time share the same upstream call.
+    """
+    return SPARQL_FLIGHT.do(
+        (endpoint, query), http_get,
+        'sparql', endpoint, headers=SPARQL_HEADERS, params=sparql_params(query))
+
+
+def sparql_stream(endpoint, query):
+    """Send a SPARQL query to the endpoint and return the response unread.
+
+    The body is left on the socket so that it can be streamed; such calls
+    are not coalesced.
+    """
+    return http_get(
+        'sparql', endpoint, headers=SPARQL_HEADERS, params=sparql_params(query), stream=True)
+
+
 def simple_query(query):
     """Make a SPARQL query to the appropriate platform"""
     # Make a SPARQL query to retrieve the label
     endpoint = app.config['ACCESS_ENDPOINT']
     # app.logger.debug("SPARQL query %s", query)
-    response = get(
-        endpoint,
-        headers={'Accept': 'application/sparql-results+json'},
-        params={'query': query, 'format': 'application/sparql-results+json'})
+    response = sparql_get(endpoint, query)
     if response.status_code != codes.ok:
         app.logger.debug("Bad response for query %s", query)
         raise ValueError(response.status_code)
     return response.json()
 
 
-@lru_cache(maxsize=128)
-def label_query(label, platform):
-    """Make a SPARQL query to retrieve a label"""
-    if platform == "TEST":
-        if label == "sparprovenance:digitization":
-            return __fake_literal_result("Num\u00E9risation")
-        elif label == "sparprovenance:packageCreation":
-            return __fake_literal_result("Cr\u00E9ation de paquet")
-        elif label == "sparprovenance:digitizationRequests":
-            return __fake_literal_result("Demande de num\u00E9risation")
-        elif label == "sparprovenance:hasPerformer":
-            return __fake_literal_result("ex\u00E9cutant")
-        elif label == "ark:/12148/br2d2wf":
-            return __fake_literal_result("Format TIFF NB G4")
-        elif abstract_ark(label) == "ark:/12148/br2d27h":
-            return __fake_literal_result("Processus ING_1")
-        elif is_uuid(label):
-            return __fake_literal_result("DSC - atelier RES")
-        else:
-            return __fake_empty_result()
+def test_label_result(label):
+    """Give the label of some known values on the TEST platform"""
+    if label == "sparprovenance:digitization":
+        return __fake_literal_result("Num\u00E9risation")
+    elif label == "sparprovenance:packageCreation":
+        return __fake_literal_result("Cr\u00E9ation de paquet")
+    elif label == "sparprovenance:digitizationRequests":
+        return __fake_literal_result("Demande de num\u00E9risation")
+    elif label == "sparprovenance:hasPerformer":
+        return __fake_literal_result("ex\u00E9cutant")
+    elif label == "ark:/12148/br2d2wf":
+        return __fake_literal_result("Format TIFF NB G4")
+    elif abstract_ark(label) == "ark:/12148/br2d27h":
+        return __fake_literal_result("Processus ING_1")
+    elif is_uuid(label):
+        return __fake_literal_result("DSC - atelier RES")
+    else:
+        return __fake_empty_result()
 
-    # Make a SPARQL query to retrieve the label
+
+def empty_label_result():
+    """Give an empty SPARQL result"""
+    return __fake_empty_result()
+
+
+def label_sparql(label):
+    """Build the SPARQL query retrieving a label (None if it cannot have one)"""
     label = label.strip()
     ark = abstract_ark(label)
     if ark is not None:
@@ -81,9 +130,9 @@ def label_query(label, platform):
         same = ""
         value = "VALUES ?id { <info:bnf/spar/agent/%s> } " % label
     else:
-        return __fake_empty_result()
+        return None
 
-    query = """
+    return """
         SELECT ?label WHERE {
           %s
           { ?id rdfs:label ?label }
@@ -93,32 +142,205 @@ def label_query(label, platform):
           %s
           FILTER (lang(?label) = '%s' or lang(?label) = '')
         } LIMIT 1""" % (same, value, gettext("en"))
+
+
+@lru_cache(maxsize=128)
+def label_query(label, platform):
+    """Make a SPARQL query to retrieve a label"""
+    if platform == "TEST":
+        return test_label_result(label)
+
+    # Make a SPARQL query to retrieve the label
+    query = label_sparql(label)
+    if query is None:
+        return __fake_empty_result()
     app.logger.debug("SPARQL query %s", query)
     return simple_query(query)
 
 
-def from_sparql_results_to_json(json, withCounts=False, count=100):
-    values = []
-    result = {}
-    # print("THL from_sparql_results_to_json", json.get("results").get("bindings"), file=sys.stderr)
+def label_cache_counters():
+    info = label_query.cache_info()
+    return cache_counters('label', info.hits, info.misses)
+
+
+REGISTRY.add_collector(label_cache_counters)
+
+
+def __simplify_binding(binding):
+    """Keep only the values of a SPARQL binding"""
+    return {key: entry.get("value") for key, entry in binding.items()}
+
+
+def iter_sparql_results(json):
+    """Give one at a time the simplified rows of a parsed SPARQL result"""
     if json.get("results") is None or json.get("results").get("bindings") is None:
-        if withCounts:
-            result['total'] = 0
-            result['rows'] = values
-            return result
-        else:
-            return values
-    # print("THL from_sparql_results_to_json", file=sys.stderr)
+        return
     for binding in json.get("results").get("bindings"):
-        dict = {}
-        for key, entry in binding.items():
-            # print("THL mapping ", key, entry.get("value"), file=sys.stderr)
-            dict[key] = entry.get("value")
-        values.append(dict)
+        yield __simplify_binding(binding)
+
+
+def iter_sparql_bindings(response):
+    """Give one at a time the bindings of a streamed SPARQL response.
+
+    With ijson the bindings are parsed incrementally from the socket, so the
+    memory used does not depend on the size of the result; otherwise the
+    whole body is parsed first.
+    """
+    if ijson is None:
+        json = response.json()
+        if json.get("results") is None or json.get("results").get("bindings") is None:
+            return
+        for binding in json.get("results").get("bindings"):
+            yield binding
+        return
+    response.raw.decode_content = True
+    for binding in ijson.items(response.raw, 'results.bindings.item'):
+        yield binding
+
+
+def iter_sparql_response(response):
+    """Give one at a time the simplified rows of a streamed SPARQL response"""
+    for binding in iter_sparql_bindings(response):
+        yield __simplify_binding(binding)
+
+
+class AsyncBodyReader(object):
+    """File-like reading (for ijson) of the body of a streamed asynchronous response"""
+
+    def __init__(self, response, chunk_size=None):
+        self.chunks = response.aiter_bytes(chunk_size)
+
+    async def read(self, size=-1):
+        # ijson reads 0 bytes first to know the type of the data
+        if size == 0:
+            return b''
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            return b''
+
+
+async def aiter_sparql_response(response):
+    """Give one at a time the simplified rows of a streamed asynchronous (httpx) response"""
+    if ijson is None:
+        await response.aread()
+        for row in iter_sparql_results(response.json()):
+            yield row
+        return
+    reader = AsyncBodyReader(response, app.config['STREAM_CHUNK_SIZE'])
+    async for binding in ijson.items(reader, 'results.bindings.item'):
+        yield __simplify_binding(binding)
+
+
+def label_bulk_query(values, platform):
+    """Retrieve the labels of several values with as few SPARQL queries as possible"""
+    labels = {}
+    if platform == "TEST":
+        for value in values:
+            bindings = label_query(value, platform)["results"]["bindings"]
+            if bindings:
+                labels[value] = bindings[0]["label"]["value"]
+        return labels
+
+    # Only arks and agents have labels, several values can share the same id
+    ids = {}
+    for value in values:
+        ark = abstract_ark(value)
+        if ark is not None:
+            ids.setdefault(ark, []).append(value)
+        elif value.startswith("info:bnf/spar/agent/"):
+            ids.setdefault(value, []).append(value)
+        elif is_uuid(value):
+            ids.setdefault("info:bnf/spar/agent/%s" % value, []).append(value)
+    id_list = sorted(ids)
+    batch_size = app.config['LABELS_BATCH_SIZE']
+    for i in range(0, len(id_list), batch_size):
+        query = """
+            SELECT ?id (SAMPLE(?l) AS ?label) WHERE {
+              VALUES ?id { %s }
+              { ?id rdfs:label ?l }
+              UNION { ?id foaf:name ?l }
+              UNION { ?id doap:name ?l }
+              UNION { ?id dc:title ?l }
+              FILTER (lang(?l) = '%s' or lang(?l) = '')
+            } GROUP BY ?id""" % (
+                " ".join("<%s>" % id for id in id_list[i:i + batch_size]), gettext("en"))
+        for row in iter_sparql_results(simple_query(query)):
+            for value in ids.get(row.get("id"), []):
+                labels[value] = row.get("label")
+    return labels
+
+
+def from_sparql_results_to_json(json, withCounts=False, count=100):
+    values = list(iter_sparql_results(json))
     # Format the result depending on whether we need total or not
     if withCounts:
+        result = {}
+        if json.get("results") is None or json.get("results").get("bindings") is None:
+            count = 0
         result['total'] = count
         result['rows'] = values
         return result
     else:
         return values
+
+
+def __sparql_literal(value, datatype=None):
+    """Build a SPARQL literal from a value"""
+    literal = '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    if datatype:
+        literal += '^^<%s>' % datatype
+    return literal
+
+
+def keyset_order(order):
+    """Build the ORDER BY clause of the keyset pagination"""
+    return "ORDER BY " + " ".join("?" + var for var in KEYSET_ORDERS[order])
+
+
+def keyset_filter(order, keys):
+    """Build the FILTER keeping only the rows after the keys of a cursor"""
+    ark = "STR(?ark) > %s" % __sparql_literal(keys[-1][0])
+    if order == 'ark':
+        return "FILTER (%s)" % ark
+    date = __sparql_literal(keys[0][0], keys[0][1])
+    return "FILTER (?ingest_date > %s || (?ingest_date = %s && %s))" % (date, date, ark)
+
+
+def keyset_keys(order, binding):
+    """Give the keys of a SPARQL binding for the keyset pagination"""
+    keys = []
+    for var in KEYSET_ORDERS[order]:
+        entry = binding.get(var, {})
+        keys.append([entry.get("value", ""), entry.get("datatype")])
+    return keys
+
+
+def iter_keyset_rows(response, order):
+    """Give the simplified rows of a streamed SPARQL response with their keys"""
+    for binding in iter_sparql_bindings(response):
+        yield __simplify_binding(binding), keyset_keys(order, binding)
+
+
+def encode_cursor(order, binding):
+    """Give an opaque cursor pointing after the given SPARQL binding"""
+    keys = keyset_keys(order, binding)
+    payload = json.dumps({'order': order, 'keys': keys}, separators=(',', ':'))
+    return urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, order):
+    """Retrieve the keys of a cursor given by encode_cursor"""
+    try:
+        payload = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        keys = payload['keys']
+    except (BinasciiError, UnicodeError, ValueError, KeyError, TypeError):
+        raise ValueError(cursor)
+    if payload.get('order') != order or len(keys) != len(KEYSET_ORDERS[order]):
+        raise ValueError(cursor)
+    for key in keys:
+        if not isinstance(key, list) or len(key) != 2 or not isinstance(key[0], str):
+            raise ValueError(cursor)
+        if key[1] is not None and (not isinstance(key[1], str) or re.search(r'[<>"\s]', key[1])):
+            raise ValueError(cursor)
+    return keys
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Storing of reference data."""
 
+from .metrics import count_cache
 from .rdfquery import simple_query, from_sparql_results_to_json
 
 
@@ -127,6 +128,7 @@ class ReferenceData(Singleton):
     def get_data(self, kind):
         if kind not in ReferenceData.KINDS:
             raise ValueError(kind)
+        count_cache('reference', kind in self.values)
         if kind in self.values:
             return self.values[kind]
         self.values[kind] = self.__load(kind)
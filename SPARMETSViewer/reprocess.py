@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Run again some extractors on the stored manifests, patching the METS."""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from SPARMETSViewer import app, db
+
+from .ingestqueue import PROCESS_CONTEXT
+from .manifeststore import manifest_path, has_manifest
+from .models import METS
+from .parsemets import METSFile
+
+
+def reextract_manifest(digest, metsfile, original_files, extractors):
+    """Run the extractors on a stored manifest (in a worker process), give the files info"""
+    with app.app_context():
+        return METSFile(manifest_path(digest), metsfile, None).reextract(original_files,
+                                                                         extractors)
+
+
+def reprocess(extractors, metsfiles=None, workers=None, batch_size=None, report=None):
+    """
+    Run the extractors on the stored manifests of the METS (all of them or
+    the given metsfiles) with workers processes, and give the number of METS
+    done, failed and skipped (no stored manifest). report is called with each
+    METS and its error (None if done).
+    """
+    unknown = [extractor for extractor in extractors if extractor not in METSFile.REEXTRACTORS]
+    if unknown:
+        raise ValueError("Unknown extractors: " + ", ".join(unknown))
+    workers = workers or app.config['REPROCESS_WORKERS']
+    batch_size = batch_size or app.config['BULK_INSERT_BATCH']
+    query = db.session.query(METS.id, METS.manifest)
+    if metsfiles:
+        query = query.filter(METS.metsfile.in_(metsfiles))
+    counts = {'done': 0, 'failed': 0, 'skipped': 0}
+    ids = []
+    for mets_id, digest in query.order_by(METS.id):
+        if has_manifest(digest):
+            ids.append(mets_id)
+        else:
+            counts['skipped'] += 1
+    app.logger.debug("Reprocessing %d METS with %s", len(ids), ", ".join(extractors))
+
+    pending = {}
+    patched = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=PROCESS_CONTEXT) as pool:
+        while ids or pending:
+            # Only a few METS in memory at once
+            while ids and len(pending) < workers * 2:
+                mets_instance = METS.query.get(ids.pop(0))
+                future = pool.submit(reextract_manifest, mets_instance.manifest,
+                                     mets_instance.metsfile, mets_instance.metslist, extractors)
+                pending[future] = mets_instance
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                mets_instance = pending.pop(future)
+                try:
+                    # A new list, so that the pickled column is saved
+                    mets_instance.metslist = list(future.result())
+                except Exception as e:
+                    app.logger.warning("Reprocessing of %s failed: %s", mets_instance.metsfile, e)
+                    counts['failed'] += 1
+                    error = e
+                else:
+                    counts['done'] += 1
+                    patched += 1
+                    error = None
+                if report is not None:
+                    report(mets_instance, error)
+            if patched >= batch_size:
+                db.session.commit()
+                patched = 0
+    db.session.commit()
+    return counts
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Coalescing of identical outbound queries running at the same time."""
+
+import threading
+
+
+class _Call(object):
+    """A call in flight, shared by the threads asking for the same key"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Class sharing one upstream call between concurrent identical requests.
+
+    The first thread asking for a key runs the function, the threads asking
+    for the same key while it runs wait for it and get the same result
+    (or the same exception).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.requests = 0
+        self.upstream = 0
+        self.coalesced = 0
+
+    def __str__(self):
+        return "%s [%d in flight]" % (self.name, len(self.calls))
+
+    def do(self, key, function, *args, **kwargs):
+        """Run function(*args, **kwargs) once for all the callers of key"""
+        with self.lock:
+            self.requests += 1
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.upstream += 1
+                call = _Call()
+                self.calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """Give the counters of the requests seen"""
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'upstream': self.upstream,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.calls),
+            }
+
+
+# Known groups of coalesced calls, by name
+FLIGHTS = {}
+FLIGHTS_LOCK = threading.Lock()
+
+
+def get_flight(name):
+    """Retrieve (or create) the group of coalesced calls with this name"""
+    with FLIGHTS_LOCK:
+        if name not in FLIGHTS:
+            FLIGHTS[name] = SingleFlight(name)
+        return FLIGHTS[name]
+
+
+def flights_stats():
+    """Give the counters of all the groups of coalesced calls"""
+    with FLIGHTS_LOCK:
+        flights = list(FLIGHTS.values())
+    return {flight.name: flight.stats() for flight in flights}
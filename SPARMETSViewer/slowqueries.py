@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Log of the slow queries sent to the SPARQL and SRU endpoints."""
+
+import hashlib
+import math
+import re
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from SPARMETSViewer import app, db
+
+from .models import SlowQuery
+
+# Upstreams whose queries are logged
+QUERY_UPSTREAMS = ('sparql', 'sru')
+# Longest query text kept
+QUERY_MAX_LENGTH = 20000
+# Values replaced by ? in the normalized queries
+STRING_REGEX = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+ARK_REGEX = re.compile(r'ark:/\d+/[0-9a-z]+', re.IGNORECASE)
+UUID_REGEX = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+                        re.IGNORECASE)
+NUMBER_REGEX = re.compile(r'(?<![\w:/.-])\d+(?:\.\d+)?(?!\w)')
+# Lists of values (such as in VALUES) becoming a single ?
+VALUES_REGEX = re.compile(r'(\?|<[^<>\s]*\?[^<>\s]*>)(?:(?:\s*,\s*|\s+)\1)+')
+SPACES_REGEX = re.compile(r'\s+')
+# Orders of the ranking of the queries
+RANK_ORDERS = ('total', 'p95', 'max', 'count')
+
+
+def normalize_query(text):
+    """Give a query with its values replaced by ?, so that similar queries are grouped"""
+    text = STRING_REGEX.sub('?', text)
+    text = ARK_REGEX.sub('ark:/?', text)
+    text = UUID_REGEX.sub('?', text)
+    text = NUMBER_REGEX.sub('?', text)
+    text = SPACES_REGEX.sub(' ', text).strip()
+    return VALUES_REGEX.sub(r'\1', text)
+
+
+def response_size(response, stream=False):
+    """Size of the body of a response (None if streamed without Content-Length)"""
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit():
+        return int(length)
+    if not stream:
+        return len(response.content)
+    return None
+
+
+def is_slow_query(upstream, seconds):
+    """Tell whether a query sent to an upstream is to be logged"""
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+    return upstream in QUERY_UPSTREAMS and threshold is not None and seconds >= threshold
+
+
+def log_slow_query(upstream, url, params, seconds, status, response=None, stream=False):
+    """
+    Log a query sent to an upstream if it took more than SLOW_QUERY_THRESHOLD
+    seconds (from any thread: in an application context of its own)
+    """
+    if not is_slow_query(upstream, seconds):
+        return
+    text = (params or {}).get('query') or urlsplit(url).query
+    normalized = normalize_query(text)
+    now = datetime.now()
+    row = {
+        'created': now,
+        'upstream': upstream,
+        'host': urlsplit(url).hostname or '',
+        'fingerprint': hashlib.sha1(normalized.encode('utf-8')).hexdigest(),
+        'normalized': normalized[:QUERY_MAX_LENGTH],
+        'text': text[:QUERY_MAX_LENGTH],
+        'duration': seconds,
+        'size': response_size(response, stream) if response is not None else None,
+        'status': str(status),
+    }
+    table = SlowQuery.__table__
+    try:
+        # Apart from the session of the request, which is not to be committed here
+        with app.app_context(), db.engine.begin() as connection:
+            connection.execute(table.insert(), [row])
+            days = app.config['SLOW_QUERY_DAYS']
+            if days:
+                connection.execute(
+                    table.delete().where(table.c.created < now - timedelta(days=days)))
+    except SQLAlchemyError as e:
+        app.logger.warning("Slow query not logged: %s", e)
+        return
+    app.logger.debug("Slow %s query (%.3f s, %s): %s", upstream, seconds, status, normalized)
+
+
+def percentile(durations, rank):
+    """Give the percentile (nearest rank) of sorted durations"""
+    return durations[max(0, int(math.ceil(rank / 100.0 * len(durations))) - 1)]
+
+
+def rank_queries(order='total', upstream=None, days=None, limit=100):
+    """
+    Give the slow queries grouped by normalized query, ranked by order
+    (total time, p95 or max of the durations, or count)
+    """
+    if order not in RANK_ORDERS:
+        raise ValueError(order)
+    query = db.session.query(
+        SlowQuery.fingerprint, SlowQuery.upstream, SlowQuery.host, SlowQuery.duration,
+        SlowQuery.size, SlowQuery.status, SlowQuery.created)
+    if upstream:
+        query = query.filter(SlowQuery.upstream == upstream)
+    if days:
+        query = query.filter(SlowQuery.created >= datetime.now() - timedelta(days=days))
+    groups = {}
+    for fingerprint, kind, host, duration, size, status, created in query:
+        group = groups.get(fingerprint)
+        if group is None:
+            group = groups[fingerprint] = {
+                'fingerprint': fingerprint, 'upstream': kind, 'hosts': set(),
+                'durations': [], 'sizes': [], 'errors': 0, 'last': created,
+            }
+        group['hosts'].add(host)
+        group['durations'].append(duration)
+        if size is not None:
+            group['sizes'].append(size)
+        if not status.isdigit() or int(status) >= 400:
+            group['errors'] += 1
+        group['last'] = max(group['last'], created)
+    ranking = []
+    for group in groups.values():
+        durations = sorted(group.pop('durations'))
+        sizes = group.pop('sizes')
+        group.update({
+            'hosts': sorted(group['hosts']),
+            'count': len(durations),
+            'total': sum(durations),
+            'mean': sum(durations) / len(durations),
+            'p95': percentile(durations, 95),
+            'max': durations[-1],
+            'size': sum(sizes) // len(sizes) if sizes else None,
+        })
+        ranking.append(group)
+    ranking.sort(key=lambda group: group[order], reverse=True)
+    ranking = ranking[:limit]
+    # The texts of the ranked queries only
+    texts = dict(db.session.query(SlowQuery.fingerprint, SlowQuery.normalized).filter(
+        SlowQuery.fingerprint.in_([group['fingerprint'] for group in ranking])).distinct())
+    for group in ranking:
+        group['normalized'] = texts.get(group['fingerprint'], '')
+    return ranking
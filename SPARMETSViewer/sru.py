@@ -1,14 +1,11 @@
 # -*- coding: utf-8 -*-
 """How to query with SRU."""
 
-import sys
-
-from lxml import etree
-from requests import get, codes
+from collections import namedtuple
 # from urllib.parse import quote
 
 # from .identifiers import convert_size, extract_date, add_naan
-
+from .sruparse import SRUBase, SRUResponseBase
 
 # Dictionnary of XML prefixes and their namespaces
 NAMESPACES = {
@@ -27,142 +24,127 @@ NAMESPACES = {
 }
 
 
-class SRUResponse():
+# Fields extracted from a dublincore record
+DCRecord = namedtuple('DCRecord', [
+    'identifiers', 'relations', 'description_sets', 'types', 'languages', 'dates',
+    'extents', 'creators', 'contributors', 'subjects', 'titles', 'publishers',
+    'annotations'])
+
+# Simple fields, by the local name of their element
+DC_SIMPLE_FIELDS = {
+    'language': 'languages', 'date': 'dates', 'extent': 'extents',
+    'creator': 'creators', 'contributor': 'contributors', 'subject': 'subjects',
+    'title': 'titles', 'publisher': 'publishers', 'annotation': 'annotations',
+}
+
+
+def extract_dc_record(record_data):
+    """Extract all the fields of a dublincore record in a single pass"""
+    baseurls = ('http://catalogue.bnf.fr/', 'https://catalogue.bnf.fr/', 'https://gallica.bnf.fr/')
+    basestrings = ('Notice du catalogue : http://catalogue.bnf.fr/',
+                   'Notice du catalogue : http://archivesetmanuscrits.bnf.fr/')
+    basestring = "Appartient à l'ensemble documentaire : "
+    fields = dict((name, []) for name in DCRecord._fields)
+    for r in record_data.iter():
+        # Skip XML comments and processing instructions
+        if not isinstance(r.tag, str) or r.text is None:
+            continue
+        tag = r.tag[r.tag.rfind('}') + 1:]
+        text = r.text
+        if tag in DC_SIMPLE_FIELDS:
+            fields[DC_SIMPLE_FIELDS[tag]].append(text)
+        elif tag == 'identifier':
+            if text.find(':') > -1:
+                for baseurl in baseurls:
+                    text = text.replace(baseurl, '')
+                fields['identifiers'].append(text.strip())
+        elif tag == 'relation':
+            if text.startswith("Notice du catalogue"):
+                for base in basestrings:
+                    text = text.replace(base, '')
+                fields['relations'].append(text.strip())
+        elif tag == 'description':
+            if text.startswith("Appartient à l'ensemble"):
+                fields['description_sets'].append(text.replace(basestring, ''))
+        elif tag == 'type':
+            # dc_type = elem.get('{http://www.w3.org/2001/XMLSchema-instance}type')
+            if 'fre' == r.get('{http://www.w3.org/XML/1998/namespace}lang'):
+                fields['types'].append(text)
+    return DCRecord(**fields)
+
+
+class SRUResponse(SRUResponseBase):
     """
-    Class handling a SRU response
+    Class handling a SRU response (the properties apply to a srw:record)
     """
 
-    def __init__(self, record_data, sru):
-        self.record_data = record_data
-        self.sru = sru
-
-    @property
-    def records(self):
-        if self.sru.num_records == 0:
-            record_data = "<xml></xml>"
-        else:
-            record_data = self.record_data.xpath("srw:records/srw:record",
-                                                 namespaces=NAMESPACES)[0]
-        return(SRURecord(record_data, self.sru))
+    def extract(self, record_data):
+        return extract_dc_record(record_data)
 
     @property
     def identifiers(self):
-        baseurl1 = 'http://catalogue.bnf.fr/'
-        baseurl2 = 'https://catalogue.bnf.fr/'
-        baseurl3 = 'https://gallica.bnf.fr/'
-        result = [r.text.replace(baseurl1, '').replace(baseurl2, '').replace(baseurl3, '').strip()
-                  for r in self.record_data.iter() if
-                  r.tag.endswith('identifier') and r.text.find(':') > -1]
-        return result
+        return self.fields.identifiers
 
     @property
     def relations(self):
-        basestring1 = 'Notice du catalogue : http://catalogue.bnf.fr/'
-        basestring2 = 'Notice du catalogue : http://archivesetmanuscrits.bnf.fr/'
-        result = [r.text.replace(basestring1, '').replace(basestring2, '').strip() for r in self.record_data.iter() if
-                  r.tag.endswith('relation') and r.text.startswith("Notice du catalogue")]
-        return result
+        return self.fields.relations
 
     @property
     def description_sets(self):
-        basestring = "Appartient à l'ensemble documentaire : "
-        result = [r.text.replace(basestring, '') for r in self.record_data.iter() if
-                  r.tag.endswith('description') and r.text.startswith("Appartient à l'ensemble")]
-        return result
+        return self.fields.description_sets
 
     @property
     def types(self):
-        # dc_type = elem.get('{http://www.w3.org/2001/XMLSchema-instance}type')
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('type')
-                and 'fre' == r.get('{http://www.w3.org/XML/1998/namespace}lang')]
+        return self.fields.types
 
     @property
     def languages(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('language')]
+        return self.fields.languages
 
     @property
     def dates(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('date')]
+        return self.fields.dates
 
     @property
     def extents(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('extent')]
+        return self.fields.extents
 
     @property
     def creators(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('creator')]
+        return self.fields.creators
 
     @property
     def contributors(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('contributor')]
+        return self.fields.contributors
 
     # TODO: distinguish by xsi:type and xml:lang
     @property
     def subjects(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('subject')]
+        return self.fields.subjects
 
     @property
     def titles(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('title')]
+        return self.fields.titles
 
     @property
     def publishers(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('publisher')]
+        return self.fields.publishers
 
     # Following properties occur in GGC
 
     @property
     def annotations(self):
-        return [r.text for r in self.record_data.iter() if
-                r.tag.endswith('annotation')]
-
-
-class SRURecord():
-    """ Class for keeping a SRU record"""
-
-    def __init__(self, record_data, sru):
-        self.record_data = record_data
-        self.sru = sru
-
-    def __iter__(self):
-        return self
+        return self.fields.annotations
 
-    def __next__(self):
-        if self.sru.num_records == 0:
-            raise StopIteration
-        if self.sru.startrecord < self.sru.num_records + 1:
-            record_data = self.sru.run_query()
-            self.sru.startrecord += 1
-            return SRUResponse(record_data, self.sru)
-        else:
-            raise StopIteration
-
-    def next(self):
-        return self.__next__()
 
-
-class SRU():
+class SRU(SRUBase):
     """ Class to query a SRU endpoint"""
 
-    DEBUG = True
-
     CATALOG_ENDPOINT = "http://catalogue.bnf.fr/api"
     GALLICA_ENDPOINT = "https://gallica.bnf.fr"
 
-    maximumrecords = 50
-    num_records = 0
-    query = ""
-    recordschema = False
-    startrecord = 0
+    RECORD_SCHEMA = 'dublincore'
+    response_class = SRUResponse
 
     def __init__(self, kind="catalogue"):
         if kind == "catalogue":
@@ -171,42 +153,3 @@ class SRU():
             self.endpoint = self.GALLICA_ENDPOINT
         else:
             raise ValueError(kind)
-
-    def search(self, query, startrecord=1, maximumrecords=1,
-               recordschema='dublincore'):
-        self.maximumrecords = maximumrecords
-        self.query = query
-        self.startrecord = startrecord
-        self.recordschema = recordschema
-
-        record_data = self.run_query()
-
-        num_records = record_data.xpath(
-            "/srw:searchRetrieveResponse/srw:numberOfRecords/text()", namespaces=NAMESPACES)
-        print("Num records %s" % num_records, file=sys.stderr)
-        self.num_records = int(num_records[0])
-        if self.num_records > 0:
-            return SRUResponse(record_data, self)
-
-        return False
-
-    def run_query(self):
-        endpoint = "%s/SRU" % self.endpoint
-
-        if self.DEBUG:
-            print('run_query: [%s], query: [%s]' % (endpoint, self.query), file=sys.stderr)
-
-        #    headers={'Accept': 'application/sparql-results+json'},
-        r = get(
-            endpoint,
-            params={
-                'version': '1.2', 'operation': 'searchRetrieve',
-                'startRecord': self.startrecord, 'maximumRecords': self.maximumrecords,
-                'recordSchema': self.recordschema, 'query': self.query,
-            })
-
-        if not r.status_code == codes.ok:
-            raise Exception('Error while getting data from %s' % endpoint)
-
-        record_data = etree.fromstring(r.content)
-        return record_data
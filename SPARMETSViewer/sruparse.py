@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""Paging, prefetching and incremental parsing of the SRU searches, whatever their record schema."""
+
+import sys
+
+from lxml import etree
+from requests import codes
+
+from .outbound import http_get, UpstreamStatusError
+from .prefetch import PagePrefetcher
+from .singleflight import get_flight
+
+SRU_FLIGHT = get_flight('sru')
+
+SRW_NAMESPACE = 'http://www.loc.gov/zing/srw/'
+SRW_NAMESPACES = {'srw': SRW_NAMESPACE}
+RECORD_TAG = '{%s}record' % SRW_NAMESPACE
+NUMBER_OF_RECORDS_TAG = '{%s}numberOfRecords' % SRW_NAMESPACE
+
+
+def iterparse_records(response, sru):
+    """
+    Give the srw:record elements of a streamed SRU response as they are parsed.
+
+    response is a requests response opened with stream=True; the number of
+    records of the search is stored in sru.num_records as soon as it is read.
+    Each record is freed when the next one is asked for, so that only one
+    record is kept in memory: its fields must be read before going on.
+    """
+    response.raw.decode_content = True
+    context = etree.iterparse(response.raw, events=('end',),
+                              tag=(NUMBER_OF_RECORDS_TAG, RECORD_TAG))
+    try:
+        for _, elem in context:
+            if elem.tag == NUMBER_OF_RECORDS_TAG:
+                sru.num_records = int(elem.text)
+                continue
+            yield elem
+            # Free the record and the records already given
+            elem.clear()
+            parent = elem.getparent()
+            while elem.getprevious() is not None:
+                del parent[0]
+    finally:
+        del context
+        response.close()
+
+
+class SRUResponseBase():
+    """
+    Base class handling a SRU response (the properties apply to a srw:record),
+    the subclasses extracting the fields of their record schema
+    """
+
+    def __init__(self, record_data, sru):
+        self.record_data = record_data
+        self.sru = sru
+        self._fields = None
+
+    @property
+    def records(self):
+        if self.sru.num_records == 0:
+            record_data = []
+        else:
+            record_data = self.record_data.xpath("srw:records/srw:record",
+                                                 namespaces=SRW_NAMESPACES)
+        return(SRURecord(record_data, self.sru))
+
+    @property
+    def fields(self):
+        """All the fields of the record, extracted once"""
+        if self._fields is None:
+            self._fields = self.extract(self.record_data)
+        return self._fields
+
+    def extract(self, record_data):
+        """Extract the fields of a record"""
+        raise NotImplementedError
+
+
+class SRURecord():
+    """ Class iterating over the records of a SRU search, page by page"""
+
+    def __init__(self, record_data, sru):
+        # srw:record elements of the current page
+        self.record_data = record_data
+        self.sru = sru
+        self.position = 0
+        self.prefetcher = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.sru.num_records == 0:
+            raise StopIteration
+        if self.position >= len(self.record_data):
+            # Current page consumed, fetch the next one if any
+            startrecord = self.sru.startrecord + len(self.record_data)
+            if not self.record_data or startrecord > self.sru.last_wanted():
+                raise StopIteration
+            self.sru.startrecord = startrecord
+            self.record_data = self.fetch_page(startrecord).xpath("srw:records/srw:record",
+                                                                  namespaces=SRW_NAMESPACES)
+            self.position = 0
+            if not self.record_data:
+                raise StopIteration
+        record_data = self.record_data[self.position]
+        self.position += 1
+        return self.sru.response_class(record_data, self.sru)
+
+    def fetch_page(self, startrecord):
+        """Get the page at startrecord, the following ones being prefetched if asked"""
+        if self.sru.prefetch <= 0:
+            return self.sru.run_query(startrecord)
+        if self.prefetcher is None:
+            self.prefetcher = PagePrefetcher(self.sru.run_query, self.sru.maximumrecords,
+                                             self.sru.last_wanted(), self.sru.prefetch)
+        return self.prefetcher.get(startrecord)
+
+    def close(self):
+        """Stop prefetching the next pages"""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def next(self):
+        return self.__next__()
+
+
+class SRUBase():
+    """
+    Base class to query a SRU endpoint, page by page or streamed; the
+    subclasses give the endpoint, the record schema and the response class
+    """
+
+    DEBUG = True
+
+    # Record schema asked by default, and class of the responses
+    RECORD_SCHEMA = None
+    response_class = SRUResponseBase
+
+    maximumrecords = 50
+    num_records = 0
+    # Number of pages requested in advance while iterating on the records
+    prefetch = 0
+    # Last record wanted while iterating on the records (None: all of them)
+    last_record = None
+    query = ""
+    recordschema = False
+    startrecord = 0
+
+    def search(self, query, startrecord=1, maximumrecords=50, recordschema=None, limit=None):
+        self.maximumrecords = maximumrecords
+        self.query = query
+        self.startrecord = startrecord
+        self.recordschema = recordschema or self.RECORD_SCHEMA
+        self.last_record = None if limit is None else startrecord + limit - 1
+
+        record_data = self.run_query()
+        return self.read_response(record_data)
+
+    def last_wanted(self):
+        """Give the last record to fetch: the last one, or the last one of the limit"""
+        if self.last_record is None:
+            return self.num_records
+        return min(self.num_records, self.last_record)
+
+    def read_response(self, record_data):
+        """Read the number of records of a response, give the response (False if empty)"""
+        num_records = record_data.xpath(
+            "/srw:searchRetrieveResponse/srw:numberOfRecords/text()", namespaces=SRW_NAMESPACES)
+        if self.DEBUG:
+            print("Num records %s" % num_records, file=sys.stderr)
+        self.num_records = int(num_records[0])
+        if self.num_records > 0:
+            return self.response_class(record_data, self)
+
+        return False
+
+    def query_params(self, startrecord):
+        """Give the parameters of the request of the page at startrecord"""
+        return {
+            'version': '1.2', 'operation': 'searchRetrieve',
+            'startRecord': startrecord, 'maximumRecords': self.maximumrecords,
+            'recordSchema': self.recordschema, 'query': self.query,
+        }
+
+    def page_records(self, record_data):
+        """Give the records of a page, without fetching the following pages"""
+        return [self.response_class(record, self) for record in
+                record_data.xpath("srw:records/srw:record", namespaces=SRW_NAMESPACES)]
+
+    def run_query(self, startrecord=None):
+        endpoint = "%s/SRU" % self.endpoint
+        if startrecord is None:
+            startrecord = self.startrecord
+
+        if self.DEBUG:
+            print('run_query: [%s], query: [%s]' % (endpoint, self.query), file=sys.stderr)
+
+        params = self.query_params(startrecord)
+        # Identical queries sent at the same time share the same upstream call
+        key = (endpoint, tuple(sorted(params.items())))
+        r = SRU_FLIGHT.do(key, http_get, 'sru', endpoint, params=params)
+
+        if not r.status_code == codes.ok:
+            raise Exception('Error while getting data from %s' % endpoint)
+
+        record_data = etree.fromstring(r.content)
+        return record_data
+
+    def stream(self, query, startrecord=1, maximumrecords=50, recordschema=None, limit=None):
+        """
+        Search and give the records of all the pages (or the limit first ones).
+
+        The responses are parsed incrementally: a record is freed when the
+        next one is asked for.
+        """
+        self.maximumrecords = maximumrecords
+        self.query = query
+        self.startrecord = startrecord
+        self.recordschema = recordschema or self.RECORD_SCHEMA
+
+        count = 0
+        while True:
+            page_count = 0
+            for record_data in self.stream_query(self.startrecord):
+                yield self.response_class(record_data, self)
+                page_count += 1
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            self.startrecord += page_count
+            if page_count == 0 or self.startrecord > self.num_records:
+                return
+
+    def stream_query(self, startrecord=None):
+        """Run the query, giving the srw:record elements as they are received"""
+        endpoint = "%s/SRU" % self.endpoint
+        if startrecord is None:
+            startrecord = self.startrecord
+
+        if self.DEBUG:
+            print('stream_query: [%s], query: [%s]' % (endpoint, self.query), file=sys.stderr)
+
+        params = self.query_params(startrecord)
+        r = http_get('sru', endpoint, params=params, stream=True)
+        if not r.status_code == codes.ok:
+            try:
+                raise UpstreamStatusError('sru', r)
+            finally:
+                r.close()
+
+        return iterparse_records(r, self)
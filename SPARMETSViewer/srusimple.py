@@ -5,7 +5,13 @@ import re
 import sys
 
 from lxml import etree
-from requests import get, codes
+from requests import codes
+
+from .identifiers import abstract_ark
+from .outbound import http_get
+from .singleflight import get_flight
+
+SRU_FLIGHT = get_flight('sru')
 
 # Dictionnary of XML prefixes and their namespaces
 NAMESPACES = {
@@ -40,6 +46,8 @@ class SRUSimple():
 
     maximumrecords = 1
     num_records = 0
+    # Whether the last search_many matched more records than it gave
+    truncated = False
     query = ""
     recordschema = False
     startrecord = 1
@@ -127,19 +135,63 @@ class SRUSimple():
         record = record_data.xpath(oai_xpath, namespaces=NAMESPACES)[0]
         return record
 
+    def search_many(self, arks, recordschema='dublincore'):
+        """
+        Search the records of several arks with one query.
+
+        Give a dictionary ark -> oai_dc element, the arks with no record
+        being left out; truncated tells whether some records were past the
+        page (so the arks left out may have one).
+        """
+        if self.endpoint == self.CATALOG_ENDPOINT:
+            self.query = '(bib.ark any "%s")' % " ".join(arks)
+        else:
+            self.query = " or ".join('(dc.identifier all "%s")' % ark for ark in arks)
+        self.recordschema = recordschema
+        self.startrecord = 1
+        self.maximumrecords = len(arks)
+
+        record_data = self.run_query()
+
+        page = record_data.xpath(
+            "/srw:searchRetrieveResponse/srw:records/srw:record", namespaces=NAMESPACES)
+        num_records = record_data.xpath(
+            "/srw:searchRetrieveResponse/srw:numberOfRecords/text()", namespaces=NAMESPACES)
+        self.num_records = int(num_records[0]) if num_records else len(page)
+        self.truncated = self.num_records > len(page)
+
+        wanted = set(arks)
+        records = {}
+        for record in page:
+            dc_xml = record.find("srw:recordData/oai_dc:dc", namespaces=NAMESPACES)
+            if dc_xml is None:
+                continue
+            # The ark is the record identifier, or one of the dc identifiers
+            identifiers = record.xpath(
+                "srw:recordIdentifier/text()|srw:recordData/oai_dc:dc/dc:identifier/text()",
+                namespaces=NAMESPACES)
+            for identifier in identifiers:
+                ark = abstract_ark(self.no_http(identifier.strip()))
+                if ark in wanted and ark not in records:
+                    records[ark] = dc_xml
+        if self.DEBUG:
+            print("Found %d records of %d" % (len(records), len(arks)), file=sys.stderr)
+        return records
+
     def run_query(self):
         endpoint = "%s/SRU" % self.endpoint
 
         if self.DEBUG:
             print('run_query: [%s], query: [%s]' % (endpoint, self.query), file=sys.stderr)
 
-        r = get(
-            endpoint,
-            params={
-                'version': '1.2', 'operation': 'searchRetrieve',
-                'startRecord': self.startrecord, 'maximumRecords': self.maximumrecords,
-                'recordSchema': self.recordschema, 'query': self.query,
-            })
+        params = {
+            'version': '1.2', 'operation': 'searchRetrieve',
+            'startRecord': self.startrecord, 'maximumRecords': self.maximumrecords,
+            'recordSchema': self.recordschema, 'query': self.query,
+        }
+        # Identical queries sent at the same time share the same upstream call
+        key = (endpoint, tuple(sorted(params.items())))
+        r = SRU_FLIGHT.do(key, http_get, 'sru', endpoint, params=params)
 
         if not r.status_code == codes.ok:
             raise Exception('Error while getting data from %s' % endpoint)
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 """How to query with SRU in Unimarc."""
 
-import sys
+from collections import namedtuple
 
 from lxml import etree
-from requests import get, codes
 
+from .sruparse import SRUBase, SRUResponseBase
 
 # Dictionnary of XML prefixes and their namespaces
 NAMESPACES = {
@@ -25,163 +25,100 @@ NAMESPACES = {
 }
 
 
-class SRUResponse():
-    """
-    Class handling a SRU response in UniXMarc
-    """
+# Precompiled paths to the parts of a srw:record
+RECORD_IDENTIFIERS = etree.XPath("srw:recordIdentifier", namespaces=NAMESPACES)
+RECORD_DATAFIELDS = etree.XPath("srw:recordData/mxc:record/mxc:datafield", namespaces=NAMESPACES)
+SUBFIELD_TAG = '{%s}subfield' % NAMESPACES['mxc']
 
-    def __init__(self, record_data, sru):
-        self.record_data = record_data
-        self.sru = sru
+# Fields extracted from a UNIMARC record
+UnimarcRecord = namedtuple('UnimarcRecord', [
+    'identifiers', 'urls', 'dates', 'callnumbers', 'creators', 'titles', 'publishers'])
 
-    def xpathfor(self, tag, code):
-        prefix = ".//srw:record/srw:recordData/mxc:record/"
-        return prefix + "mxc:datafield[@tag='%s']/mxc:subfield[@code='%s']" % (tag, code)
 
-    @property
-    def records(self):
-        if self.sru.num_records == 0:
-            record_data = "<xml></xml>"
-        else:
-            record_data = self.record_data.xpath("srw:records/srw:record",
-                                                 namespaces=NAMESPACES)[0]
-        return(SRURecord(record_data, self.sru))
+def index_datafields(record_data):
+    """Index the subfields of a record: tag -> list of {code: [texts]}, one per datafield"""
+    index = {}
+    for datafield in RECORD_DATAFIELDS(record_data):
+        subfields = {}
+        for subfield in datafield.iterchildren(SUBFIELD_TAG):
+            subfields.setdefault(subfield.get('code'), []).append(subfield.text)
+        index.setdefault(datafield.get('tag'), []).append(subfields)
+    return index
+
+
+def extract_unimarc_record(record_data):
+    """Extract all the fields of a UNIMARC record in a single pass"""
+    index = index_datafields(record_data)
+
+    def subfields(tags, code):
+        return [text for tag in tags for datafield in index.get(tag, [])
+                for text in datafield.get(code, [])]
+
+    def joined(tags, codes):
+        return [", ".join(text for code in codes for text in datafield.get(code, [])
+                          if text is not None)
+                for tag in tags for datafield in index.get(tag, [])]
+
+    baseurl = 'http://gallica.bnf.fr/'
+    return UnimarcRecord(
+        identifiers=[r.text for r in RECORD_IDENTIFIERS(record_data)],
+        urls=[text.replace(baseurl, '') for text in subfields(['856'], 'u')],
+        dates=subfields(['210'], 'd'),
+        callnumbers=subfields(['930'], 'a'),
+        # name, first name and dates of authors
+        creators=joined(['700', '702'], ['a', 'b', 'f']),
+        titles=subfields(['200'], 'a'),
+        # name and place of publishers
+        publishers=joined(['210'], ['c', 'a']))
+
+
+class SRUResponse(SRUResponseBase):
+    """
+    Class handling a SRU response in UniXMarc (the properties apply to a srw:record)
+    """
+
+    def extract(self, record_data):
+        return extract_unimarc_record(record_data)
 
     @property
     def urls(self):
-        xpath = self.xpathfor('856', 'u')
-        baseurl = 'http://gallica.bnf.fr/'
-        result = [r.text.replace(baseurl, '')
-                  for r in self.record_data.xpath(xpath, namespaces=NAMESPACES)]
-        return result
+        return self.fields.urls
 
     @property
     def identifiers(self):
-        return [r.text
-                for r in self.record_data.xpath(".//srw:record/srw:recordIdentifier",
-                                                namespaces=NAMESPACES)]
+        return self.fields.identifiers
 
     @property
     def dates(self):
-        xpath = self.xpathfor('210', 'd')
-        return [r.text for r in self.record_data.xpath(xpath, namespaces=NAMESPACES)]
+        return self.fields.dates
 
     @property
     def callnumbers(self):
-        xpath = self.xpathfor('930', 'a')
-        return [r.text for r in self.record_data.xpath(xpath, namespaces=NAMESPACES)]
+        return self.fields.callnumbers
 
     @property
     def creators(self):
-        xpathCreator = ".//srw:recordData/mxc:record/mxc:datafield[@tag='700' or @tag='702']"
-        xpathNom = "./mxc:subfield[@code='a']/text()"
-        xpathPrenom = "./mxc:subfield[@code='b']/text()"
-        xpathDates = "./mxc:subfield[@code='f']/text()"
-        xpathFonction = "./mxc:subfield[@code='4']/text()"
-        r = []
-        for el in self.record_data.xpath(xpathCreator, namespaces=NAMESPACES):
-            nom = el.xpath(xpathNom, namespaces=NAMESPACES)
-            prenom = el.xpath(xpathPrenom, namespaces=NAMESPACES)
-            dates = el.xpath(xpathDates, namespaces=NAMESPACES)
-            r.append(", ".join(nom + prenom + dates))
-        return r
+        return self.fields.creators
 
     @property
     def titles(self):
-        xpath = self.xpathfor('200', 'a')
-        return [r.text for r in self.record_data.xpath(xpath, namespaces=NAMESPACES)]
+        return self.fields.titles
 
     @property
     def publishers(self):
-        xpathPublisher = ".//srw:recordData/mxc:record/mxc:datafield[@tag='210']"
-        xpathName = "./mxc:subfield[@code='c']/text()"
-        xpathLieu = "./mxc:subfield[@code='a']/text()"
-        r = []
-        for el in self.record_data.xpath(xpathPublisher, namespaces=NAMESPACES):
-            name = el.xpath(xpathName, namespaces=NAMESPACES)
-            lieu = el.xpath(xpathLieu, namespaces=NAMESPACES)
-            r.append(", ".join(name + lieu))
-        return r
-
-
-class SRURecord():
-    """ Class for keeping a SRU record"""
-
-    def __init__(self, record_data, sru):
-        self.record_data = record_data
-        self.sru = sru
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self.sru.num_records == 0:
-            raise StopIteration
-        if self.sru.startrecord < self.sru.num_records + 1:
-            record_data = self.sru.run_query()
-            self.sru.startrecord += 1
-            return SRUResponse(record_data, self.sru)
-        else:
-            raise StopIteration
+        return self.fields.publishers
 
-    def next(self):
-        return self.__next__()
 
-
-class SRUUnimarc():
+class SRUUnimarc(SRUBase):
     """ Class to query a SRU endpoint"""
 
-    DEBUG = True
-
     CATALOG_ENDPOINT = "http://catalogue.bnf.fr/api"
 
-    maximumrecords = 50
-    num_records = 0
-    query = ""
-    recordschema = False
-    startrecord = 0
+    RECORD_SCHEMA = 'unimarcXchange'
+    response_class = SRUResponse
 
     def __init__(self, kind="catalogue"):
         if kind == "catalogue":
             self.endpoint = self.CATALOG_ENDPOINT
         else:
             raise ValueError(kind)
-
-    def search(self, query, startrecord=1, maximumrecords=1,
-               recordschema='unimarcXchange'):
-        self.maximumrecords = maximumrecords
-        self.query = query
-        self.startrecord = startrecord
-        self.recordschema = recordschema
-
-        record_data = self.run_query()
-
-        num_records = record_data.xpath(
-            "/srw:searchRetrieveResponse/srw:numberOfRecords/text()", namespaces=NAMESPACES)
-        if self.DEBUG:
-            print("Num records %s" % num_records, file=sys.stderr)
-        self.num_records = int(num_records[0])
-        if self.num_records > 0:
-            return SRUResponse(record_data, self)
-
-        return False
-
-    def run_query(self):
-        endpoint = "%s/SRU" % self.endpoint
-
-        if self.DEBUG:
-            print('run_query: [%s], query: [%s]' % (endpoint, self.query), file=sys.stderr)
-
-        r = get(
-            endpoint,
-            params={
-                'version': '1.2', 'operation': 'searchRetrieve',
-                'startRecord': self.startrecord, 'maximumRecords': self.maximumrecords,
-                'recordSchema': self.recordschema, 'query': self.query,
-            })
-
-        if not r.status_code == codes.ok:
-            raise Exception('Error while getting data from %s' % endpoint)
-
-        record_data = etree.fromstring(r.content)
-        return record_data
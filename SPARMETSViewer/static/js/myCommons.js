@@ -12,6 +12,8 @@
  *
  * translateNs() : simplify an URI with known prefixes
  *
+ * exportAll() : download all the results of a query, exported by the server
+ *
 **/
 
 
@@ -89,3 +91,11 @@
     }
     return original
   }
+
+  // Post the query to an export url so that the browser downloads the result
+  var exportAll = function(url, params, format) {
+    var $form = $('<form method="post" style="display: none"></form>').attr('action', url)
+    $('<input type="hidden" name="query" />').val(JSON.stringify(params)).appendTo($form)
+    $('<input type="hidden" name="format" />').val(format).appendTo($form)
+    $form.appendTo('body').submit().remove()
+  }
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Cache keeping values, and failures, for a limited time."""
+
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Class keeping values for a limited time.
+
+    Failures can be kept too (negative caching), usually for a shorter time:
+    get() raises again the error which was stored.
+    """
+
+    def __init__(self, name, timeout, negative_timeout, max_entries):
+        self.name = name
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "%s [%d entries]" % (self.name, len(self.entries))
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[2] > time.time()
+
+    def peek(self, key):
+        """Give the value of key (None if missing or expired)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def get(self, key, function, *args, **kwargs):
+        """Give the value of key, computed with function(*args, **kwargs) if missing"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] <= now:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is not None:
+            value, error, _ = entry
+            if error is not None:
+                raise error
+            return value
+
+        try:
+            value = function(*args, **kwargs)
+        except ValueError as e:
+            self.store(key, error=e)
+            raise
+        self.store(key, value)
+        return value
+
+    def store(self, key, value=None, error=None):
+        """Keep a value (or an error) for key"""
+        timeout = self.timeout if error is None else self.negative_timeout
+        with self.lock:
+            if len(self.entries) >= self.max_entries and key not in self.entries:
+                self.purge()
+            self.entries[key] = (value, error, time.time() + timeout)
+
+    def purge(self):
+        """Forget the expired entries, and the oldest ones if still full"""
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry[2] <= now]:
+            del self.entries[key]
+        if len(self.entries) >= self.max_entries:
+            oldest = sorted(self.entries, key=lambda key: self.entries[key][2])
+            for key in oldest[:len(oldest) - self.max_entries + 1]:
+                del self.entries[key]
+
+    def stats(self):
+        """Give the counters of the cache"""
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
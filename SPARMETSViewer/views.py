@@ -1,24 +1,59 @@
 # -*- coding: utf-8 -*-
 """Definition of the routes for the application."""
+import itertools
+import json
 import os
-import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import jsonify, request, render_template, Response
+from flask import jsonify, request, render_template, Response, stream_with_context
+from flask import send_from_directory
 from flask_babel import gettext
-from requests import get, codes
+from requests import codes
+from requests.exceptions import ConnectionError as UpstreamConnectionError, Timeout
 from werkzeug.utils import secure_filename
 
 from SPARMETSViewer import app, babel, db
 from config import LANGUAGES
 
+from .aggregates import report_from_aggregates, aggregates_status
+from .bibcache import get_bib_record, warm_up_aip, BIB_CACHE
+from .bulk import queue_bulk, start_bulk, bulk_status
+from .export import EXPORT_FORMATS, export_response
+from .identifiers import from_ark_to_name
+from .ingestqueue import new_job_id, job_folder, enqueue_job, get_job, job_status, manifest_url
+from .ingestqueue import active_jobs, recent_jobs, queue_stats
+from .metrics import REGISTRY
 from .models import METS
-from .parsemets import METSFile
+from .outbound import breakers_stats, CircuitOpenError, UpstreamStatusError
+from .parsemets import METSFile, complete_mets
+from .profiling import PROFILE_PARAMETER, recent_profiles, get_profile, token_given
 from .referencedata import ReferenceData
-from .rdfquery import label_query, from_sparql_results_to_json
+from .singleflight import flights_stats
+from .slowqueries import RANK_ORDERS, rank_queries
+from .rdfgraph import build_compact_graph
+from .rdfquery import label_query, label_bulk_query, sparql_get, sparql_stream
+from .rdfquery import iter_sparql_bindings, iter_sparql_response, iter_keyset_rows
+from .rdfquery import from_sparql_results_to_json
+from .rdfquery import KEYSET_ORDERS, keyset_order, keyset_filter, keyset_keys
+from .rdfquery import encode_cursor, decode_cursor
 from .sru import SRU
-from .srusimple import SRUSimple
 from .sruunimarc import SRUUnimarc
+from .ttlcache import TTLCache
+
+# Query giving all the triples of the last release of an ark
+GRAPH_QUERY = """SELECT ?s ?p ?o WHERE {
+        <%s> sparcontext:hasLastVersion/sparcontext:hasLastRelease ?arkvr.
+        GRAPH ?g {
+          ?arkvr a sparstructure:group.
+          ?s ?p ?o.
+        } }"""
+# Pool used to send the independent SPARQL queries of a request in parallel
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=app.config['QUERY_WORKERS'])
+# Count of results per (channel, triples, filter)
+TOTALS_CACHE = TTLCache(
+    'totals', app.config['TOTALS_CACHE_TIMEOUT'], app.config['TOTALS_CACHE_TIMEOUT'],
+    app.config['TOTALS_CACHE_SIZE'])
 
 
 @babel.localeselector
@@ -27,24 +62,75 @@ def get_locale():
     return request.accept_languages.best_match(LANGUAGES.keys())
 
 
-def download(url, file_name):
-    """Download a url in the given file"""
-    # open in binary mode
-    with open(file_name, "wb") as file:
-        # get request
-        response = get(url)
-        if response.status_code != 200:
-            raise ValueError("Not found")
-        # write to file
-        file.write(response.content)
+@app.errorhandler(CircuitOpenError)
+def upstream_unavailable(error):
+    """Fail fast while an upstream is unhealthy"""
+    resp = Response(str(error), status=codes.service_unavailable, mimetype="text/plain")
+    resp.headers['Retry-After'] = str(error.retry_after)
+    return resp
+
+
+@app.errorhandler(Timeout)
+def upstream_timeout(error):
+    """An upstream did not answer in time"""
+    return Response("Upstream timeout", status=codes.gateway_timeout, mimetype="text/plain")
+
+
+@app.errorhandler(UpstreamConnectionError)
+def upstream_connection_error(error):
+    """An upstream could not be reached"""
+    return Response("Upstream unreachable", status=codes.bad_gateway, mimetype="text/plain")
+
+
+@app.errorhandler(UpstreamStatusError)
+def upstream_status_error(error):
+    """An upstream failed before the response was started"""
+    return Response(error.content, status=error.status_code, mimetype=error.mimetype)
+
+
+def stream_upstream(response):
+    """Forward the body of an upstream response to the client as it arrives"""
+    def generate():
+        try:
+            for chunk in response.iter_content(app.config['STREAM_CHUNK_SIZE']):
+                yield chunk
+        finally:
+            response.close()
+    return Response(
+        stream_with_context(generate()),
+        status=response.status_code,
+        mimetype=response.headers.get('Content-Type', 'application/json'))
+
+
+def json_array_stream(response, rows):
+    """Serialize rows one at a time as a JSON array, then close the response"""
+    try:
+        yield '['
+        separator = ''
+        for row in rows:
+            yield separator + json.dumps(row)
+            separator = ','
+        yield ']'
+    finally:
+        response.close()
+
+
+def upstream_error(response):
+    """Forward an unsuccessful upstream response to the client"""
+    return Response(
+        response.content,
+        status=response.status_code,
+        mimetype=response.headers.get('Content-Type', 'text/plain'))
 
 
-def from_ark_to_name(ark):
-    """Transform an ark in a name"""
-    name = ark.replace(":", "-").replace("/", "-").replace("--", "-")
-    if name.endswith(".xml"):
-        return name
-    return name + ".xml"
+def cached_total(key):
+    """Return the cached count of results for a channel and its filters"""
+    return TOTALS_CACHE.peek(key)
+
+
+def store_total(key, total):
+    """Keep the count of results for a channel and its filters"""
+    TOTALS_CACHE.store(key, total)
 
 
 def allowed_file(filename):
@@ -68,7 +154,7 @@ def last_modified_date():
 def index():
     """Primary route"""
     mets_instances = METS.query.all()
-    return render_template('index.html', mets_instances=mets_instances)
+    return render_template('index.html', mets_instances=mets_instances, jobs=active_jobs())
 
 
 @app.route("/upload", methods=['GET', 'POST'])
@@ -122,20 +208,8 @@ def reference_data_rest(kind):
     return jsonify(ref_data.get_data(kind))
 
 
-@app.route("/customquery", methods=['POST'])
-def custom_query_json():
-    """Make a SPARQL query and get back a simple json for table"""
-    if not request.is_json:
-        resp = Response("No json parameters", status=codes.bad_request, mimetype="text/plain")
-        return resp
-    content = request.get_json()
-    platform = app.config['ACCESS_PLATFORM']
-    if platform is None:
-        return
-
-    endpoint = app.config['ACCESS_ENDPOINT']
-    channel = content['filter']['channel']
-    app.logger.debug("THL QUERY with %s", channel)
+def custom_query_parts(content, order=None):
+    """Build the head, triples, optional patterns and filter of a channel search"""
     filter = ""
     triples = ""
     if "period" in content['filter']:
@@ -145,14 +219,10 @@ def custom_query_json():
         arkrecord = content['filter']['arkrecord']
         triples += " ?p dc:relation <%s>. " % arkrecord
 
-    limit = ""
-    if "offset" in content and content['offset']:
-        limit += "OFFSET " + str(content['offset'])
-    if "limit" in content and content['limit']:
-        limit += " LIMIT " + str(content['limit'])
- 
     columns = content['columns']
     head = "?ark "
+    if order == "ingest_date" and "ingest_date" not in columns:
+        head += "?ingest_date "
     triples += """?p sparprovenance:hasEvent ?e.
         ?e a sparprovenance:ingestCompletion.
         ?e dc:date ?ingest_date. """
@@ -209,61 +279,186 @@ def custom_query_json():
             ?eReception a sparprovenance:documentReception.
             ?eReception dc:date ?reception_date.
             ?eReception dc:description ?reception_no. }"""
+    return head, triples, optional, filter
 
-    queryCount = """SELECT (count(?ark) AS ?total)
+
+def custom_select(channel, head, triples, optional, filter, after="", limit="", subquery=""):
+    """Build the SPARQL query of a channel search"""
+    # after uses ?ark, which is only bound outside of the GRAPH group
+    return """SELECT
+        %s
         WHERE {
+        %s
         ?ark sparcontext:hasLastVersion/sparcontext:hasLastRelease ?p.
         GRAPH ?g {
         ?p a sparstructure:group.
         ?p sparcontext:isMemberOf <%s>.
+        %s %s
         %s
-        %s
-        } }""" % (channel, triples, filter)
-    app.logger.debug("THL QUERYCOUNT with %s", queryCount)
-    if 'total' in content:
-        total = int(content['total'])
-    elif platform == "TEST":
-        total = 2
-    else:
-        response = get(
-            endpoint,
-            headers={'Accept': 'application/sparql-results+json'},
-            params={'query': queryCount, 'format': 'application/sparql-results+json'})
-        if response.status_code != codes.ok:
-            resp = Response(
-                response.data,
-                status=response.status_code,
-                mimetype=response.content_type
-            )
-            return resp
-        totals = response.json()
-        total = int(totals.get("results").get("bindings")[0].get("total").get("value"))
-        app.logger.debug("Find %s results for channel %s", total, channel)
-
-    query = """SELECT
-        %s
+        } %s } %s""" % (head, subquery, channel, triples, optional, filter, after, limit)
+
+
+def custom_page_select(channel, head, triples, optional, filter, order, keys=None,
+                       limit=None, offset=None):
+    """
+    Build the SPARQL query of a page of a channel search with keyset pagination.
+
+    A package gives several rows (one per ingest, and per value of the
+    optional columns), so the page is made of the limit first distinct keys
+    after the cursor keys, with all their rows.
+    """
+    clause = keyset_order(order)
+    if offset:
+        clause += " OFFSET %d" % offset
+    if limit:
+        clause += " LIMIT %d" % limit
+    subquery = "{ %s }" % custom_select(
+        channel, "DISTINCT " + " ".join("?" + var for var in KEYSET_ORDERS[order]),
+        triples, "", filter, keyset_filter(order, keys) if keys else "", clause)
+    return custom_select(channel, head, triples, optional, filter,
+                         limit=keyset_order(order), subquery=subquery)
+
+
+def count_keys(order, bindings):
+    """Give the number of distinct keys of some SPARQL bindings"""
+    return len(set(json.dumps(keyset_keys(order, binding)) for binding in bindings))
+
+
+def custom_query_plan(content):
+    """
+    Build the queries of a page of a channel search.
+
+    Give a dictionary with the channel, the page query, the count query, the
+    key of the total in the cache and the order of the keyset pagination.
+    Raise ValueError for bad parameters.
+    """
+    channel = content['filter']['channel']
+    app.logger.debug("THL QUERY with %s", channel)
+
+    # Keyset pagination: rows are ordered on a key and the page starts
+    # after the last row of the previous one instead of using an OFFSET
+    order = content.get('order')
+    keys = None
+    if order is not None:
+        if order not in KEYSET_ORDERS:
+            raise ValueError("Bad order parameter")
+        if content.get('cursor'):
+            try:
+                keys = decode_cursor(content['cursor'], order)
+            except ValueError:
+                raise ValueError("Bad cursor parameter")
+
+    limit = ""
+    if "offset" in content and content['offset'] and keys is None:
+        limit += "OFFSET " + str(content['offset'])
+    if "limit" in content and content['limit']:
+        limit += " LIMIT " + str(content['limit'])
+
+    head, triples, optional, filter = custom_query_parts(content, order)
+
+    queryCount = """SELECT (count(?ark) AS ?total)
         WHERE {
         ?ark sparcontext:hasLastVersion/sparcontext:hasLastRelease ?p.
         GRAPH ?g {
         ?p a sparstructure:group.
         ?p sparcontext:isMemberOf <%s>.
-        %s %s
         %s
-        } } %s""" % (head, channel, triples, optional, filter, limit)
+        %s
+        } }""" % (channel, triples, filter)
+    if order is not None:
+        # The pages are made of distinct keys: so are the total and the offsets
+        queryCount = "SELECT (count(*) AS ?total) WHERE { { %s } }" % custom_select(
+            channel, "DISTINCT " + " ".join("?" + var for var in KEYSET_ORDERS[order]),
+            triples, "", filter)
+    app.logger.debug("THL QUERYCOUNT with %s", queryCount)
 
+    if order is None:
+        query = custom_select(channel, head, triples, optional, filter, limit=limit)
+    else:
+        query = custom_page_select(
+            channel, head, triples, optional, filter, order, keys,
+            int(content.get('limit') or 0), None if keys else int(content.get('offset') or 0))
     app.logger.debug("THL QUERY with %s", query)
+
+    return {
+        'channel': channel,
+        'query': query,
+        'count_query': queryCount,
+        # The total only depends on the channel, the filters and the order, not on the page
+        'total_key': (channel, triples, filter, order),
+        'order': order,
+    }
+
+
+def custom_query_total(content, platform, plan):
+    """Give the known total of a channel search (None if it must be counted)"""
+    if 'total' in content:
+        return int(content['total'])
+    elif platform == "TEST":
+        return 2
+    return cached_total(plan['total_key'])
+
+
+def custom_query_count(plan, totals):
+    """Read and keep the total given by the count query of a channel search"""
+    total = int(totals.get("results").get("bindings")[0].get("total").get("value"))
+    store_total(plan['total_key'], total)
+    app.logger.debug("Find %s results for channel %s", total, plan['channel'])
+    return total
+
+
+def custom_query_result(content, plan, results, total):
+    """Build the json of a page of a channel search"""
+    result = from_sparql_results_to_json(results, withCounts=True, count=total)
+    if plan['order'] is not None:
+        # Opaque cursor to get the next page, none when this one is the last
+        bindings = results.get("results", {}).get("bindings") or []
+        result['cursor'] = None
+        if (bindings and content.get('limit')
+                and count_keys(plan['order'], bindings) >= int(content['limit'])):
+            result['cursor'] = encode_cursor(plan['order'], bindings[-1])
+    return result
+
+
+@app.route("/customquery", methods=['POST'])
+def custom_query_json():
+    """Make a SPARQL query and get back a simple json for table"""
+    if not request.is_json:
+        resp = Response("No json parameters", status=codes.bad_request, mimetype="text/plain")
+        return resp
+    content = request.get_json()
+    platform = app.config['ACCESS_PLATFORM']
+    if platform is None:
+        return
+
+    endpoint = app.config['ACCESS_ENDPOINT']
+    try:
+        plan = custom_query_plan(content)
+    except ValueError as e:
+        return Response(str(e), status=codes.bad_request, mimetype="text/plain")
+
+    # Take the total from the client, then from the cache, else count in parallel
+    count_future = None
+    total = custom_query_total(content, platform, plan)
+    if total is None:
+        count_future = QUERY_EXECUTOR.submit(sparql_get, endpoint, plan['count_query'])
+
     if platform == "TEST":  # long queries on TEST
         time.sleep(5)
-    response = get(
-        endpoint,
-        headers={'Accept': 'application/sparql-results+json'},
-        params={'query': query, 'format': 'application/sparql-results+json'})
+    page_future = QUERY_EXECUTOR.submit(sparql_get, endpoint, plan['query'])
+
+    if count_future is not None:
+        response = count_future.result()
+        if response.status_code != codes.ok:
+            page_future.cancel()
+            return upstream_error(response)
+        total = custom_query_count(plan, response.json())
+
+    response = page_future.result()
     app.logger.debug("THL SPARQL %s response %s", endpoint, response.status_code)
     if response.status_code != codes.ok:
-        resp = Response(response.data, status=response.status_code, mimetype=response.content_type)
-        return resp
-    results = response.json()
-    return jsonify(from_sparql_results_to_json(results, withCounts=True, count=total))
+        return upstream_error(response)
+    return jsonify(custom_query_result(content, plan, response.json(), total))
 
 
 @app.route("/uri", methods=['GET', 'POST'])
@@ -289,16 +484,11 @@ def get_uri():
         }""" % uri
     app.logger.debug("Get uri endpoint %s", endpoint)
 
-    response = get(
-        endpoint,
-        headers={'Accept': 'application/sparql-results+json'},
-        params={'query': query, 'format': 'application/sparql-results+json'})
+    response = sparql_stream(endpoint, query)
     app.logger.debug("Get graph response %s", response.status_code)
     if response.status_code != codes.ok:
-        resp = Response(response.data, status=response.status_code, mimetype=response.content_type)
-        return resp
-    results = response.json()
-    return jsonify(results)
+        return upstream_error(response)
+    return stream_upstream(response)
 
 
 @app.route("/graph", methods=['GET', 'POST'])
@@ -319,24 +509,57 @@ def get_graph():
     endpoint = app.config['ACCESS_ENDPOINT']
     if platform == 'TEST':
         endpoint = app.config['GRAPH_TESTFILE']
-    query = """SELECT ?s ?p ?o WHERE {
-        <%s> sparcontext:hasLastVersion/sparcontext:hasLastRelease ?arkvr.
-        GRAPH ?g {
-          ?arkvr a sparstructure:group.
-          ?s ?p ?o.
-        } }""" % ark
+    query = GRAPH_QUERY % ark
     app.logger.debug("Get graph endpoint %s", endpoint)
 
-    response = get(
-        endpoint,
-        headers={'Accept': 'application/sparql-results+json'},
-        params={'query': query, 'format': 'application/sparql-results+json'})
+    response = sparql_stream(endpoint, query)
     app.logger.debug("Get graph response %s", response.status_code)
     if response.status_code != codes.ok:
-        resp = Response(response.data, status=response.status_code, mimetype=response.content_type)
+        return upstream_error(response)
+    return stream_upstream(response)
+
+
+@app.route("/graph/compact", methods=['GET', 'POST'])
+def get_compact_graph():
+    """Retrieve the full graph for a given ark as deduplicated nodes and edges"""
+    if request.method == 'POST':
+        params = request.form
+    else:
+        params = request.args
+    ark = params.get("ark")
+    if ark is None:
+        resp = Response("No ark", status=codes.bad_request, mimetype="text/plain")
         return resp
-    results = response.json()
-    return jsonify(results)
+    collapse = params.get("collapse", "1") != "0"
+    ark = app.config['ARK_PREFIX'] + ark.strip()
+    app.logger.debug("Get compact graph with %s", ark)
+    platform = app.config['ACCESS_PLATFORM']
+    if platform is None:
+        return
+    endpoint = app.config['ACCESS_ENDPOINT']
+    if platform == 'TEST':
+        endpoint = app.config['GRAPH_TESTFILE']
+
+    def labels(uris):
+        try:
+            return label_bulk_query(uris, platform)
+        except ValueError:
+            app.logger.warning("No labels for the graph of %s", ark)
+            return {}
+
+    response = sparql_stream(endpoint, GRAPH_QUERY % ark)
+    app.logger.debug("Get compact graph response %s", response.status_code)
+    if response.status_code != codes.ok:
+        return upstream_error(response)
+    try:
+        graph = build_compact_graph(
+            iter_sparql_bindings(response), collapse=collapse,
+            max_nodes=app.config['GRAPH_MAX_NODES'], labels=labels)
+    finally:
+        response.close()
+    app.logger.debug("Compact graph of %s: %d nodes, %d edges",
+                     ark, len(graph['nodes']), len(graph['edges']))
+    return jsonify(graph)
 
 
 @app.route("/query", methods=['GET', 'POST'])
@@ -359,16 +582,13 @@ def query_json():
         if "SUM(" in query:
             endpoint = app.config['REPORT_ENDPOINT']
 
-    response = get(
-        endpoint,
-        headers={'Accept': 'application/sparql-results+json'},
-        params={'query': query, 'format': 'application/sparql-results+json'})
+    response = sparql_stream(endpoint, query)
     app.logger.debug("THL SPARQL response %s", response.status_code)
     if response.status_code != codes.ok:
-        resp = Response(response.data, status=response.status_code, mimetype=response.content_type)
-        return resp
-    results = response.json()
-    return jsonify(from_sparql_results_to_json(results))
+        return upstream_error(response)
+    return Response(
+        stream_with_context(json_array_stream(response, iter_sparql_response(response))),
+        mimetype='application/json')
 
 
 @app.route("/sparql", methods=['GET', 'POST'])
@@ -383,57 +603,47 @@ def sparql_query():
 
     endpoint = app.config['ACCESS_ENDPOINT']
 
-    response = get(
-        endpoint,
-        headers={'Accept': 'application/sparql-results+json'},
-        params={'query': query, 'format': 'application/sparql-results+json'})
+    response = sparql_stream(endpoint, query)
     app.logger.debug("SPARQL response %s", response.status_code)
-    return response.content
+    return stream_upstream(response)
 
 
 @app.route("/bibrecord", methods=['GET'])
 def bib_record():
     """Access to the bib record in OAI"""
     ark = request.args.get("value")
-    if not ark.startswith("ark:"):
-        ark = re.sub(r'<a[^>]+>(.+)<\/a>', r'\1', ark)
-    is_gallica = ark.startswith('ark:/12148/b')
+    if ark is None:
+        return Response("No value parameter", status=codes.bad_request, mimetype="text/plain")
 
     app.logger.debug("BIBRECORD for %s", ark)
-    if is_gallica:
-        query = '(dc.identifier all "%s")' % ark
-        endpoint = SRUSimple("gallica")
-    else:
-        query = '(bib.ark all "%s")' % ark
-        endpoint = SRUSimple("catalogue")
-    response = endpoint.search(query)
-    record = endpoint.from_oai_to_array(response)
-    # return endpoint.from_dc_array_to_html(record)
+    try:
+        record = get_bib_record(ark)
+    except ValueError:
+        return Response(gettext('Not found'), status=codes.not_found, mimetype="text/plain")
     return render_template('dcsummary.html', dcmetadata=record)
 
 
-@app.route("/srucatalogquery", methods=['POST'])
-def catalog_sru():
-    """Access to the SRU endpoint of the catalog"""
-    if not request.is_json:
-        resp = Response("No json parameters", status=codes.bad_request, mimetype="text/plain")
-        return resp
-    content = request.get_json()
-    platform = app.config['ACCESS_PLATFORM']
-    if platform is None:
-        return
+@app.route("/bibrecord/warmup/<mets_file>", methods=['POST'])
+def warm_up_bib_records(mets_file):
+    """Prefetch in one batch the bib records related to an AIP"""
+    mets_instance = METS.query.filter_by(metsfile='%s' % (mets_file)).first()
+    if mets_instance is None:
+        return Response("Unknown METS", status=codes.not_found, mimetype="text/plain")
+    fetched = warm_up_aip(mets_instance, background=False)
+    return jsonify({'fetched': fetched, 'cache': BIB_CACHE.stats()})
 
-    endpoint = SRUUnimarc()
-    # Build the query
-    doctype = content['filter']['doc_type']
+
+def catalog_sru_query(filters):
+    """Build the CQL query of a catalogue search"""
+    doctype = filters['doc_type']
     query = '(bib.doctype any "%s") ' % doctype
     app.logger.debug("THL SRU with %s", doctype)
-    if "arkrecord" in content['filter']:
+    if "arkrecord" in filters:
         # bib.ark all "ark:/12148/cb40096442t"
-        arkrecord = content['filter']['arkrecord']
+        arkrecord = filters['arkrecord']
         query += ' and (bib.ark all "%s") ' % arkrecord
-    if "publication_date" in content['filter']:
-        pdates = content['filter']['publication_date'].split("-")
+    if "publication_date" in filters:
+        pdates = filters['publication_date'].split("-")
         if len(pdates) == 2:
             if pdates[0] and pdates[1]:
                 query += ' and (bib.publicationdate within "%s %s") ' % (pdates[0], pdates[1])
@@ -443,25 +653,123 @@ def catalog_sru():
                 query += ' and (bib.publicationdate <= "%s") ' % pdates[1]
         else:
             query += ' and (bib.publicationdate all "%s") ' % pdates[0]
-    if "value1" in content['filter']:
-        value = content['filter']['value1']
-        field = content['filter']['field1']
+    if "value1" in filters:
+        value = filters['value1']
+        field = filters['field1']
         if field == 'all':
             query += ' and (bib.anywhere all "%s") ' % value
         elif field == 'title':
             query += ' and (bib.title all "%s") ' % value
         elif field == 'creator':
             query += ' and (bib.author all "%s") ' % value
-    if "value2" in content['filter']:
-        value = content['filter']['value2']
-        field = content['filter']['field2']
+    if "value2" in filters:
+        value = filters['value2']
+        field = filters['field2']
         if field == 'all':
             query += ' and (bib.anywhere all "%s") ' % value
         elif field == 'title':
             query += ' and (bib.title all "%s") ' % value
         elif field == 'creator':
             query += ' and (bib.author all "%s") ' % value
-    app.logger.debug("THL SRU Query %s", query)
+    return query
+
+
+def catalog_sru_row(r, columns):
+    """Build the row of a catalogue record with the asked columns"""
+    record = {}
+    if "ark" in columns and r.identifiers:
+        app.logger.debug("Identifier : %s" % r.identifiers)
+        record['ark'] = " ; ".join(r.identifiers)
+    if "publication_date" in columns and r.dates:
+        app.logger.debug("Publication date: %s" % r.dates)
+        record['publication_date'] = r.dates[0]
+    if "title" in columns and r.titles:
+        app.logger.debug("Title: %s" % r.titles)
+        record['title'] = " ; ".join(r.titles)
+    if "creator" in columns and r.creators:
+        app.logger.debug("Creator: %s" % r.creators[0])
+        record['creator'] = " ; ".join(r.creators)
+    if "publisher" in columns and r.publishers:
+        app.logger.debug("Publisher: %s" % r.publishers[0])
+        record['publisher'] = r.publishers[0]
+    if "ark_doc" in columns and r.urls:
+        record['ark_doc'] = " ; ".join(r.urls)
+    if "call_no" in columns and r.callnumbers:
+        record['call_no'] = " ; ".join(r.callnumbers)
+    return record
+
+
+def gallica_sru_query(filters):
+    """Build the CQL query of a Gallica search"""
+    doctype = filters['doc_type']
+    query = '(dc.type any "%s") ' % doctype
+    app.logger.debug("THL SRU Gallica with %s", doctype)
+    if "arkrecord" in filters:
+        # dc.relation all "ark:/12148/cb40096442t"
+        arkrecord = filters['arkrecord']
+        query += ' and (dc.relation all "%s") ' % arkrecord
+    if "publication_date" in filters:
+        pdates = filters['publication_date'].split("-")
+        # or indexationdate
+        if len(pdates) == 2:
+            if pdates[0] and pdates[1]:
+                query += ' and (dc.date >= "%s") and (dc.date <= "%s") ' % (pdates[0], pdates[1])
+            elif pdates[0]:
+                query += ' and (dc.date >= "%s") ' % pdates[0]
+            elif pdates[1]:
+                query += ' and (dc.date <= "%s") ' % pdates[1]
+        else:
+            query += ' and (dc.date all "%s") ' % pdates[0]
+    if "value1" in filters:
+        value = filters['value1']
+        field = filters['field1']
+        if field == 'all':
+            query += ' and (metadata all "%s") ' % value
+        elif field == 'title':
+            query += ' and (dc.title all "%s") ' % value
+        elif field == 'creator':
+            query += ' and (dc.creator all "%s") ' % value
+    if "value2" in filters:
+        value = filters['value2']
+        field = filters['field2']
+        if field == 'all':
+            query += ' and (metadata all "%s") ' % value
+        elif field == 'title':
+            query += ' and (dc.title all "%s") ' % value
+        elif field == 'creator':
+            query += ' and (dc.creator all "%s") ' % value
+    # Add BnF provenance
+    query += ' and (provenance adj "bnf.fr") '
+    return query
+
+
+def gallica_sru_row(r, columns):
+    """Build the row of a Gallica record with the asked columns"""
+    record = {}
+    if "ark" in columns and r.identifiers:
+        app.logger.debug("Identifier : %s" % r.identifiers)
+        record['ark'] = " ; ".join(r.identifiers)
+    if "publication_date" in columns and r.dates:
+        app.logger.debug("Publication date: %s" % r.dates)
+        record['publication_date'] = r.dates[0]
+    if "title" in columns and r.titles:
+        app.logger.debug("Title: %s" % r.titles)
+        record['title'] = " ; ".join(r.titles)
+    if "creator" in columns and r.creators:
+        app.logger.debug("Creator: %s" % r.creators[0])
+        record['creator'] = " ; ".join(r.creators)
+    if "publisher" in columns and r.publishers:
+        app.logger.debug("Publisher: %s" % r.publishers[0])
+        record['publisher'] = r.publishers[0]
+    if "ark_record" in columns and r.relations:
+        record['ark_record'] = " ; ".join(r.relations)
+    if "set" in columns and r.description_sets:
+        record['set'] = " ; ".join(r.description_sets)
+    return record
+
+
+def sru_paging(content, default_limit):
+    """Give the first record (from 1) and the number of records of a SRU page"""
     startrecord = content['offset']
     if startrecord:
         startrecord = int(startrecord) + 1
@@ -471,9 +779,31 @@ def catalog_sru():
     if maximumrecords:
         maximumrecords = int(maximumrecords)
     else:
-        maximumrecords = 10
+        maximumrecords = default_limit
     app.logger.debug("THL SRU limit %s of %s", startrecord, maximumrecords)
-    response = endpoint.search(query, startrecord=startrecord)
+    return startrecord, maximumrecords
+
+
+@app.route("/srucatalogquery", methods=['POST'])
+def catalog_sru():
+    """Access to the SRU endpoint of the catalog"""
+    if not request.is_json:
+        resp = Response("No json parameters", status=codes.bad_request, mimetype="text/plain")
+        return resp
+    content = request.get_json()
+    platform = app.config['ACCESS_PLATFORM']
+    if platform is None:
+        return
+
+    endpoint = SRUUnimarc()
+    endpoint.prefetch = app.config['SRU_PREFETCH_PAGES']
+    # Build the query
+    query = catalog_sru_query(content['filter'])
+    app.logger.debug("THL SRU Query %s", query)
+    startrecord, maximumrecords = sru_paging(content, 10)
+    response = endpoint.search(query, startrecord=startrecord,
+                               maximumrecords=min(maximumrecords, app.config['SRU_PAGE_SIZE']),
+                               limit=maximumrecords)
 
     records = []
     total = endpoint.num_records
@@ -487,31 +817,14 @@ def catalog_sru():
     # Find the columns and build the response
     columns = content['columns']
     count = 0
-    for r in response.records:
-        count = count + 1
-        record = {}
-        if "ark" in columns and r.identifiers:
-            app.logger.debug("Identifier : %s" % r.identifiers)
-            record['ark'] = " ; ".join(r.identifiers)
-        if "publication_date" in columns and r.dates:
-            app.logger.debug("Publication date: %s" % r.dates)
-            record['publication_date'] = r.dates[0]
-        if "title" in columns and r.titles:
-            app.logger.debug("Title: %s" % r.titles)
-            record['title'] = " ; ".join(r.titles)
-        if "creator" in columns and r.creators:
-            app.logger.debug("Creator: %s" % r.creators[0])
-            record['creator'] = " ; ".join(r.creators)
-        if "publisher" in columns and r.publishers:
-            app.logger.debug("Publisher: %s" % r.publishers[0])
-            record['publisher'] = r.publishers[0]
-        if "ark_doc" in columns and r.urls:
-            record['ark_doc'] = " ; ".join(r.urls)
-        if "call_no" in columns and r.callnumbers:
-            record['call_no'] = " ; ".join(r.callnumbers)
-        records.append(record)
-        if count >= maximumrecords:
-            break
+    # The prefetching of the next pages stops with the loop, even on an error
+    with response.records as sru_records:
+        for r in sru_records:
+            count = count + 1
+            record = catalog_sru_row(r, columns)
+            records.append(record)
+            if count >= maximumrecords:
+                break
 
     result = {}
     result['total'] = total
@@ -531,60 +844,17 @@ def gallica_sru():
         return
 
     endpoint = SRU("gallica")
+    endpoint.prefetch = app.config['SRU_PREFETCH_PAGES']
     # Build the query
-    doctype = content['filter']['doc_type']
-    query = '(dc.type any "%s") ' % doctype
-    app.logger.debug("THL SRU Gallica with %s", doctype)
-    if "arkrecord" in content['filter']:
-        # dc.relation all "ark:/12148/cb40096442t"
-        arkrecord = content['filter']['arkrecord']
-        query += ' and (dc.relation all "%s") ' % arkrecord
-    if "publication_date" in content['filter']:
-        pdates = content['filter']['publication_date'].split("-")
-        # or indexationdate
-        if len(pdates) == 2:
-            if pdates[0] and pdates[1]:
-                query += ' and (dc.date >= "%s") and (dc.date <= "%s") ' % (pdates[0], pdates[1])
-            elif pdates[0]:
-                query += ' and (dc.date >= "%s") ' % pdates[0]
-            elif pdates[1]:
-                query += ' and (dc.date <= "%s") ' % pdates[1]
-        else:
-            query += ' and (dc.date all "%s") ' % pdates[0]
-    if "value1" in content['filter']:
-        value = content['filter']['value1']
-        field = content['filter']['field1']
-        if field == 'all':
-            query += ' and (metadata all "%s") ' % value
-        elif field == 'title':
-            query += ' and (dc.title all "%s") ' % value
-        elif field == 'creator':
-            query += ' and (dc.creator all "%s") ' % value
-    if "value2" in content['filter']:
-        value = content['filter']['value2']
-        field = content['filter']['field2']
-        if field == 'all':
-            query += ' and (metadata all "%s") ' % value
-        elif field == 'title':
-            query += ' and (dc.title all "%s") ' % value
-        elif field == 'creator':
-            query += ' and (dc.creator all "%s") ' % value
-    # Add BnF provenance
-    query += ' and (provenance adj "bnf.fr") '
+    query = gallica_sru_query(content['filter'])
 
     app.logger.debug("THL SRU Gallica Query %s", query)
-    startrecord = content['offset']
-    if startrecord:
-        startrecord = int(startrecord) + 1
-    else:
-        startrecord = 1
-    maximumrecords = content['limit']
-    if maximumrecords:
-        maximumrecords = int(maximumrecords)
-    else:
-        maximumrecords = -1 
-    app.logger.debug("THL SRU limit %s of %s", startrecord, maximumrecords)
-    response = endpoint.search(query, startrecord=startrecord)
+    startrecord, maximumrecords = sru_paging(content, -1)
+    pagesize = app.config['SRU_PAGE_SIZE']
+    if maximumrecords != -1:
+        pagesize = min(maximumrecords, pagesize)
+    response = endpoint.search(query, startrecord=startrecord, maximumrecords=pagesize,
+                               limit=None if maximumrecords == -1 else maximumrecords)
 
     records = []
     total = endpoint.num_records
@@ -600,31 +870,14 @@ def gallica_sru():
     # Find the columns and build the response
     columns = content['columns']
     count = 0
-    for r in response.records:
-        count = count + 1
-        record = {}
-        if "ark" in columns and r.identifiers:
-            app.logger.debug("Identifier : %s" % r.identifiers)
-            record['ark'] = " ; ".join(r.identifiers)
-        if "publication_date" in columns and r.dates:
-            app.logger.debug("Publication date: %s" % r.dates)
-            record['publication_date'] = r.dates[0]
-        if "title" in columns and r.titles:
-            app.logger.debug("Title: %s" % r.titles)
-            record['title'] = " ; ".join(r.titles)
-        if "creator" in columns and r.creators:
-            app.logger.debug("Creator: %s" % r.creators[0])
-            record['creator'] = " ; ".join(r.creators)
-        if "publisher" in columns and r.publishers:
-            app.logger.debug("Publisher: %s" % r.publishers[0])
-            record['publisher'] = r.publishers[0]
-        if "ark_record" in columns and r.relations:
-            record['ark_record'] = " ; ".join(r.relations)
-        if "set" in columns and r.description_sets:
-            record['set'] = " ; ".join(r.description_sets)
-        records.append(record)
-        if count >= maximumrecords:
-            break
+    # The prefetching of the next pages stops with the loop, even on an error
+    with response.records as sru_records:
+        for r in sru_records:
+            count = count + 1
+            record = gallica_sru_row(r, columns)
+            records.append(record)
+            if count >= maximumrecords:
+                break
 
     result = {}
     result['total'] = total
@@ -632,6 +885,138 @@ def gallica_sru():
     return jsonify(result)
 
 
+def custom_query_rows(content, order='ark'):
+    """
+    Give all the results of a channel search, page after page.
+
+    Raise UpstreamStatusError when a page is not given by the endpoint, so
+    that an export is not silently truncated.
+    """
+    endpoint = app.config['ACCESS_ENDPOINT']
+    channel = content['filter']['channel']
+    head, triples, optional, filter = custom_query_parts(content, order)
+    pagesize = app.config['EXPORT_PAGE_SIZE']
+    keys = None
+    while True:
+        query = custom_page_select(channel, head, triples, optional, filter, order, keys,
+                                   pagesize)
+        response = sparql_stream(endpoint, query)
+        if response.status_code != codes.ok:
+            app.logger.warning("Search of %s stopped: %s", channel, response.status_code)
+            try:
+                raise UpstreamStatusError('sparql', response)
+            finally:
+                response.close()
+        # Pages hold pagesize keys, each with one or more rows
+        count = 0
+        last_keys = keys
+        for row, row_keys in iter_keyset_rows(response, order):
+            if row_keys != last_keys:
+                count += 1
+                last_keys = row_keys
+            yield row
+        response.close()
+        # Last page, or an endpoint ignoring the pagination
+        if count < pagesize or last_keys == keys:
+            return
+        keys = last_keys
+
+
+def started_rows(rows):
+    """Read the first row of an export, so that a failed first page is known before responding"""
+    try:
+        return itertools.chain([next(rows)], rows)
+    except StopIteration:
+        return iter([])
+
+
+def sru_export_failed(error):
+    """Response of an SRU export whose first page was not given"""
+    app.logger.warning("SRU export stopped: %s", error)
+    return Response("SRU search failed: %s" % error.status_code, status=codes.bad_gateway,
+                    mimetype="text/plain")
+
+
+def export_request():
+    """Give the query and the format of an export (json body or form)"""
+    if request.is_json:
+        content = request.get_json()
+    elif request.form.get('query'):
+        try:
+            content = json.loads(request.form['query'])
+        except ValueError:
+            return None, None
+    else:
+        return None, None
+    format = request.values.get('format') or content.get('format') or 'csv'
+    if format not in EXPORT_FORMATS:
+        return None, None
+    return content, format
+
+
+@app.route("/customquery/export", methods=['POST'])
+def custom_query_export():
+    """Export all the results of a SPARQL search, page after page"""
+    content, format = export_request()
+    if content is None:
+        return Response("Bad export parameters", status=codes.bad_request, mimetype="text/plain")
+    if app.config['ACCESS_PLATFORM'] is None:
+        return
+
+    order = content.get('order') or 'ark'
+    if order not in KEYSET_ORDERS:
+        return Response("Bad order parameter", status=codes.bad_request, mimetype="text/plain")
+    columns = ['ark'] + [col for col in content['columns'] if col != 'ark']
+    app.logger.debug("THL EXPORT of %s in %s", content['filter']['channel'], format)
+    # Read the first page before the response starts, to give its error if any
+    rows = started_rows(custom_query_rows(content, order))
+    return export_response(rows, columns, format, "customquery")
+
+
+@app.route("/srucatalogquery/export", methods=['POST'])
+def catalog_sru_export():
+    """Export all the records of a catalogue search, page after page"""
+    content, format = export_request()
+    if content is None:
+        return Response("Bad export parameters", status=codes.bad_request, mimetype="text/plain")
+    if app.config['ACCESS_PLATFORM'] is None:
+        return
+
+    query = catalog_sru_query(content['filter'])
+    columns = content['columns']
+    app.logger.debug("THL SRU EXPORT of %s in %s", query, format)
+    records = SRUUnimarc().stream(query, maximumrecords=app.config['SRU_PAGE_SIZE'])
+    # Read the first page before the response starts: timeouts and unreachable
+    # endpoints are answered by the error handlers
+    try:
+        rows = started_rows(catalog_sru_row(r, columns) for r in records)
+    except UpstreamStatusError as e:
+        return sru_export_failed(e)
+    return export_response(rows, columns, format, "srucatalogquery")
+
+
+@app.route("/srugallicaquery/export", methods=['POST'])
+def gallica_sru_export():
+    """Export all the records of a Gallica search, page after page"""
+    content, format = export_request()
+    if content is None:
+        return Response("Bad export parameters", status=codes.bad_request, mimetype="text/plain")
+    if app.config['ACCESS_PLATFORM'] is None:
+        return
+
+    query = gallica_sru_query(content['filter'])
+    columns = content['columns']
+    app.logger.debug("THL SRU Gallica EXPORT of %s in %s", query, format)
+    records = SRU("gallica").stream(query, maximumrecords=app.config['SRU_PAGE_SIZE'])
+    # Read the first page before the response starts: timeouts and unreachable
+    # endpoints are answered by the error handlers
+    try:
+        rows = started_rows(gallica_sru_row(r, columns) for r in records)
+    except UpstreamStatusError as e:
+        return sru_export_failed(e)
+    return export_response(rows, columns, format, "srugallicaquery")
+
+
 @app.route("/sru", methods=['GET', 'POST'])
 def query_sru():
     """Access to the SRU endpoint"""
@@ -653,6 +1038,88 @@ def query_sru():
     return jsonify(records)
 
 
+@app.route("/status", methods=['GET'])
+def status():
+    """Give the counters of the outbound queries"""
+    return jsonify({
+        'coalescing': flights_stats(),
+        'bibrecord': BIB_CACHE.stats(),
+        'totals': TOTALS_CACHE.stats(),
+        'aggregates': aggregates_status(),
+        'breakers': breakers_stats(),
+        'ingest': queue_stats(),
+    })
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Give the metrics of all the processes in the Prometheus text format"""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+def profiles_forbidden():
+    """Refusal of the profiles to a request not giving PROFILE_TOKEN (None if given)"""
+    if token_given(request.environ):
+        return None
+    return Response(gettext("Forbidden"), status=codes.forbidden, mimetype="text/plain")
+
+
+@app.route("/profiles", methods=['GET'])
+def show_profiles():
+    """List of the latest profiles of requests"""
+    forbidden = profiles_forbidden()
+    if forbidden is not None:
+        return forbidden
+    return render_template('profiles.html', profiles=recent_profiles(),
+                           profiling=bool(app.config['PROFILE_DIR']),
+                           token=request.args.get(PROFILE_PARAMETER))
+
+
+@app.route("/profiles/<name>", methods=['GET'])
+def show_profile(name):
+    """Top functions of a profile of a request"""
+    forbidden = profiles_forbidden()
+    if forbidden is not None:
+        return forbidden
+    profile = get_profile(name)
+    if profile is None:
+        return Response(gettext("Not found"), status=codes.not_found, mimetype="text/plain")
+    return render_template('profile.html', profile=profile,
+                           token=request.args.get(PROFILE_PARAMETER))
+
+
+@app.route("/profiles/<name>/download", methods=['GET'])
+def download_profile(name):
+    """The profile of a request, to be read with pstats"""
+    forbidden = profiles_forbidden()
+    if forbidden is not None:
+        return forbidden
+    if get_profile(name) is None:
+        return Response(gettext("Not found"), status=codes.not_found, mimetype="text/plain")
+    return send_from_directory(os.path.abspath(app.config['PROFILE_DIR']), name + '.prof',
+                               as_attachment=True)
+
+
+@app.route("/slowqueries", methods=['GET'])
+def show_slow_queries():
+    """Ranking of the slow queries sent to the SPARQL and SRU endpoints"""
+    forbidden = profiles_forbidden()
+    if forbidden is not None:
+        return forbidden
+    order = request.args.get('order', 'total')
+    if order not in RANK_ORDERS:
+        return Response("Unknown order", status=codes.bad_request, mimetype="text/plain")
+    upstream = request.args.get('upstream') or None
+    try:
+        days = int(request.args.get('days', 0)) or None
+    except ValueError:
+        return Response("Bad days", status=codes.bad_request, mimetype="text/plain")
+    return render_template(
+        'slowqueries.html', queries=rank_queries(order, upstream, days), order=order,
+        upstream=upstream, days=days, orders=RANK_ORDERS,
+        threshold=app.config['SLOW_QUERY_THRESHOLD'], token=request.args.get(PROFILE_PARAMETER))
+
+
 @app.route("/compute", methods=['GET', 'POST'])
 def compute_md5():
     """Access to the md5 computation"""
@@ -700,6 +1167,19 @@ def report():
         last_date=last_modified_date())
 
 
+@app.route("/report/aggregates", methods=['GET'])
+def report_aggregates():
+    """Give the report of a channel from the local aggregates"""
+    channel = request.args.get("channel")
+    if not channel:
+        return Response("No channel parameter", status=codes.bad_request, mimetype="text/plain")
+    period = request.args.get("period")
+    report = report_from_aggregates(channel, period)
+    if report is None:
+        return Response("No aggregates", status=codes.not_found, mimetype="text/plain")
+    return jsonify(report)
+
+
 @app.route("/catalogsearch", methods=['GET', 'POST'])
 def catalog_search():
     """Access to the ctalog search form"""
@@ -799,26 +1279,14 @@ def upload_file():
                 access_platform=app.config['ACCESS_PLATFORM'])
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            if not os.path.exists(app.config['UPLOAD_FOLDER']):
-                os.makedirs(app.config['UPLOAD_FOLDER'])
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            mets_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            # Each job has its own folder, the file is parsed by an ingest worker
+            job_id = new_job_id()
+            os.makedirs(job_folder(job_id))
+            mets_path = os.path.join(job_folder(job_id), filename)
+            file.save(mets_path)
             aip_name = os.path.basename(filename)
-            mets = METSFile(mets_path, aip_name, nickname)
-            success = mets.parse_mets()
-            # delete file from uploads folder
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            if not success:
-                error = gettext('METS already exists')
-                return render_template(
-                    'upload.html',
-                    error=error,
-                    ark_prefix=app.config['ARK_PREFIX'],
-                    access_platform=app.config['ACCESS_PLATFORM'])
-            # Success back to index
-            mets_instances = METS.query.all()
-            success = gettext('Success! METS file uploaded!')
-            return render_template('index.html', mets_instances=mets_instances, success=success)
+            enqueue_job(job_id, 'upload', mets_path, aip_name, nickname)
+            return ingest_accepted(job_id)
         else:
             error = gettext('Not allowed selected file')
             return render_template(
@@ -844,47 +1312,93 @@ def retrieve_ark():
                 ark_prefix=app.config['ARK_PREFIX'],
                 access_platform=app.config['ACCESS_PLATFORM'])
         access_platform = app.config['ACCESS_PLATFORM']
-        access_server = app.config['ACCESS_URL']
         ark = app.config['ARK_PREFIX'] + ark.strip()
-        if access_platform == 'TEST':
-            url = access_server
-        else:
-            url = '%s/access/referenceDocumentRepository/%s.manifest' % (access_server, ark)
         filename = from_ark_to_name(ark)
 
-        if not os.path.exists(app.config['UPLOAD_FOLDER']):
-            os.makedirs(app.config['UPLOAD_FOLDER'])
-        mets_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        try:
-            download(url, mets_path)
-        except ValueError:
-            os.remove(mets_path)
-            error = gettext('METS not found')
-            return render_template(
-                'upload.html',
-                error=error,
-                ark_prefix=app.config['ARK_PREFIX'],
-                access_platform=app.config['ACCESS_PLATFORM'])
-
         aip_name = os.path.basename(filename)
         name = access_platform
         if nickname:
             name += " - " + nickname
-        mets = METSFile(mets_path, aip_name, name)
-        success = mets.parse_mets()
-        # delete file from uploads folder
-        os.remove(mets_path)
-        if not success:
-            error = gettext('METS already exists')
-            return render_template(
-                'upload.html',
-                error=error,
-                ark_prefix=app.config['ARK_PREFIX'],
-                access_platform=app.config['ACCESS_PLATFORM'])
-        # Success back to index
-        mets_instances = METS.query.all()
-        success = gettext('Success! METS file uploaded!')
-        return render_template('index.html', mets_instances=mets_instances, success=success)
+        # The manifest is downloaded and parsed by an ingest worker
+        job_id = enqueue_job(new_job_id(), 'ark', manifest_url(ark), aip_name, name, ark=ark)
+        return ingest_accepted(job_id)
+
+
+def ingest_accepted(job_id):
+    """Answer a queued ingest: the job id in json, or the index page following the job"""
+    if request.accept_mimetypes.best == 'application/json':
+        resp = jsonify({'job': job_id, 'status': '/ingest/%s' % job_id})
+        resp.status_code = codes.accepted
+        return resp
+    mets_instances = METS.query.all()
+    success = gettext('METS file queued for ingest')
+    return render_template('index.html', mets_instances=mets_instances, jobs=active_jobs(),
+                           success=success)
+
+
+def channel_arks(content):
+    """Give the arks found by a channel search, at most BULK_MAX_ARKS + 1"""
+    arks = []
+    for row in custom_query_rows({'filter': content['filter'], 'columns': []}, 'ark'):
+        # One row per ingest of a package
+        if arks and arks[-1] == row['ark']:
+            continue
+        arks.append(row['ark'])
+        if len(arks) > app.config['BULK_MAX_ARKS']:
+            break
+    return arks
+
+
+@app.route('/retrieve/bulk', methods=['POST'])
+def retrieve_bulk():
+    """Retrieve the manifests of a list of arks, or of the arks found by a channel search"""
+    content = request.get_json(silent=True)
+    if not content:
+        return Response("No json parameters", status=codes.bad_request, mimetype="text/plain")
+    if content.get('arks'):
+        arks = [ark for ark in content['arks'] if ark and ark.strip()]
+    elif content.get('filter') and app.config['ACCESS_PLATFORM'] is not None:
+        arks = channel_arks(content)
+    else:
+        arks = []
+    if not arks:
+        return Response("No arks", status=codes.bad_request, mimetype="text/plain")
+    if len(arks) > app.config['BULK_MAX_ARKS']:
+        return Response("Too many arks", status=codes.bad_request, mimetype="text/plain")
+    batch, count = queue_bulk(arks, content.get('nickname'))
+    start_bulk(batch)
+    resp = jsonify({'batch': batch, 'arks': count, 'status': '/retrieve/bulk/%s' % batch})
+    resp.status_code = codes.accepted
+    return resp
+
+
+@app.route('/retrieve/bulk/<batch>', methods=['GET'])
+def retrieve_bulk_status(batch):
+    """Give the status of each ark of a bulk retrieval"""
+    result = bulk_status(batch)
+    if result is None:
+        return Response(gettext("Not found"), status=codes.not_found, mimetype="text/plain")
+    return jsonify(result)
+
+
+@app.route('/ingest', methods=['GET'])
+def ingest_jobs():
+    """Give the status of the last ingest jobs"""
+    return jsonify([job_status(job) for job in recent_jobs()])
+
+
+@app.route('/ingest/<job_id>', methods=['GET'])
+def ingest_job(job_id):
+    """Give the status and the progress of an ingest job"""
+    job = get_job(job_id)
+    if job is None:
+        return Response(gettext("Not found"), status=codes.not_found, mimetype="text/plain")
+    result = job_status(job)
+    if job.error:
+        result['error'] = gettext(job.error)
+    if job.status == 'done':
+        result['url'] = '/aip/%s' % job.metsfile
+    return jsonify(result)
 
 
 # See https://www.ntu.edu.sg/home/ehchua/programming/webprogramming/Python3_Flask.html
@@ -907,10 +1421,22 @@ def show_aip(mets_file):
     return render_template(
         'aip.html', original_files=original_files,
         mets_file=mets_file, level=level, dcmetadata=dcmetadata, divs=divs,
-        filecount=filecount, aip_uuid=aip_uuid
+        filecount=filecount, aip_uuid=aip_uuid, timings=mets_instance.timings,
+        parse_phases=METSFile.PARSE_PHASES, parse_counters=METSFile.PARSE_COUNTERS
     )
 
 
+@app.route('/aip/<mets_file>/structure')
+def show_structure(mets_file):
+    """Structure information of a METS file (extracted when first asked)"""
+    mets_instance = METS.query.filter_by(metsfile='%s' % (mets_file)).first()
+    if mets_instance is None:
+        return Response(gettext("Not found"), status=codes.not_found, mimetype="text/plain")
+    complete_mets(mets_instance)
+    return render_template('aiptree.html', mets_file=mets_file, divs=mets_instance.divs or [],
+                           unavailable=mets_instance.detailed is False, fragment=True)
+
+
 @app.route('/delete/<mets_file>')
 def confirm_delete_aip(mets_file):
     """Access to the deletion"""
@@ -930,11 +1456,15 @@ def delete_aip(mets_file):
 def show_file(mets_file, fid):
     """Access to the description of a file"""
     mets_instances = METS.query.filter_by(metsfile='%s' % (mets_file)).first()
-    original_files = mets_instances.metslist
+    # The details of the files may not be extracted yet
+    original_files = complete_mets(mets_instances).metslist
     for original_file in original_files:
         if original_file["id"] == fid:
             target_original_file = original_file
             break
+    error = None
+    if mets_instances.detailed is False:
+        error = gettext("Details unavailable: the stored manifest of this METS is missing or unreadable")
     return render_template(
         'detail.html',
-        original_file=target_original_file, mets_file=mets_file)
+        original_file=target_original_file, mets_file=mets_file, error=error)
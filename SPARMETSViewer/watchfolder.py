@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Ingest of the manifests dropped in a watched folder."""
+
+import gzip
+import os
+import shutil
+import time
+from datetime import datetime
+
+from werkzeug.utils import secure_filename
+
+from SPARMETSViewer import app, db
+
+from .ingestqueue import new_job_id, job_folder, enqueue_job, get_job
+from .manifeststore import file_hash
+from .models import WatchedFile
+
+# Extensions of the manifests taken from the watch folder
+WATCHED_EXTENSIONS = ('.xml', '.xml.gz')
+# Subfolder receiving the manifests which could not be ingested
+FAILED_FOLDER = 'failed'
+
+
+def mets_name(filename):
+    """Name of the METS file of a manifest (without the .gz)"""
+    if filename.lower().endswith('.gz'):
+        filename = filename[:-3]
+    return secure_filename(filename)
+
+
+class WatchFolder(object):
+    """
+    Class polling a folder for new manifests and queuing their ingest.
+
+    A file is taken once its size and date did not change between two polls;
+    the hashes of the files taken are kept in the database, so that a file
+    is ingested only once even after a restart. The files whose ingest
+    failed are moved in the failed subfolder, with a .error file giving why;
+    a file which cannot even be hashed is only known by its path.
+    """
+
+    def __init__(self, folder=None, interval=None, nickname=None):
+        self.folder = folder or app.config['WATCH_FOLDER']
+        self.interval = interval or app.config['WATCH_INTERVAL']
+        self.nickname = nickname or app.config['WATCH_NICKNAME']
+        # Size and date of the files at the previous poll
+        self.seen = {}
+        # Files already hashed and known, with their size and date
+        self.known = {}
+
+    def __str__(self):
+        return self.folder
+
+    def candidates(self):
+        """Give the manifests of the folder whose writing is over"""
+        current = {}
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or not entry.name.lower().endswith(WATCHED_EXTENSIONS):
+                continue
+            stat = entry.stat()
+            current[entry.path] = (stat.st_size, stat.st_mtime)
+        ready = [path for path, state in current.items()
+                 if self.seen.get(path) == state and self.known.get(path) != state]
+        self.seen = current
+        return sorted(ready)
+
+    def submit(self, path, sha256):
+        """Queue the ingest of a manifest not yet known (sha256 is the hash of its content)"""
+        state = self.seen[path]
+        watched = WatchedFile.query.get(sha256)
+        if watched is not None and watched.status != 'failed':
+            self.known[path] = state
+            return None
+        if watched is not None:
+            # A manifest which failed is tried again when put back
+            db.session.delete(watched)
+            db.session.flush()
+        job_id = new_job_id()
+        filename = mets_name(os.path.basename(path))
+        os.makedirs(job_folder(job_id))
+        mets_path = os.path.join(job_folder(job_id), filename)
+        opener = gzip.open if path.lower().endswith('.gz') else open
+        try:
+            with opener(path, 'rb') as source, open(mets_path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+        except (OSError, EOFError):
+            shutil.rmtree(job_folder(job_id), ignore_errors=True)
+            raise
+        db.session.add(WatchedFile(sha256, path, job_id, datetime.now()))
+        db.session.commit()
+        self.known[path] = state
+        app.logger.debug("Watch folder: %s queued as job %s", path, job_id)
+        return enqueue_job(job_id, 'upload', mets_path, filename, self.nickname)
+
+    def move_failed(self, path, error):
+        """Move a manifest which could not be ingested in the failed subfolder"""
+        if not os.path.exists(path):
+            return
+        failed = os.path.join(os.path.dirname(path), FAILED_FOLDER)
+        if not os.path.exists(failed):
+            os.makedirs(failed)
+        target = os.path.join(failed, os.path.basename(path))
+        shutil.move(path, target)
+        with open(target + '.error', 'w') as f:
+            f.write(error + '\n')
+        self.known.pop(path, None)
+
+    def fail(self, watched, error):
+        """Record the failure of the ingest of a manifest and move it aside"""
+        watched.status = 'failed'
+        watched.error = str(error)[:255]
+        watched.updated = datetime.now()
+        app.logger.warning("Watch folder: ingest of %s failed: %s", watched.path, error)
+        self.move_failed(watched.path, watched.error)
+
+    def check(self):
+        """Record the end of the ingests queued"""
+        for watched in WatchedFile.query.filter_by(status='queued'):
+            job = get_job(watched.job)
+            if job is None:
+                self.fail(watched, "Job lost")
+            elif job.status == 'done':
+                watched.status = 'done'
+                watched.updated = datetime.now()
+            elif job.status == 'failed':
+                self.fail(watched, job.error)
+        db.session.commit()
+
+    def poll(self):
+        """Queue the new manifests and follow the ingests, give the number queued"""
+        queued = 0
+        for path in self.candidates():
+            try:
+                sha256 = file_hash(path)
+            except OSError as e:
+                # Unreadable or already removed: not tried again until it changes
+                app.logger.warning("Watch folder: %s not readable: %s", path, e)
+                self.known[path] = self.seen[path]
+                try:
+                    self.move_failed(path, str(e)[:255])
+                except OSError:
+                    pass
+                continue
+            try:
+                if self.submit(path, sha256):
+                    queued += 1
+            except (OSError, EOFError) as e:
+                # Unreadable, or not really compressed
+                db.session.rollback()
+                app.logger.warning("Watch folder: %s not taken: %s", path, e)
+                watched = WatchedFile.query.get(sha256)
+                if watched is None:
+                    watched = WatchedFile(sha256, path, None, datetime.now())
+                    db.session.add(watched)
+                watched.path = path
+                self.fail(watched, e)
+                db.session.commit()
+        self.check()
+        return queued
+
+    def run(self):
+        """Poll the folder until stopped"""
+        app.logger.info("Watching %s every %s s", self.folder, self.interval)
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                # A bad file or a database error must not stop the watch
+                db.session.rollback()
+                app.logger.error("Watch folder: poll of %s failed: %s", self.folder, e)
+            time.sleep(self.interval)
@@ -0,0 +1,157 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Load test of the proxy routes against a slow local SPARQL stand-in.
+
+Usage: python -m benchmarks.bench_async [--requests N] [--latency S] [--threads T]
+
+The same burst of concurrent /query requests is sent to the Flask
+application served by T threads (like a threaded WSGI worker), then to the
+asynchronous routes served by a single uvicorn worker.
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+import httpx
+
+from benchmarks.sparqlstandin import SPARQLStandIn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class PooledWSGIServer(WSGIServer):
+    """WSGI server answering the requests with a fixed number of threads"""
+
+    request_queue_size = 1024
+    threads = 8
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, 'pool'):
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_sync(port, threads):
+    """Serve the Flask application with a pool of threads"""
+    from SPARMETSViewer import app
+    PooledWSGIServer.threads = threads
+    server = make_server('127.0.0.1', port, app,
+                         server_class=PooledWSGIServer, handler_class=QuietHandler)
+    server.serve_forever()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server on port %d did not start" % port)
+
+
+async def burst(url, count):
+    """Send count requests at once, give the latencies and the errors"""
+    limits = httpx.Limits(max_connections=count, max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=600) as client:
+
+        async def one(i):
+            start = time.time()
+            query = "SELECT ?ark WHERE { ?ark ?p ?o } # %d" % i
+            try:
+                response = await client.get(url, params={'query': query})
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            return time.time() - start, ok
+
+        results = await asyncio.gather(*[one(i) for i in range(count)])
+    return sorted(r[0] for r in results), sum(1 for r in results if not r[1])
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(name, command, env, port, standin, count):
+    """Start a server, send it the burst, stop it and print the figures"""
+    server = subprocess.Popen(command, env=env, cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(port)
+        standin.reset()
+        start = time.time()
+        latencies, errors = asyncio.run(burst("http://127.0.0.1:%d/query" % port, count))
+        elapsed = time.time() - start
+    finally:
+        server.terminate()
+        server.wait()
+    print("%-22s %8d %8d %10d %10.2f %10.1f %8.2f %8.2f" % (
+        name, count, errors, standin.max_in_flight, elapsed, count / elapsed,
+        percentile(latencies, 50), percentile(latencies, 95)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=300, help='concurrent requests')
+    parser.add_argument('--latency', type=float, default=1.0, help='latency of the stand-in (s)')
+    parser.add_argument('--threads', type=int, default=8, help='threads of the WSGI server')
+    parser.add_argument('--serve-sync', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve_sync:
+        return serve_sync(args.serve_sync, args.threads)
+
+    standin = SPARQLStandIn(latency=args.latency).start()
+    settings = tempfile.NamedTemporaryFile('w', suffix='.cfg', delete=False)
+    settings.write("ACCESS_PLATFORM = 'BENCH'\nACCESS_ENDPOINT = %r\nOUTBOUND_RETRIES = 0\n"
+                   % standin.endpoint)
+    settings.close()
+    env = dict(os.environ, METSVIEWER_SETTINGS=settings.name)
+    try:
+        print("%-22s %8s %8s %10s %10s %10s %8s %8s" % (
+            "server", "requests", "errors", "upstream", "seconds", "req/s", "p50", "p95"))
+        port = free_port()
+        run("wsgi (%d threads)" % args.threads,
+            [sys.executable, '-m', 'benchmarks.bench_async', '--serve-sync', str(port),
+             '--threads', str(args.threads)], env, port, standin, args.requests)
+        port = free_port()
+        run("asgi (1 worker)",
+            [sys.executable, '-m', 'uvicorn', 'SPARMETSViewer.asgi:application',
+             '--port', str(port), '--workers', '1', '--log-level', 'warning'],
+            env, port, standin, args.requests)
+    finally:
+        standin.stop()
+        os.unlink(settings.name)
+
+
+if __name__ == '__main__':
+    main()
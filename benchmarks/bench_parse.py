@@ -0,0 +1,185 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Benchmark of the METS parser on synthetic manifests.
+
+Usage: python -m benchmarks.bench_parse [--scenarios a,b] [--repeat N] [--lazy]
+           [--output results.json] [--baseline baseline.json] [--tolerance 0.1]
+
+Each scenario is a manifest made by benchmarks.metsgenerator, ingested with
+METSFile.parse_mets in a fresh process: the median parse time, the peak RSS
+and the size of the stored columns are written as JSON. With a baseline
+(the output of a former run), the figures are compared and the exit status
+is 1 when a parse time or a peak RSS grew more than the tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.metsgenerator import KINDS, generate_mets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Parameters of the generator for each scenario
+SCENARIOS = {
+    'small': {'files': 20},
+    'medium': {'files': 500},
+    'large': {'files': 3000},
+    'events': {'files': 500, 'events': 8, 'agents': 3},
+    'admids': {'files': 500, 'events': 2, 'extra_admids': 20},
+    'objects': {'files': 2000, 'objects': 200},
+    'mix-only': {'files': 2000, 'kinds': ['mix']},
+    'no-metadata': {'files': 2000, 'events': 0, 'kinds': []},
+}
+# Compared with the baseline (the higher, the worse)
+COMPARED = ('parse_seconds', 'peak_rss_mb')
+
+
+def max_rss_mb():
+    """Peak RSS of this process (in MB)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS, in KB elsewhere
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def run_one(manifest, workdir, repeat):
+    """Ingest a manifest repeat times (in the child process), print the figures as JSON"""
+    from SPARMETSViewer import app, db
+    from SPARMETSViewer.models import METS
+    from SPARMETSViewer.parsemets import METSFile
+
+    times = []
+    with app.app_context():
+        db.create_all()
+        rss_before = max_rss_mb()
+        for i in range(repeat):
+            path = os.path.join(workdir, os.path.basename(manifest))
+            shutil.copy(manifest, path)
+            start = time.perf_counter()
+            if not METSFile(path, 'bench', None).parse_mets():
+                raise RuntimeError("METS not stored")
+            times.append(time.perf_counter() - start)
+            if i < repeat - 1:
+                METS.query.delete()
+                db.session.commit()
+        blob = db.session.execute(db.text(
+            "SELECT length(metslist) + length(dcmetadata) + coalesce(length(divs), 0) "
+            "FROM mets")).scalar()
+    times.sort()
+    print(json.dumps({
+        'parse_seconds': round(times[len(times) // 2], 4),
+        'parse_seconds_min': round(times[0], 4),
+        'peak_rss_mb': round(max_rss_mb(), 1),
+        'rss_growth_mb': round(max_rss_mb() - rss_before, 1),
+        'blob_bytes': blob,
+    }))
+
+
+def run_scenario(name, params, repeat, lazy, tmp):
+    """Generate the manifest of a scenario and ingest it in a new process"""
+    workdir = tempfile.mkdtemp(prefix=name + '-', dir=tmp)
+    manifest = os.path.join(tmp, name + '.xml')
+    admids = generate_mets(manifest, ark='bpt6kbench%s' % name.replace('-', ''), **params)
+    settings = os.path.join(workdir, 'settings.cfg')
+    with open(settings, 'w') as f:
+        f.write("SQLALCHEMY_DATABASE_URI = %r\n" % ('sqlite:///' + os.path.join(workdir, 'bench.db')))
+        f.write("MANIFEST_STORE = %r\n" % os.path.join(workdir, 'manifests'))
+        f.write("LAZY_PARSING = %r\n" % lazy)
+    env = dict(os.environ, METSVIEWER_SETTINGS=settings)
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmarks.bench_parse', '--run-one', manifest,
+         '--workdir', workdir, '--repeat', str(repeat)], env=env, cwd=ROOT)
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result.update({
+        'params': params,
+        'admids_per_file': admids,
+        'manifest_bytes': os.path.getsize(manifest),
+    })
+    shutil.rmtree(workdir)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Print the changes from the baseline, give the regressions"""
+    regressions = []
+    print("\n%-12s %-14s %12s %12s %8s" % ("scenario", "figure", "baseline", "current", "change"))
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        for figure in COMPARED + ('blob_bytes',):
+            if not before.get(figure):
+                continue
+            change = result[figure] / float(before[figure]) - 1
+            flag = ''
+            if figure in COMPARED and change > tolerance:
+                flag = ' <- regression'
+                regressions.append((name, figure))
+            print("%-12s %-14s %12s %12s %+7.1f%%%s" % (
+                name, figure, before[figure], result[figure], change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='scenarios to run, among ' + ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=3, help='ingests of each manifest')
+    parser.add_argument('--lazy', action='store_true', help='with LAZY_PARSING')
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--baseline', help='JSON file of former results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative growth reported as a regression')
+    parser.add_argument('--run-one', metavar='MANIFEST', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_one:
+        return run_one(args.run_one, args.workdir, args.repeat)
+
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(sorted(unknown)))
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'lazy': args.lazy,
+        'repeat': args.repeat,
+        'kinds': list(KINDS),
+        'scenarios': {},
+    }
+    tmp = tempfile.mkdtemp(prefix='bench_parse-')
+    print("%-12s %6s %7s %10s %10s %10s %12s" % (
+        "scenario", "files", "admids", "MB", "seconds", "peak MB", "blob bytes"))
+    try:
+        for name in names:
+            result = run_scenario(name, SCENARIOS[name], args.repeat, args.lazy, tmp)
+            results['scenarios'][name] = result
+            print("%-12s %6d %7d %10.1f %10.3f %10.1f %12d" % (
+                name, result['params']['files'], result['admids_per_file'],
+                result['manifest_bytes'] / 1e6, result['parse_seconds'],
+                result['peak_rss_mb'], result['blob_bytes']))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
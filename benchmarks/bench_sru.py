@@ -0,0 +1,54 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Benchmark of the SRU clients against the local stand-in.
+
+Usage: python -m benchmarks.bench_sru [--records N] [--latency S]
+
+A page size of 1 gives the former behaviour (one request per record),
+prefetch is the number of pages requested in advance.
+"""
+
+import argparse
+import time
+
+from benchmarks.srustandin import SRUStandIn
+from SPARMETSViewer.sru import SRU
+from SPARMETSViewer.sruunimarc import SRUUnimarc
+
+
+def run(client, standin, pagesize, prefetch):
+    """Iterate over all the records of a search and read one field of each"""
+    client.endpoint = standin.endpoint
+    client.DEBUG = False
+    client.prefetch = prefetch
+    standin.requests = 0
+    start = time.time()
+    count = 0
+    response = client.search('bib.ark any "ark:/12148/cb316013536"', maximumrecords=pagesize)
+    for record in response.records:
+        if record.titles:
+            count += 1
+    return count, standin.requests, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=1000, help='records of the search')
+    parser.add_argument('--latency', type=float, default=0.02, help='latency of a request (s)')
+    args = parser.parse_args()
+
+    standin = SRUStandIn(num_records=args.records, latency=args.latency).start()
+    try:
+        print("%-12s %8s %8s %8s %8s %10s" % (
+            "client", "pagesize", "prefetch", "records", "requests", "seconds"))
+        for name, factory in (("dublincore", SRU), ("unimarc", SRUUnimarc)):
+            for pagesize, prefetch in ((1, 0), (10, 0), (50, 0), (50, 3), (50, 8)):
+                count, requests, elapsed = run(factory(), standin, pagesize, prefetch)
+                print("%-12s %8d %8d %8d %8d %10.3f" % (
+                    name, pagesize, prefetch, count, requests, elapsed))
+    finally:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Generator of synthetic SPAR-like METS manifests.
+
+Usage: python -m benchmarks.metsgenerator OUTPUT [--files N] [--events N] [--agents N]
+           [--objects N] [--extra-admids N] [--kinds mix,textmd,xmp,mpeg7,containermd]
+
+Each file has a PREMIS object, one section of each metadata kind, events
+performed by agents (described once in the amdSec) and extra unparsed
+sections; its ADMID references all of them. The files are spread over the
+objects of the physical structMap. The output is the same for the same
+parameters.
+"""
+
+import argparse
+import uuid
+
+KINDS = ('mix', 'textmd', 'xmp', 'mpeg7', 'containermd')
+
+HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink"'
+    ' xmlns:premis="info:lc/xmlns/premis-v2" xmlns:mix="http://www.loc.gov/mix/v10"'
+    ' xmlns:textMD="info:lc/xmlns/textMD-v3" xmlns:mpeg7="urn:mpeg:mpeg7:schema:2004"'
+    ' xmlns:containerMD="http://bibnum.bnf.fr/ns/containerMD-v1"'
+    ' xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
+    ' xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:spar_dc="http://bibnum.bnf.fr/ns/spar_dc"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+
+GROUP_DC = (
+    '<mets:dmdSec ID="DMD.GRP" CREATED="2020-01-01T00:00:00"><mets:mdWrap MDTYPE="DC">'
+    '<mets:xmlData><spar_dc:spar_dc><dc:title>Title of {ark}</dc:title>'
+    '<dc:creator>Author</dc:creator><dc:date>1900</dc:date><dc:language>fre</dc:language>'
+    '<dc:type xsi:type="dcterms:DCMIType">text</dc:type>'
+    '<dc:relation>ark:/12148/cb316013536</dc:relation>'
+    '<dc:identifier xsi:type="spar_dc:ark">ark:/12148/{ark}</dc:identifier>'
+    '</spar_dc:spar_dc></mets:xmlData></mets:mdWrap></mets:dmdSec>\n')
+
+GROUP_OBJECT = (
+    '<mets:techMD ID="OBJ.GRP"><mets:mdWrap MDTYPE="PREMIS:OBJECT"><mets:xmlData><premis:object>'
+    '<premis:objectIdentifier><premis:objectIdentifierType>ark</premis:objectIdentifierType>'
+    '<premis:objectIdentifierValue>ark:/12148/{ark}</premis:objectIdentifierValue>'
+    '</premis:objectIdentifier>'
+    '<premis:objectIdentifier><premis:objectIdentifierType>productionIdentifier'
+    '</premis:objectIdentifierType><premis:objectIdentifierValue>PROD_{ark}'
+    '</premis:objectIdentifierValue></premis:objectIdentifier>'
+    '<premis:objectIdentifier><premis:objectIdentifierType>versionIdentifier'
+    '</premis:objectIdentifierType><premis:objectIdentifierValue>{ark}.version0.release0'
+    '</premis:objectIdentifierValue></premis:objectIdentifier>'
+    '<premis:relationship><premis:relationshipType>structural</premis:relationshipType>'
+    '<premis:relationshipSubType>channel</premis:relationshipSubType>'
+    '<premis:relatedObjectIdentification><premis:relatedObjectIdentifierType>ark'
+    '</premis:relatedObjectIdentifierType><premis:relatedObjectIdentifierValue>TPA'
+    '</premis:relatedObjectIdentifierValue></premis:relatedObjectIdentification>'
+    '</premis:relationship></premis:object></mets:xmlData></mets:mdWrap></mets:techMD>\n')
+
+AGENT = (
+    '<mets:digiprovMD ID="AGT.{n}"><mets:mdWrap MDTYPE="PREMIS:AGENT"><mets:xmlData><premis:agent>'
+    '<premis:agentIdentifier><premis:agentIdentifierType>UUID</premis:agentIdentifierType>'
+    '<premis:agentIdentifierValue>{uuid}</premis:agentIdentifierValue></premis:agentIdentifier>'
+    '<premis:agentName>Agent {n}</premis:agentName><premis:agentType>software</premis:agentType>'
+    '<premis:agentNote>version {n}.0</premis:agentNote>'
+    '</premis:agent></mets:xmlData></mets:mdWrap></mets:digiprovMD>\n')
+
+EVENT = (
+    '<mets:digiprovMD ID="{id}"><mets:mdWrap MDTYPE="PREMIS:EVENT"><mets:xmlData><premis:event>'
+    '<premis:eventIdentifier><premis:eventIdentifierType>UUID</premis:eventIdentifierType>'
+    '<premis:eventIdentifierValue>{uuid}</premis:eventIdentifierValue></premis:eventIdentifier>'
+    '<premis:eventType>{type}</premis:eventType>'
+    '<premis:eventDateTime>2019-01-{day:02d}T10:00:00</premis:eventDateTime>'
+    '<premis:eventDetail>Detail of {id}</premis:eventDetail>'
+    '<premis:eventOutcomeInformation><premis:eventOutcome>success</premis:eventOutcome>'
+    '<premis:eventOutcomeDetail><premis:eventOutcomeDetailNote>note</premis:eventOutcomeDetailNote>'
+    '</premis:eventOutcomeDetail></premis:eventOutcomeInformation>'
+    '{agents}'
+    '<premis:linkingObjectIdentifier><premis:linkingObjectIdentifierType>ark'
+    '</premis:linkingObjectIdentifierType><premis:linkingObjectIdentifierValue>ark:/12148/{ark}'
+    '</premis:linkingObjectIdentifierValue><premis:linkingObjectRole>source'
+    '</premis:linkingObjectRole></premis:linkingObjectIdentifier>'
+    '</premis:event></mets:xmlData></mets:mdWrap></mets:digiprovMD>\n')
+
+LINKING_AGENT = (
+    '<premis:linkingAgentIdentifier><premis:linkingAgentIdentifierType>UUID'
+    '</premis:linkingAgentIdentifierType><premis:linkingAgentIdentifierValue>{uuid}'
+    '</premis:linkingAgentIdentifierValue><premis:linkingAgentRole>performer'
+    '</premis:linkingAgentRole></premis:linkingAgentIdentifier>')
+
+FILE_OBJECT = (
+    '<mets:techMD ID="OBJ.{i}"><mets:mdWrap MDTYPE="PREMIS:OBJECT"><mets:xmlData><premis:object>'
+    '<premis:objectIdentifier><premis:objectIdentifierType>local</premis:objectIdentifierType>'
+    '<premis:objectIdentifierValue>f{i}</premis:objectIdentifierValue>'
+    '</premis:objectIdentifier><premis:objectCharacteristics><premis:format>'
+    '<premis:formatDesignation><premis:formatName>image/tiff</premis:formatName>'
+    '<premis:formatVersion>6.0</premis:formatVersion></premis:formatDesignation>'
+    '<premis:formatRegistry><premis:formatRegistryName>SPAR</premis:formatRegistryName>'
+    '<premis:formatRegistryKey>ark:/12148/br2d27h</premis:formatRegistryKey>'
+    '</premis:formatRegistry></premis:format></premis:objectCharacteristics>'
+    '</premis:object></mets:xmlData></mets:mdWrap></mets:techMD>\n')
+
+SECTIONS = {
+    'mix': (
+        '<mets:techMD ID="MIX.{i}"><mets:mdWrap MDTYPE="NISOIMG"><mets:xmlData><mix:mix>'
+        '<mix:BasicImageInformation><mix:BasicImageCharacteristics>'
+        '<mix:imageWidth>{width}</mix:imageWidth><mix:imageHeight>3500</mix:imageHeight>'
+        '</mix:BasicImageCharacteristics></mix:BasicImageInformation>'
+        '<mix:Compression><mix:compressionScheme>1</mix:compressionScheme></mix:Compression>'
+        '<mix:ImageAssessmentMetadata><mix:ImageColorEncoding><mix:BitsPerSample>'
+        '<mix:bitsPerSampleValue>8</mix:bitsPerSampleValue></mix:BitsPerSample>'
+        '</mix:ImageColorEncoding></mix:ImageAssessmentMetadata>'
+        '</mix:mix></mets:xmlData></mets:mdWrap></mets:techMD>\n'),
+    'textmd': (
+        '<mets:techMD ID="TXT.{i}"><mets:mdWrap MDTYPE="TEXTMD"><mets:xmlData><textMD:textMD>'
+        '<textMD:character_info><textMD:charset>UTF-8</textMD:charset></textMD:character_info>'
+        '<textMD:markup_basis>XML</textMD:markup_basis>'
+        '<textMD:markup_language>ALTO</textMD:markup_language>'
+        '</textMD:textMD></mets:xmlData></mets:mdWrap></mets:techMD>\n'),
+    'xmp': (
+        '<mets:techMD ID="XMP.{i}"><mets:mdWrap MDTYPE="OTHER" OTHERMDTYPE="XMP"><mets:xmlData>'
+        '<rdf:RDF><rdf:Description><premis:hasSignificantProperties><rdf:Bag>'
+        '<rdf:li premis:hasSignificantPropertiesType="hasEncryption"'
+        ' premis:hasSignificantPropertiesValue="false"/>'
+        '</rdf:Bag></premis:hasSignificantProperties></rdf:Description></rdf:RDF>'
+        '</mets:xmlData></mets:mdWrap></mets:techMD>\n'),
+    'mpeg7': (
+        '<mets:techMD ID="MPG.{i}"><mets:mdWrap MDTYPE="OTHER" OTHERMDTYPE="MPEG7"><mets:xmlData>'
+        '<mpeg7:Mpeg7><mpeg7:MediaFormat><mpeg7:Content><mpeg7:Name>audio</mpeg7:Name>'
+        '</mpeg7:Content></mpeg7:MediaFormat><mpeg7:AudioCoding><mpeg7:Format>'
+        '<mpeg7:Name>WAV</mpeg7:Name></mpeg7:Format><mpeg7:Sample rate="44100"/>'
+        '</mpeg7:AudioCoding><mpeg7:MediaDuration>PT3M{sec}S</mpeg7:MediaDuration>'
+        '</mpeg7:Mpeg7></mets:xmlData></mets:mdWrap></mets:techMD>\n'),
+    'containermd': (
+        '<mets:techMD ID="CMD.{i}"><mets:mdWrap MDTYPE="OTHER" OTHERMDTYPE="containerMD">'
+        '<mets:xmlData><containerMD:containerMD><containerMD:entriesInformation number="{i}"/>'
+        '</containerMD:containerMD></mets:xmlData></mets:mdWrap></mets:techMD>\n'),
+}
+PREFIXES = {'mix': 'MIX', 'textmd': 'TXT', 'xmp': 'XMP', 'mpeg7': 'MPG', 'containermd': 'CMD'}
+
+EXTRA = (
+    '<mets:techMD ID="EXT.{i}.{k}"><mets:mdWrap MDTYPE="OTHER" OTHERMDTYPE="unparsed">'
+    '<mets:xmlData><note>Section {k} of file {i}</note></mets:xmlData></mets:mdWrap>'
+    '</mets:techMD>\n')
+
+EVENT_TYPES = ('digitization', 'ingestCompletion', 'formatIdentification', 'validation')
+
+
+def make_uuid(*parts):
+    """Deterministic UUID of a generated element"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, '/'.join(str(part) for part in parts)))
+
+
+def file_admids(i, events, kinds, extra_admids):
+    """ADMID references of a file"""
+    admids = ['OBJ.%d' % i]
+    admids += ['%s.%d' % (PREFIXES[kind], i) for kind in kinds]
+    admids += ['EVT.%d.%d' % (i, j) for j in range(events)]
+    admids += ['EXT.%d.%d' % (i, k) for k in range(extra_admids)]
+    return admids
+
+
+def generate_mets(output, files=100, events=2, agents=1, objects=None, extra_admids=0,
+                  kinds=KINDS, ark='bpt6k0000000'):
+    """Write a synthetic manifest in output (a path or a text file), give its ADMIDs per file"""
+    if isinstance(output, str):
+        with open(output, 'w', encoding='utf-8') as f:
+            return generate_mets(f, files, events, agents, objects, extra_admids, kinds, ark)
+    objects = objects or files
+    agent_uuids = [make_uuid(ark, 'agent', n) for n in range(max(agents, 1))]
+    write = output.write
+    write(HEADER)
+    write(GROUP_DC.format(ark=ark))
+    for i in range(files):
+        write('<mets:dmdSec ID="DMD.%d"><mets:mdWrap MDTYPE="DC"><mets:xmlData><spar_dc:spar_dc>'
+              '<dc:title>Page %d</dc:title><dc:description>File %d</dc:description>'
+              '</spar_dc:spar_dc></mets:xmlData></mets:mdWrap></mets:dmdSec>\n' % (i, i + 1, i))
+    write('<mets:amdSec>\n')
+    write(GROUP_OBJECT.format(ark=ark))
+    for n, agent_uuid in enumerate(agent_uuids):
+        write(AGENT.format(n=n, uuid=agent_uuid))
+    linking = ''.join(LINKING_AGENT.format(uuid=agent_uuid) for agent_uuid in agent_uuids[:agents])
+    write(EVENT.format(id='EVT.GRP', uuid=make_uuid(ark, 'event'), type='ingestCompletion',
+                       day=28, agents=linking, ark=ark))
+    for k in range(objects):
+        write(EVENT.format(id='EVT.O.%d' % k, uuid=make_uuid(ark, 'object', k),
+                           type='validation', day=27, agents=linking, ark=ark))
+    for i in range(files):
+        write(FILE_OBJECT.format(i=i, ark=ark))
+        for kind in kinds:
+            write(SECTIONS[kind].format(i=i, width=2000 + i % 500, sec=i % 60))
+        for j in range(events):
+            write(EVENT.format(id='EVT.%d.%d' % (i, j), uuid=make_uuid(ark, i, j),
+                               type=EVENT_TYPES[j % len(EVENT_TYPES)], day=1 + j % 26,
+                               agents=linking, ark=ark))
+        for k in range(extra_admids):
+            write(EXTRA.format(i=i, k=k))
+    write('</mets:amdSec>\n<mets:fileSec><mets:fileGrp USE="master">\n')
+    for i in range(files):
+        write('<mets:file ID="FIL.%d" ADMID="%s" DMDID="DMD.%d" CHECKSUMTYPE="MD5"'
+              ' CHECKSUM="%032x" SIZE="%d" MIMETYPE="image/tiff">'
+              '<mets:FLocat LOCTYPE="URL" xlink:href="%s/master/f%d.tif"/></mets:file>\n'
+              % (i, ' '.join(file_admids(i, events, kinds, extra_admids)), i, i,
+                 1000000 + i, ark, i))
+    write('</mets:fileGrp></mets:fileSec>\n')
+    write('<mets:structMap TYPE="physical"><mets:div TYPE="set" DMDID="DMD.GRP">'
+          '<mets:div TYPE="group" DMDID="DMD.GRP" ADMID="OBJ.GRP EVT.GRP">\n')
+    for k in range(objects):
+        write('<mets:div TYPE="object" ID="DIV.%d" ORDER="%d" ORDERLABEL="%d" ADMID="EVT.O.%d">'
+              % (k, k + 1, k + 1, k))
+        for i in range(k, files, objects):
+            write('<mets:fptr FILEID="FIL.%d"/>' % i)
+        write('</mets:div>\n')
+    write('</mets:div></mets:div></mets:structMap>\n</mets:mets>\n')
+    return len(file_admids(0, events, kinds, extra_admids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help='manifest to write')
+    parser.add_argument('--files', type=int, default=100, help='files of the fileSec')
+    parser.add_argument('--events', type=int, default=2, help='PREMIS events of each file')
+    parser.add_argument('--agents', type=int, default=1, help='agents of each event')
+    parser.add_argument('--objects', type=int, help='objects of the structMap (default files)')
+    parser.add_argument('--extra-admids', type=int, default=0,
+                        help='unparsed sections referenced by each file')
+    parser.add_argument('--kinds', default=','.join(KINDS), help='metadata kinds of each file')
+    parser.add_argument('--ark', default='bpt6k0000000', help='ark of the package')
+    args = parser.parse_args()
+    kinds = [kind for kind in args.kinds.split(',') if kind]
+    unknown = set(kinds) - set(KINDS)
+    if unknown:
+        parser.error('unknown kinds: ' + ', '.join(sorted(unknown)))
+    admids = generate_mets(args.output, args.files, args.events, args.agents, args.objects,
+                           args.extra_admids, kinds, args.ark)
+    print('%s: %d files, %d ADMIDs per file' % (args.output, args.files, admids))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in of a slow SPARQL endpoint, replaying a recorded result."""
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'SPARMETSViewer', 'static', 'samples')
+# Recorded answer of the SPARQL endpoint
+RECORDED_RESULT = os.path.join(SAMPLES, 'sparqlResponse2.json')
+
+
+class SPARQLStandIn(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server answering every query with the recorded result after latency
+    seconds; the highest number of requests waiting at the same time is kept.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=1.0, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), SPARQLHandler)
+        self.latency = latency
+        with open(RECORDED_RESULT, 'rb') as f:
+            self.result = f.read()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:%d/sparql" % self.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.max_in_flight = 0
+
+
+class SPARQLHandler(BaseHTTPRequestHandler):
+    """Handler of the requests sent to the stand-in"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Content-Length', str(len(server.result)))
+        self.end_headers()
+        self.wfile.write(server.result)
+
+    def log_message(self, format, *args):
+        pass
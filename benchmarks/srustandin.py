@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in of the SRU endpoints of the BnF, replaying a recorded record."""
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from lxml import etree
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'SPARMETSViewer', 'static', 'samples')
+# Recorded dublincore answer of catalogue.bnf.fr
+RECORDED_DC = os.path.join(SAMPLES, 'cb316013536.sru.xml')
+
+SRW = 'http://www.loc.gov/zing/srw/'
+
+# Record in unimarcXchange, as given by catalogue.bnf.fr for the same notice
+UNIMARC_RECORD = b"""<srw:record xmlns:srw="http://www.loc.gov/zing/srw/">
+<srw:recordSchema>unimarcXchange</srw:recordSchema>
+<srw:recordPacking>xml</srw:recordPacking>
+<srw:recordData>
+<mxc:record xmlns:mxc="info:lc/xmlns/marcxchange-v2" format="Unimarc" type="Bibliographic">
+<mxc:leader>     cam0 22        450 </mxc:leader>
+<mxc:controlfield tag="001">FRBNF31601353</mxc:controlfield>
+<mxc:datafield tag="200" ind1="1" ind2=" "><mxc:subfield code="a">Impressions de Sicile</mxc:subfield><mxc:subfield code="f">Princesse Marie Wolkonsky</mxc:subfield></mxc:datafield>
+<mxc:datafield tag="210" ind1=" " ind2=" "><mxc:subfield code="a">Paris</mxc:subfield><mxc:subfield code="c">Hachette</mxc:subfield><mxc:subfield code="d">1914</mxc:subfield></mxc:datafield>
+<mxc:datafield tag="700" ind1=" " ind2="|"><mxc:subfield code="a">Volkonska\xc3\xafa</mxc:subfield><mxc:subfield code="b">Mari\xc4\x83</mxc:subfield><mxc:subfield code="f">18..-19..</mxc:subfield><mxc:subfield code="4">0070</mxc:subfield></mxc:datafield>
+<mxc:datafield tag="856" ind1=" " ind2=" "><mxc:subfield code="u">http://gallica.bnf.fr/ark:/12148/bpt6k206840w</mxc:subfield></mxc:datafield>
+<mxc:datafield tag="930" ind1=" " ind2=" "><mxc:subfield code="a">FOL-K-1108</mxc:subfield></mxc:datafield>
+</mxc:record>
+</srw:recordData>
+<srw:recordIdentifier>ark:/12148/cb316013536</srw:recordIdentifier>
+<srw:recordPosition>1</srw:recordPosition>
+</srw:record>"""
+
+
+def recorded_records():
+    """Give the recorded srw:record of each schema"""
+    tree = etree.parse(RECORDED_DC)
+    record = tree.find('.//{%s}record' % SRW)
+    return {
+        'dublincore': etree.tostring(record),
+        'unimarcXchange': UNIMARC_RECORD,
+    }
+
+
+class SRUStandIn(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server answering searchRetrieve requests with numberOfRecords
+    records, each one being a copy of the recorded record of the schema.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, num_records=200, latency=0.02, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), SRUHandler)
+        self.num_records = num_records
+        self.latency = latency
+        self.records = recorded_records()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:%d" % self.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def answer(self, params):
+        """Build the searchRetrieveResponse for the request parameters"""
+        start = int(params.get('startRecord', ['1'])[0])
+        maximum = int(params.get('maximumRecords', ['1'])[0])
+        schema = params.get('recordSchema', ['dublincore'])[0]
+        record = self.records.get(schema, self.records['dublincore'])
+        positions = range(start, min(start + maximum, self.num_records + 1))
+        body = [b'<?xml version="1.0" encoding="UTF-8"?>',
+                b'<srw:searchRetrieveResponse xmlns:srw="%s">' % SRW.encode('ascii'),
+                b'<srw:version>1.2</srw:version>',
+                b'<srw:numberOfRecords>%d</srw:numberOfRecords>' % self.num_records,
+                b'<srw:records>']
+        for position in positions:
+            body.append(record.replace(b'<srw:recordPosition>1<',
+                                       b'<srw:recordPosition>%d<' % position))
+        body.append(b'</srw:records>')
+        if positions and positions[-1] < self.num_records:
+            body.append(b'<srw:nextRecordPosition>%d</srw:nextRecordPosition>'
+                        % (positions[-1] + 1))
+        body.append(b'</srw:searchRetrieveResponse>')
+        return b'\n'.join(body)
+
+
+class SRUHandler(BaseHTTPRequestHandler):
+    """Handler of the requests sent to the stand-in"""
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        body = self.server.answer(parse_qs(urlparse(self.path).query))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,44 @@
+#!python
+# Retrieve the manifests of many arks, given on the command line, in a file
+# (one ark by line) or found by a channel search
+# Usage: ./bulk_retrieve.py [--file FILE] [--channel CHANNEL --period PERIOD] [ark ...]
+import argparse
+import sys
+from SPARMETSViewer import app
+from SPARMETSViewer.bulk import queue_bulk, BulkRetrieval
+from SPARMETSViewer.views import channel_arks
+
+
+def report(job):
+    print('%s\t%s\t%s' % (job.ark, job.status, job.error or job.metsfile))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk retrieval of manifests')
+    parser.add_argument('arks', nargs='*', help='arks (with or without the prefix)')
+    parser.add_argument('--file', help='file of arks, one by line')
+    parser.add_argument('--channel', help='channel searched for the arks')
+    parser.add_argument('--period', help='period of the channel search')
+    parser.add_argument('--nickname', help='nickname of the METS')
+    parser.add_argument('--downloads', type=int, help='manifests downloaded at the same time')
+    parser.add_argument('--parsers', type=int, help='processes parsing the manifests')
+    args = parser.parse_args()
+
+    with app.app_context():
+        arks = list(args.arks)
+        if args.file:
+            with open(args.file) as f:
+                arks += [line.strip() for line in f if line.strip()]
+        if args.channel:
+            content = {'filter': {'channel': args.channel}}
+            if args.period:
+                content['filter']['period'] = args.period
+            arks += channel_arks(content)
+        if not arks:
+            parser.error('no arks')
+        batch, count = queue_bulk(arks, args.nickname)
+        print('Batch %s: %d arks' % (batch, count))
+        counts = BulkRetrieval(batch, downloads=args.downloads, parsers=args.parsers,
+                               report=report).run()
+        print(', '.join('%s: %d' % item for item in sorted(counts.items())))
@@ -16,6 +16,95 @@ REPORT_ENDPOINT = 'http://localhost:5000/static/samples/sparqlResponseReport.jso
 GRAPH_TESTFILE = 'http://localhost:5000/static/samples/bpt6k206840w.rdf.json'
 NODES_TESTFILE = 'http://localhost:5000/static/samples/bpt6k206840w.nodes.rdf.json'
 SPARQL_URL = 'http://localhost:5000/static/samples/bpt6k206840w.rdf.json'
+# Number of threads used to run in parallel the SPARQL queries of a request
+QUERY_WORKERS = 8
+# Time (in seconds) during which the count of results of a channel is kept
+TOTALS_CACHE_TIMEOUT = 600
+# Maximum number of counts of results kept in memory
+TOTALS_CACHE_SIZE = 1000
+# Size (in bytes) of the chunks used to stream upstream responses
+STREAM_CHUNK_SIZE = 65536
+# Maximum number of nodes of a compact graph and of values per labels query
+GRAPH_MAX_NODES = 2000
+LABELS_BATCH_SIZE = 200
+# Number of records fetched by each request to the SRU endpoints
+SRU_PAGE_SIZE = 50
+# Number of following SRU pages requested in parallel while a page is read
+SRU_PREFETCH_PAGES = 3
+# Number of threads shared by the prefetching of the SRU pages
+SRU_PREFETCH_WORKERS = 8
+# Time (in seconds) during which the bib records (and the unknown arks) are kept
+BIB_CACHE_TIMEOUT = 86400
+BIB_CACHE_NEGATIVE_TIMEOUT = 600
+# Maximum number of bib records kept in memory
+BIB_CACHE_SIZE = 10000
+# Number of arks looked up by each query of a batch of bib records
+BIB_BATCH_SIZE = 20
+# Number of rows asked to the SPARQL endpoint by each page of an export
+EXPORT_PAGE_SIZE = 1000
+# Timeouts (connect, read in seconds) of the calls to the external services
+OUTBOUND_TIMEOUTS = {
+    'sparql': (5, 60),
+    'sru': (5, 30),
+    'access': (5, 120),
+    'default': (5, 30),
+}
+# Number of retries of a failed GET and base (in seconds) of the backoff between them
+OUTBOUND_RETRIES = 2
+OUTBOUND_BACKOFF = 0.5
+# Consecutive failures opening the circuit of a service, and time before trying again
+BREAKER_FAILURES = 5
+BREAKER_RESET_TIMEOUT = 30
+# Connections (and idle ones kept open) of the client of the asynchronous proxy routes
+ASYNC_MAX_CONNECTIONS = 200
+ASYNC_MAX_KEEPALIVE = 50
+# Worker processes started to run the ingests (0 if run apart with ingest_worker.py)
+INGEST_WORKERS = 2
+# Time (in seconds) between two checks of the ingest queue by an idle worker
+INGEST_POLL_INTERVAL = 1
+# Time (in seconds) between two looks of the web process for the jobs done, whose bib
+# records are then prefetched (0 to prefetch none)
+JOB_WARMUP_INTERVAL = 10
+# Number of manifests downloaded at the same time by a bulk retrieval
+BULK_DOWNLOADS = 8
+# Number of processes parsing the manifests of a bulk retrieval
+BULK_PARSERS = 2
+# Number of METS stored in one transaction by a bulk retrieval
+BULK_INSERT_BATCH = 20
+# Maximum number of arks of a bulk retrieval
+BULK_MAX_ARKS = 1000
+# Folder polled for manifests (*.xml, *.xml.gz) to ingest by watch_folder.py
+WATCH_FOLDER = None
+# Time (in seconds) between two polls of the watch folder
+WATCH_INTERVAL = 5
+# Nickname given to the METS ingested from the watch folder
+WATCH_NICKNAME = None
+# Folder keeping the raw manifests compressed (None to keep none)
+MANIFEST_STORE = os.path.join(basedir, 'manifests')
+# Extract only a summary of the METS at ingest, the details of the files and the
+# structMap being extracted from the stored manifest when first shown
+LAZY_PARSING = False
+# Number of processes running the extractors again in reprocess.py
+REPROCESS_WORKERS = 4
+# Folder where each process saves its metrics, summed by /metrics (None: the metrics
+# of the process answering only); empty it when the service is started
+METRICS_DIR = None
+# Seconds between two saves of the metrics of a process in METRICS_DIR
+METRICS_SAVE_INTERVAL = 5
+# Folder of the profiles of requests (None to profile none)
+PROFILE_DIR = os.path.join(basedir, 'profiles')
+# Value of the X-Profile header or of the profile parameter asking the profile of a
+# request (None: not asked by requests)
+PROFILE_TOKEN = None
+# Part of the requests profiled at random (0.01 for 1%)
+PROFILE_SAMPLE_RATE = 0
+# Number of profiles kept, and of top functions given by each
+PROFILE_KEEP = 200
+PROFILE_TOP = 30
+# Queries to the SPARQL and SRU endpoints taking more than this (in seconds) are logged
+# in the database (None to log none), and the days they are kept
+SLOW_QUERY_THRESHOLD = 2
+SLOW_QUERY_DAYS = 30
 ARK_PREFIX = 'ark:/12148/'
 ALLOWED_EXTENSIONS = set(['xml'])
 # available languages
@@ -0,0 +1,115 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+# Report aggregates (user-038)
+aggregate_watermark = Table('aggregate_watermark', post_meta,
+    Column('name', String(length=120), primary_key=True, nullable=False),
+    Column('date', String(length=64)),
+    Column('refreshed', DateTime),
+)
+
+report_aggregate = Table('report_aggregate', post_meta,
+    Column('channel', String(length=255), primary_key=True, nullable=False),
+    Column('month', String(length=7), primary_key=True, nullable=False),
+    Column('name', String(length=120)),
+    Column('packages', Integer, default=ColumnDefault(0)),
+    Column('files', BigInteger, default=ColumnDefault(0)),
+    Column('size', BigInteger, default=ColumnDefault(0)),
+)
+
+# Ingest queue (user-041)
+ingest_job = Table('ingest_job', post_meta,
+    Column('id', String(length=32), primary_key=True, nullable=False),
+    Column('kind', String(length=16)),
+    Column('source', String(length=1024)),
+    Column('ark', String(length=120)),
+    Column('batch', String(length=32), index=True),
+    Column('metsfile', String(length=120)),
+    Column('nickname', String(length=120)),
+    Column('status', String(length=16), index=True),
+    Column('phase', String(length=16)),
+    Column('bytes_done', BigInteger, default=ColumnDefault(0)),
+    Column('bytes_total', BigInteger, default=ColumnDefault(0)),
+    Column('files_done', Integer, default=ColumnDefault(0)),
+    Column('files_total', Integer, default=ColumnDefault(0)),
+    Column('error', String(length=255)),
+    Column('worker', Integer),
+    Column('created', DateTime),
+    Column('updated', DateTime),
+)
+
+# Watch folder (user-043)
+watched_file = Table('watched_file', post_meta,
+    Column('sha256', String(length=64), primary_key=True, nullable=False),
+    Column('path', String(length=1024)),
+    Column('job', String(length=32)),
+    Column('status', String(length=16), index=True),
+    Column('error', String(length=255)),
+    Column('created', DateTime),
+    Column('updated', DateTime),
+)
+
+# Slow queries (user-050)
+slow_query = Table('slow_query', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('created', DateTime, index=True),
+    Column('upstream', String(length=16)),
+    Column('host', String(length=255)),
+    Column('fingerprint', String(length=40), index=True),
+    Column('normalized', Text),
+    Column('text', Text),
+    Column('duration', Float),
+    Column('size', BigInteger),
+    Column('status', String(length=16)),
+)
+
+# Stored manifest (user-044), lazy details (user-045) and parse timings (user-047)
+METS = Table('METS', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('metsfile', String(length=120)),
+    Column('nickname', String(length=120)),
+    Column('level', String(length=120)),
+    Column('metslist', PickleType),
+    Column('dcmetadata', PickleType),
+    Column('divs', PickleType),
+    Column('originalfilecount', Integer),
+    Column('manifest', String(length=64)),
+    Column('detailed', Boolean, default=ColumnDefault(True)),
+    Column('timings', PickleType),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['aggregate_watermark'].create()
+    post_meta.tables['ingest_job'].create()
+    post_meta.tables['report_aggregate'].create()
+    post_meta.tables['slow_query'].create()
+    post_meta.tables['watched_file'].create()
+    post_meta.tables['METS'].columns['detailed'].create(populate_default=False)
+    # The METS already ingested are detailed
+    migrate_engine.execute(METS.update().values(detailed=True))
+    post_meta.tables['METS'].columns['manifest'].create(index_name='ix_METS_manifest')
+    post_meta.tables['METS'].columns['timings'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['aggregate_watermark'].drop()
+    post_meta.tables['ingest_job'].drop()
+    post_meta.tables['report_aggregate'].drop()
+    post_meta.tables['slow_query'].drop()
+    post_meta.tables['watched_file'].drop()
+    post_meta.tables['METS'].columns['detailed'].drop()
+    Index('ix_METS_manifest', post_meta.tables['METS'].columns['manifest']).drop()
+    post_meta.tables['METS'].columns['manifest'].drop()
+    post_meta.tables['METS'].columns['timings'].drop()
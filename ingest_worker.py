@@ -0,0 +1,9 @@
+#!python
+# Run the ingest workers apart from the web application (with INGEST_WORKERS = 0)
+# Usage: ./ingest_worker.py [number of processes]
+import sys
+from SPARMETSViewer.ingestqueue import start_workers
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for worker in start_workers(count):
+        worker.join()
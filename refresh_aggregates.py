@@ -0,0 +1,8 @@
+#!python
+from SPARMETSViewer import app, db
+from SPARMETSViewer.aggregates import refresh_aggregates, aggregates_status
+with app.app_context():
+    db.create_all()
+    updated = refresh_aggregates()
+    print('Aggregates updated: ' + str(updated))
+    print('Last ingest aggregated: ' + str(aggregates_status()['last_ingest']))
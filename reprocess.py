@@ -0,0 +1,23 @@
+#!python
+# Run again some extractors (e.g. parse_file_xmp) on the stored manifests
+# Usage: ./reprocess.py [--workers N] [--mets METSFILE ...] extractor [extractor ...]
+import argparse
+from SPARMETSViewer import app
+from SPARMETSViewer.parsemets import METSFile
+from SPARMETSViewer.reprocess import reprocess
+
+
+def report(mets_instance, error):
+    print('%s\t%s' % (mets_instance.metsfile, error or 'done'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reprocessing of the stored manifests')
+    parser.add_argument('extractors', nargs='+', choices=METSFile.REEXTRACTORS)
+    parser.add_argument('--mets', action='append', help='METS file to reprocess (default all)')
+    parser.add_argument('--workers', type=int, help='processes running the extractors')
+    args = parser.parse_args()
+
+    with app.app_context():
+        counts = reprocess(args.extractors, args.mets, args.workers, report=report)
+        print(', '.join('%s: %d' % item for item in sorted(counts.items())))
@@ -1,3 +1,4 @@
 #!python
 from SPARMETSViewer import app
-app.run(debug=True, host='0.0.0.0')
+if __name__ == '__main__':
+    app.run(debug=True, host='0.0.0.0')
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Report aggregates compared with the live report query, on a small RDF dataset."""
+
+import json
+
+import pytest
+
+rdflib = pytest.importorskip('rdflib')
+
+from SPARMETSViewer import app, aggregates, db  # noqa: E402
+from SPARMETSViewer.aggregates import refresh_aggregates, report_from_aggregates  # noqa: E402
+
+CHANNEL = 'info:bnf/spar/context/test'
+PREFIXES = """
+PREFIX sparcontext: <info:bnf/spar/context#>
+PREFIX sparprovenance: <info:bnf/spar/provenance#>
+PREFIX sparfixity: <info:bnf/spar/fixity#>
+PREFIX dc: <http://purl.org/dc/elements/1.1/>
+PREFIX owl: <http://www.w3.org/2002/07/owl#>
+PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+"""
+
+
+def live_query(channel, period):
+    """Query of report.html (with the GROUP BY left implicit there)"""
+    return ("SELECT (STRAFTER(STR(?uri), 'context/') AS ?channel) "
+            " (COUNT(?p) AS ?packages) (SUM(xsd:integer(?n_files)) AS ?files) "
+            " (SUM(xsd:integer(?size_p)) AS ?size) "
+            "WHERE { "
+            " { SELECT ?uri ?p ?n_files ?size_p " + ("(max(?date) AS ?dc) " if period else "") +
+            "   WHERE { GRAPH ?g { "
+            "     ?p sparcontext:isMemberOf ?c."
+            "     OPTIONAL { ?p sparfixity:size ?size_p } "
+            "     OPTIONAL { ?p sparfixity:fileCount ?n_files } " +
+            ("     ?p sparprovenance:hasEvent ?e. ?e a sparprovenance:ingestCompletion." if period
+             else "") +
+            ("     ?e dc:date ?date." if period else "") +
+            "   }"
+            "   ?c a sparcontext:channel. ?c owl:sameAs ?uri."
+            "   VALUES ?c { <" + channel + ">}" +
+            (" } GROUP BY ?uri ?p ?n_files ?size_p }" if period else " } }") +
+            (" FILTER (STRSTARTS(STR(?dc), '" + period + "'))" if period else "") +
+            " } LIMIT 10")
+
+
+class Endpoint(object):
+    """Dataset of packages answering the SPARQL queries"""
+
+    def __init__(self):
+        self.ns = dict((name, rdflib.Namespace(uri)) for name, uri in (
+            ('context', 'info:bnf/spar/context#'),
+            ('provenance', 'info:bnf/spar/provenance#'),
+            ('fixity', 'info:bnf/spar/fixity#'),
+            ('dc', 'http://purl.org/dc/elements/1.1/')))
+        self.dataset = rdflib.Dataset()
+        channel = rdflib.URIRef('info:channel/test')
+        self.dataset.add((channel, rdflib.RDF.type, self.ns['context'].channel))
+        self.dataset.add((channel, rdflib.OWL.sameAs, rdflib.URIRef(CHANNEL)))
+        self.channel = channel
+
+    def package(self, name, *dates):
+        graph = self.dataset.graph(rdflib.URIRef('info:graph/%s' % name))
+        package = rdflib.URIRef('info:package/%s' % name)
+        graph.add((package, self.ns['context'].isMemberOf, self.channel))
+        graph.add((package, self.ns['fixity'].size, rdflib.Literal(100)))
+        graph.add((package, self.ns['fixity'].fileCount, rdflib.Literal(3)))
+        self.ingest(name, *dates)
+
+    def ingest(self, name, *dates):
+        graph = self.dataset.graph(rdflib.URIRef('info:graph/%s' % name))
+        package = rdflib.URIRef('info:package/%s' % name)
+        for date in dates:
+            event = rdflib.URIRef('info:event/%s/%s' % (name, date))
+            graph.add((package, self.ns['provenance'].hasEvent, event))
+            graph.add((event, rdflib.RDF.type, self.ns['provenance'].ingestCompletion))
+            graph.add((event, self.ns['dc'].date, rdflib.Literal(date)))
+
+    def query(self, text):
+        return json.loads(self.dataset.query(PREFIXES + text).serialize(format='json'))
+
+    def live(self, period=None):
+        bindings = self.query(live_query(str(self.channel), period))['results']['bindings']
+        return dict((key, int(bindings[0][key]['value']) if key in bindings[0] else 0)
+                    for key in ('packages', 'files', 'size'))
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, result):
+        self.result = result
+
+    def json(self):
+        return self.result
+
+
+@pytest.fixture
+def endpoint(monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI',
+                        'sqlite:///' + str(tmp_path / 'aggregates.db'))
+    endpoint = Endpoint()
+    monkeypatch.setattr(aggregates, 'sparql_get', lambda url, text: FakeResponse(
+        endpoint.query(text)))
+    with app.app_context():
+        db.create_all()
+        yield endpoint
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+
+
+def assert_same_reports(endpoint):
+    for period in (None, '2020', '2020-01', '2020-02', '2020-03', '2021', '2021-01'):
+        report = report_from_aggregates(str(endpoint.channel), period)
+        live = endpoint.live(period)
+        if live['packages'] == 0:
+            assert report == []
+        else:
+            assert report[0]['packages'] == live['packages'], period
+            assert report[0]['files'] == live['files'], period
+            assert report[0]['size'] == live['size'], period
+
+
+def test_refresh_matches_live_report(endpoint):
+    endpoint.package('a', '2020-01-10')
+    endpoint.package('b', '2020-01-15', '2020-02-03')
+    endpoint.package('c', '2020-02-20')
+    refresh_aggregates('sparql')
+    assert_same_reports(endpoint)
+
+    # A package ingested again moves to the month of its latest ingest
+    endpoint.ingest('a', '2020-03-01')
+    endpoint.package('d', '2020-03-02')
+    refresh_aggregates('sparql')
+    assert_same_reports(endpoint)
+
+    endpoint.ingest('c', '2021-01-05')
+    endpoint.ingest('b', '2021-01-06')
+    refresh_aggregates('sparql')
+    assert_same_reports(endpoint)
+    # Nothing new
+    assert refresh_aggregates('sparql') == 0
+    assert_same_reports(endpoint)
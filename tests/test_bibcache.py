@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Bib records fetched by batches, with a stand-in SRU endpoint."""
+
+import re
+
+import pytest
+
+from SPARMETSViewer import app, bibcache, srusimple
+from SPARMETSViewer.bibcache import BIB_CACHE, fetch_bib_records, get_bib_record
+
+KNOWN = ['ark:/12148/cb%d' % i for i in range(3)]
+UNKNOWN = ['ark:/12148/cb%d' % i for i in range(10, 15)]
+ARK_REGEX = re.compile(r'ark:/12148/cb\d+')
+
+
+def sru_response(arks, num_records):
+    records = "".join("""
+      <srw:record>
+        <srw:recordData>
+          <oai_dc:dc><dc:identifier>https://catalogue.bnf.fr/%s</dc:identifier>
+            <dc:title>Title of %s</dc:title></oai_dc:dc>
+        </srw:recordData>
+        <srw:recordIdentifier>%s</srw:recordIdentifier>
+      </srw:record>""" % (ark, ark, ark) for ark in arks)
+    return ("""<srw:searchRetrieveResponse xmlns:srw="http://www.loc.gov/zing/srw/"
+        xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+        xmlns:dc="http://purl.org/dc/elements/1.1/">
+      <srw:numberOfRecords>%d</srw:numberOfRecords>
+      <srw:records>%s</srw:records>
+    </srw:searchRetrieveResponse>""" % (num_records, records)).encode('utf-8')
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+
+@pytest.fixture
+def sru(monkeypatch):
+    """Endpoint knowing the KNOWN arks; extra records make the batches truncated"""
+    requests = []
+    endpoint = {'extra': 0}
+
+    def get(upstream, url, params):
+        requests.append(params['query'])
+        arks = [ark for ark in ARK_REGEX.findall(params['query']) if ark in KNOWN]
+        extra = endpoint['extra'] if ' any ' in params['query'] else 0
+        return FakeResponse(sru_response(arks, len(arks) + extra))
+
+    monkeypatch.setattr(srusimple, 'http_get', get)
+    monkeypatch.setattr(srusimple.SRUSimple, 'DEBUG', False)
+    monkeypatch.setitem(app.config, 'BIB_BATCH_SIZE', 20)
+    BIB_CACHE.entries.clear()
+    yield endpoint, requests
+    BIB_CACHE.entries.clear()
+
+
+def test_complete_batch_is_trusted(sru):
+    endpoint, requests = sru
+    records = fetch_bib_records(KNOWN + UNKNOWN)
+    assert sorted(records) == KNOWN
+    # One request for the batch, none for the unknown arks
+    assert len(requests) == 1
+    for ark in UNKNOWN:
+        with pytest.raises(ValueError):
+            get_bib_record(ark)
+    assert len(requests) == 1
+    assert get_bib_record(KNOWN[0])
+
+
+def test_truncated_batch_looks_up_the_arks_left_out(sru):
+    endpoint, requests = sru
+    endpoint['extra'] = 1
+    records = fetch_bib_records(KNOWN + UNKNOWN)
+    assert sorted(records) == KNOWN
+    assert len(requests) == 1 + len(UNKNOWN)
+    # Not found by their own lookup: kept as not found
+    for ark in UNKNOWN:
+        assert ark in bibcache.BIB_CACHE
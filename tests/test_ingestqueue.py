@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Claim of the queued jobs by the ingest workers."""
+
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from SPARMETSViewer import app, db
+from SPARMETSViewer.ingestqueue import claim_job, requeue_lost_jobs
+from SPARMETSViewer.models import IngestJob
+
+START = datetime(2020, 1, 1)
+# Pid of no process
+DEAD_PID = 2 ** 30
+
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI',
+                        'sqlite:///' + str(tmp_path / 'queue.db'))
+    monkeypatch.setitem(app.config, 'INGEST_WORKERS', 0)
+    with app.app_context():
+        db.create_all()
+
+        def add(job_id, kind='upload', minutes=0, status='queued', worker=None):
+            job = IngestJob(job_id, kind, '/tmp/' + job_id, job_id + '.xml', 'test',
+                            START + timedelta(minutes=minutes))
+            job.status = status
+            job.worker = worker
+            db.session.add(job)
+            db.session.commit()
+            return job
+
+        yield add
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+
+
+def test_oldest_worker_job_is_claimed_once(queue):
+    queue('second', minutes=2)
+    queue('first', kind='ark', minutes=1)
+    queue('bulk', kind='bulk', minutes=0)
+    queue('done', minutes=0, status='done')
+    job = claim_job()
+    assert job.id == 'first'
+    assert job.status == 'running'
+    assert job.worker == os.getpid()
+    assert claim_job().id == 'second'
+    # The jobs of a bulk retrieval are left to it
+    assert claim_job() is None
+    assert IngestJob.query.get('bulk').status == 'queued'
+
+
+def test_job_taken_by_another_worker_is_not_claimed(queue):
+    queue('only')
+    # Connection of the other worker
+    other = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    def other_worker_first(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE ingest_job'):
+            with other.begin() as connection:
+                connection.exec_driver_sql(
+                    "UPDATE ingest_job SET status = 'running', worker = 1 WHERE id = 'only'")
+
+    event.listen(db.engine, 'before_cursor_execute', other_worker_first)
+    try:
+        assert claim_job() is None
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', other_worker_first)
+        other.dispose()
+    db.session.expire_all()
+    assert IngestJob.query.get('only').worker == 1
+
+
+def test_jobs_of_dead_workers_are_queued_again(queue):
+    queue('lost', status='running', worker=DEAD_PID)
+    queue('alive', status='running', worker=os.getpid())
+    queue('bulk', kind='bulk', status='running', worker=DEAD_PID)
+    requeue_lost_jobs()
+    assert IngestJob.query.get('lost').status == 'queued'
+    assert IngestJob.query.get('alive').status == 'running'
+    assert IngestJob.query.get('bulk').status == 'failed'
+    assert claim_job().id == 'lost'
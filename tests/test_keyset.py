@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Keyset pagination of the channel searches, run on a small RDF dataset."""
+
+import io
+import json
+
+import pytest
+
+rdflib = pytest.importorskip('rdflib')
+
+from SPARMETSViewer import app, views  # noqa: E402
+
+CHANNEL = 'info:bnf/spar/channel/test'
+PREFIXES = """
+PREFIX sparcontext: <info:bnf/spar/context#>
+PREFIX sparstructure: <info:bnf/spar/structure#>
+PREFIX sparprovenance: <info:bnf/spar/provenance#>
+PREFIX dc: <http://purl.org/dc/elements/1.1/>
+"""
+# Packages with two ingests each (some on the same date) and two relations
+DATES = ['2020-01-01', '2020-01-01', '2020-02-01', '2020-02-01', '2020-03-01']
+
+
+def build_dataset():
+    context = rdflib.Namespace('info:bnf/spar/context#')
+    structure = rdflib.Namespace('info:bnf/spar/structure#')
+    provenance = rdflib.Namespace('info:bnf/spar/provenance#')
+    dc = rdflib.Namespace('http://purl.org/dc/elements/1.1/')
+    dataset = rdflib.Dataset()
+    for i, date in enumerate(DATES):
+        ark = rdflib.URIRef('info:ark:/12148/bpt6k%d' % i)
+        version = rdflib.URIRef('%s.version0' % ark)
+        group = rdflib.URIRef('%s.release0' % ark)
+        dataset.add((ark, context.hasLastVersion, version))
+        dataset.add((version, context.hasLastRelease, group))
+        graph = dataset.graph(rdflib.URIRef('%s.graph' % ark))
+        graph.add((group, rdflib.RDF.type, structure.group))
+        graph.add((group, context.isMemberOf, rdflib.URIRef(CHANNEL)))
+        for j, day in enumerate((date, '2021-0%d-01' % (i % 2 + 1))):
+            event = rdflib.URIRef('%s.ingest%d' % (group, j))
+            graph.add((group, provenance.hasEvent, event))
+            graph.add((event, rdflib.RDF.type, provenance.ingestCompletion))
+            graph.add((event, dc.date, rdflib.Literal(day)))
+        for record in ('cb1', 'cb2'):
+            graph.add((group, dc.relation, rdflib.URIRef('ark:/12148/%s%d' % (record, i))))
+    return dataset
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+        self.raw = io.BytesIO(body)
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sparql(monkeypatch):
+    dataset = build_dataset()
+    queries = []
+
+    def query(endpoint, text):
+        queries.append(text)
+        return FakeResponse(dataset.query(PREFIXES + text).serialize(format='json'))
+
+    monkeypatch.setitem(app.config, 'ACCESS_PLATFORM', 'PFO')
+    monkeypatch.setitem(app.config, 'EXPORT_PAGE_SIZE', 2)
+    monkeypatch.setattr(views, 'sparql_get', query)
+    monkeypatch.setattr(views, 'sparql_stream', query)
+    return dataset, queries
+
+
+def all_rows(dataset, columns):
+    text = views.custom_select(CHANNEL, *views.custom_query_parts(
+        {'filter': {'channel': CHANNEL}, 'columns': columns}))
+    return views.from_sparql_results_to_json(
+        json.loads(dataset.query(PREFIXES + text).serialize(format='json')))
+
+
+def sorted_rows(rows):
+    return sorted(json.dumps(row, sort_keys=True) for row in rows)
+
+
+@pytest.mark.parametrize('order', ['ark', 'ingest_date'])
+def test_cursor_walks_all_rows(sparql, order):
+    dataset, queries = sparql
+    columns = ['ingest_date', 'record_no']
+    expected = all_rows(dataset, columns)
+    assert len(expected) == 20
+
+    client = app.test_client()
+    rows = []
+    cursor = None
+    pages = 0
+    while True:
+        content = {'filter': {'channel': CHANNEL}, 'columns': columns,
+                   'order': order, 'limit': 2, 'total': len(expected)}
+        if cursor:
+            content['cursor'] = cursor
+        response = client.post('/customquery', json=content)
+        assert response.status_code == 200
+        page = response.get_json()
+        # Only the page after a full last page is empty
+        assert page['rows'] or page['cursor'] is None
+        rows += page['rows']
+        pages += 1
+        cursor = page['cursor']
+        if cursor is None:
+            break
+        assert pages < 10
+    assert pages >= 3
+    assert sorted_rows(rows) == sorted_rows(expected)
+
+
+def test_export_and_channel_arks_read_all_pages(sparql):
+    dataset, queries = sparql
+    expected = all_rows(dataset, ['record_no'])
+    with app.test_request_context():
+        rows = list(views.custom_query_rows(
+            {'filter': {'channel': CHANNEL}, 'columns': ['record_no']}))
+        assert len(queries) == 3
+        arks = views.channel_arks({'filter': {'channel': CHANNEL}})
+    assert sorted_rows(rows) == sorted_rows(expected)
+    assert arks == ['info:ark:/12148/bpt6k%d' % i for i in range(len(DATES))]
+
+
+@pytest.mark.parametrize('order, keys', [('ark', 5), ('ingest_date', 10)])
+def test_total_and_offsets_count_keys(sparql, order, keys):
+    # Each package has two ingests: the total counts the keys, not the rows
+    dataset, queries = sparql
+    columns = ['ingest_date', 'record_no']
+    expected = all_rows(dataset, columns)
+    client = app.test_client()
+    rows = []
+    pages = []
+    offset = 0
+    while True:
+        response = client.post('/customquery', json={
+            'filter': {'channel': CHANNEL}, 'columns': columns, 'order': order,
+            'limit': 2, 'offset': offset})
+        assert response.status_code == 200
+        page = response.get_json()
+        assert page['total'] == keys
+        if not page['rows']:
+            break
+        pages.append(page_keys(order, page['rows']))
+        rows += page['rows']
+        offset += 2
+    # Pages of 2 keys, none empty before the last one
+    assert pages == [2] * (keys // 2) + [keys % 2] * (keys % 2)
+    assert sorted_rows(rows) == sorted_rows(expected)
+
+
+def page_keys(order, rows):
+    return len(set(tuple(row[var] for var in views.KEYSET_ORDERS[order]) for row in rows))
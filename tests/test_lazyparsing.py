@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Details of a METS ingested in summary mode, extracted on demand from the stored manifest."""
+
+import os
+
+import pytest
+
+from SPARMETSViewer import app, db
+from SPARMETSViewer.manifeststore import manifest_path
+from SPARMETSViewer.models import METS
+from SPARMETSViewer.parsemets import METSFile, complete_mets
+from benchmarks.metsgenerator import generate_mets
+
+
+@pytest.fixture
+def manifest(monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI',
+                        'sqlite:///' + str(tmp_path / 'lazy.db'))
+    monkeypatch.setitem(app.config, 'MANIFEST_STORE', str(tmp_path / 'manifests'))
+    monkeypatch.setitem(app.config, 'LAZY_PARSING', True)
+    path = str(tmp_path / 'lazy.xml')
+    generate_mets(path, files=5, events=2, objects=2, ark='bpt6klazy')
+    with app.app_context():
+        db.create_all()
+        yield path
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+
+
+def ingest(path, summary):
+    assert METSFile(path, 'lazy.xml', 'test', summary=summary).parse_mets()
+    return METS.query.filter_by(metsfile='lazy.xml').one()
+
+
+def test_details_match_a_full_parse(manifest):
+    mets_instance = ingest(manifest, True)
+    assert mets_instance.detailed is False
+    assert mets_instance.manifest is not None
+    summary = mets_instance.metslist
+    complete_mets(mets_instance)
+    db.session.expire_all()
+    completed = METS.query.filter_by(metsfile='lazy.xml').one()
+    assert completed.detailed is True
+    assert 'details' in completed.timings['phases']
+    assert completed.metslist != summary
+    lazy = (completed.metslist, completed.divs, completed.originalfilecount)
+    # Once only
+    assert complete_mets(completed) is completed
+
+    db.session.delete(completed)
+    db.session.commit()
+    full = ingest(manifest, False)
+    assert full.detailed is True
+    assert lazy == (full.metslist, full.divs, full.originalfilecount)
+
+
+@pytest.mark.parametrize('damage', ['missing', 'unreadable'])
+def test_details_unavailable_without_the_manifest(manifest, damage):
+    mets_instance = ingest(manifest, True)
+    summary = mets_instance.metslist
+    stored = manifest_path(mets_instance.manifest)
+    if damage == 'missing':
+        os.remove(stored)
+    else:
+        with open(stored, 'wb') as f:
+            f.write(b'not a gzipped manifest')
+    assert complete_mets(mets_instance) is mets_instance
+    db.session.expire_all()
+    mets_instance = METS.query.filter_by(metsfile='lazy.xml').one()
+    assert mets_instance.detailed is False
+    assert mets_instance.metslist == summary
+
+    client = app.test_client()
+    response = client.get('/aip/lazy.xml/structure')
+    assert response.status_code == 200
+    assert b'Structure unavailable' in response.data
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Manifests kept gzipped in the store, named by the hash of their content."""
+
+import gzip
+import os
+
+import pytest
+
+from SPARMETSViewer import app
+from SPARMETSViewer.manifeststore import file_hash, has_manifest, manifest_path, store_manifest
+
+MANIFEST = b'<mets:mets xmlns:mets="http://www.loc.gov/METS/"/>\n'
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'MANIFEST_STORE', str(tmp_path / 'manifests'))
+    return tmp_path
+
+
+def stored_files(store):
+    return [name for _, _, names in os.walk(str(store / 'manifests')) for name in names]
+
+
+def test_same_content_is_stored_once(store):
+    first = store / 'a.xml'
+    first.write_bytes(MANIFEST)
+    second = store / 'b.xml'
+    second.write_bytes(MANIFEST)
+    digest = store_manifest(str(first))
+    assert digest == file_hash(str(first))
+    assert store_manifest(str(second)) == digest
+    assert has_manifest(digest)
+    assert stored_files(store) == [digest + '.xml.gz']
+    with gzip.open(manifest_path(digest), 'rb') as f:
+        assert f.read() == MANIFEST
+
+
+def test_no_store(store, monkeypatch):
+    monkeypatch.setitem(app.config, 'MANIFEST_STORE', None)
+    path = store / 'a.xml'
+    path.write_bytes(MANIFEST)
+    assert store_manifest(str(path)) is None
+    assert not has_manifest(None)
+
+
+def test_failed_copy_leaves_nothing(store, monkeypatch):
+    path = store / 'a.xml'
+    path.write_bytes(MANIFEST)
+
+    def copy_failed(source, target):
+        raise OSError("disk full")
+
+    monkeypatch.setattr('SPARMETSViewer.manifeststore.shutil.copyfileobj', copy_failed)
+    with pytest.raises(OSError):
+        store_manifest(str(path))
+    assert stored_files(store) == []
+    assert not has_manifest(file_hash(str(path)))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Metrics of all the processes summed by /metrics."""
+
+import re
+
+import pytest
+
+from SPARMETSViewer import app, views
+from SPARMETSViewer.ingestqueue import PROCESS_CONTEXT
+from SPARMETSViewer.metrics import REGISTRY
+
+
+def ingest_in_worker(folder, count):
+    """Record ingests in another process, as an ingest worker does"""
+    app.config['METRICS_DIR'] = folder
+    for i in range(count):
+        REGISTRY.inc('metsviewer_ingested_total')
+    REGISTRY.save()
+
+
+def sample(text, line):
+    match = re.search(r'^%s (\S+)$' % re.escape(line), text, re.MULTILINE)
+    return float(match.group(1)) if match else 0
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'METRICS_DIR', str(tmp_path / 'metrics'))
+    return app.test_client()
+
+
+def test_metrics_of_the_workers_are_summed(client, tmp_path):
+    before = sample(client.get('/metrics').get_data(as_text=True), 'metsviewer_ingested_total')
+    for count in (2, 3):
+        worker = PROCESS_CONTEXT.Process(target=ingest_in_worker,
+                                         args=(str(tmp_path / 'metrics'), count))
+        worker.start()
+        worker.join(60)
+        assert worker.exitcode == 0
+    REGISTRY.inc('metsviewer_ingested_total')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert sample(text, 'metsviewer_ingested_total') == before + 6
+
+
+def test_unhandled_error_is_counted_as_500(client, monkeypatch):
+    def broken(job_id):
+        raise RuntimeError("database gone")
+
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+    monkeypatch.setattr(views, 'get_job', broken)
+    line = 'metsviewer_requests_total{method="GET",route="/ingest/<job_id>",status="500"}'
+    before = sample(client.get('/metrics').get_data(as_text=True), line)
+    assert client.get('/ingest/lost').status_code == 500
+    text = client.get('/metrics').get_data(as_text=True)
+    assert sample(text, line) == before + 1
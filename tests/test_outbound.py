@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Retries and circuit breaking of the outbound calls, with a scripted upstream."""
+
+import pytest
+import requests
+
+from SPARMETSViewer import app, outbound
+from SPARMETSViewer.outbound import BREAKERS, CircuitBreaker, CircuitOpenError
+from SPARMETSViewer.outbound import get_breaker, http_get
+
+URL = 'http://upstream.test/sparql'
+
+
+class Interrupted(BaseException):
+    pass
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Upstream giving in turn the statuses (or raising the errors) of its script"""
+    script = []
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        answer = script.pop(0)
+        if callable(answer):
+            answer = answer()
+        if isinstance(answer, BaseException):
+            raise answer
+        return FakeResponse(answer)
+
+    monkeypatch.setattr(outbound.requests, 'get', get)
+    monkeypatch.setattr(outbound, 'backoff', lambda attempt: 0)
+    monkeypatch.setitem(app.config, 'SLOW_QUERY_THRESHOLD', None)
+    monkeypatch.setitem(app.config, 'OUTBOUND_RETRIES', 2)
+    monkeypatch.setitem(app.config, 'BREAKER_FAILURES', 2)
+    monkeypatch.setitem(app.config, 'BREAKER_RESET_TIMEOUT', 30)
+    BREAKERS.clear()
+    yield script, calls
+    BREAKERS.clear()
+
+
+def test_unhealthy_answers_are_retried(upstream):
+    script, calls = upstream
+    script.extend([503, 502, 200])
+    response = http_get('sparql', URL)
+    assert response.status_code == 200
+    assert len(calls) == 3
+    assert get_breaker('sparql', URL).stats() == {'state': 'closed', 'failures': 0, 'rejected': 0}
+
+
+def test_last_error_is_given_after_the_retries(upstream):
+    script, calls = upstream
+    script.extend([requests.ConnectionError("refused")] * 3 + [504] * 3)
+    with pytest.raises(requests.ConnectionError):
+        http_get('sparql', URL)
+    assert len(calls) == 3
+    # The last unhealthy answer is given back
+    assert http_get('sparql', URL).status_code == 504
+    assert len(calls) == 6
+    assert get_breaker('sparql', URL).state == CircuitBreaker.OPEN
+
+
+def test_client_errors_are_not_retried(upstream):
+    script, calls = upstream
+    script.extend([404])
+    assert http_get('sparql', URL).status_code == 404
+    assert len(calls) == 1
+
+
+def test_half_open_lets_one_trial_through(upstream, monkeypatch):
+    script, calls = upstream
+    monkeypatch.setitem(app.config, 'OUTBOUND_RETRIES', 0)
+    script.extend([503, 503])
+    http_get('sparql', URL)
+    http_get('sparql', URL)
+    breaker = get_breaker('sparql', URL)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        http_get('sparql', URL)
+    assert len(calls) == 2
+
+    # After the reset timeout, a failed trial opens the circuit again
+    breaker.opened_at -= 31
+    script.append(503)
+    assert http_get('sparql', URL).status_code == 503
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        http_get('sparql', URL)
+
+    # Only one trial at a time, and a successful one closes the circuit
+    breaker.opened_at -= 31
+    rejected = []
+
+    def concurrent_call():
+        with pytest.raises(CircuitOpenError):
+            http_get('sparql', URL)
+        rejected.append(breaker.state)
+        return 200
+
+    script.append(concurrent_call)
+    assert http_get('sparql', URL).status_code == 200
+    assert rejected == [CircuitBreaker.HALF_OPEN]
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert len(calls) == 4
+    assert breaker.stats()['rejected'] == 3
+
+
+def test_interrupted_trial_is_given_back(upstream):
+    script, calls = upstream
+    breaker = get_breaker('sparql', URL)
+    breaker.state = CircuitBreaker.OPEN
+    breaker.opened_at -= 31
+    script.append(Interrupted())
+    with pytest.raises(Interrupted):
+        http_get('sparql', URL)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    script.append(200)
+    assert http_get('sparql', URL).status_code == 200
+    assert breaker.state == CircuitBreaker.CLOSED
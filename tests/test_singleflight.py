@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Identical calls running at the same time share one upstream call."""
+
+import threading
+import time
+
+import pytest
+
+from SPARMETSViewer.singleflight import SingleFlight
+
+CALLERS = 5
+# Set by the upstream call when it starts, and to let it end
+started = threading.Event()
+release = threading.Event()
+
+
+def run_together(flight, key, function):
+    """Call the flight from CALLERS threads while the first call is running"""
+    results = []
+    errors = []
+
+    def caller():
+        try:
+            results.append(flight.do(key, function))
+        except Exception as e:
+            errors.append(e)
+
+    first = threading.Thread(target=caller)
+    first.start()
+    started.wait(5)
+    others = [threading.Thread(target=caller) for i in range(CALLERS - 1)]
+    for thread in others:
+        thread.start()
+    # Let the others wait for the call in flight before ending it
+    while flight.stats()['coalesced'] < CALLERS - 1:
+        time.sleep(0.01)
+    release.set()
+    for thread in [first] + others:
+        thread.join(5)
+    return results, errors
+
+
+@pytest.fixture(autouse=True)
+def events():
+    started.clear()
+    release.clear()
+
+
+def test_concurrent_calls_are_coalesced():
+    flight = SingleFlight('test')
+    calls = []
+
+    def function():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results, errors = run_together(flight, 'key', function)
+    assert results == ['result'] * CALLERS
+    assert errors == []
+    assert len(calls) == 1
+    assert flight.stats() == {'requests': CALLERS, 'upstream': 1, 'coalesced': CALLERS - 1,
+                              'in_flight': 0}
+    # Once done, a new call goes upstream
+    assert flight.do('key', function) == 'result'
+    assert len(calls) == 2
+
+
+def test_error_is_given_to_all_the_callers():
+    flight = SingleFlight('test')
+
+    def function():
+        started.set()
+        release.wait(5)
+        raise ValueError("upstream failed")
+
+    results, errors = run_together(flight, 'key', function)
+    assert results == []
+    assert len(errors) == CALLERS
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert flight.stats()['in_flight'] == 0
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Manifests dropped in a watch folder: taken once, and failures put aside."""
+
+import os
+import shutil
+
+import pytest
+
+from SPARMETSViewer import app, db, watchfolder
+from SPARMETSViewer.models import IngestJob, WatchedFile
+from SPARMETSViewer.watchfolder import FAILED_FOLDER, WatchFolder
+
+MANIFEST = b'<mets:mets xmlns:mets="http://www.loc.gov/METS/"/>'
+
+
+class Stop(Exception):
+    pass
+
+
+@pytest.fixture
+def folder(monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI',
+                        'sqlite:///' + str(tmp_path / 'watch.db'))
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setitem(app.config, 'INGEST_WORKERS', 0)
+    watched = tmp_path / 'watched'
+    watched.mkdir()
+    with app.app_context():
+        db.create_all()
+        yield watched
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+
+
+def test_manifest_is_queued_once(folder):
+    watch = WatchFolder(str(folder), 1, 'test')
+    (folder / 'a.xml').write_bytes(MANIFEST)
+    # Taken once its size and date are stable
+    assert watch.poll() == 0
+    assert watch.poll() == 1
+    assert watch.poll() == 0
+    # The same content under another name, or seen by a new watcher
+    shutil.copy(str(folder / 'a.xml'), str(folder / 'b.xml'))
+    assert watch.poll() == 0
+    assert watch.poll() == 0
+    restarted = WatchFolder(str(folder), 1, 'test')
+    assert restarted.poll() == 0
+    assert restarted.poll() == 0
+    assert IngestJob.query.count() == 1
+    assert WatchedFile.query.one().status == 'queued'
+
+
+def test_failures_are_put_aside(folder, monkeypatch):
+    watch = WatchFolder(str(folder), 1, 'test')
+    (folder / 'bad.xml.gz').write_bytes(b'<not-compressed/>')
+    (folder / 'unreadable.xml').write_bytes(b'<other/>')
+    (folder / 'good.xml').write_bytes(MANIFEST)
+    file_hash = watchfolder.file_hash
+
+    def hash_or_fail(path):
+        if path.endswith('unreadable.xml'):
+            raise PermissionError(path)
+        return file_hash(path)
+
+    monkeypatch.setattr(watchfolder, 'file_hash', hash_or_fail)
+    watch.poll()
+    assert watch.poll() == 1
+    failed = folder / FAILED_FOLDER
+    assert sorted(os.listdir(str(failed))) == [
+        'bad.xml.gz', 'bad.xml.gz.error', 'unreadable.xml', 'unreadable.xml.error']
+    assert sorted(os.listdir(str(folder))) == [FAILED_FOLDER, 'good.xml']
+    statuses = sorted(w.status for w in WatchedFile.query)
+    assert statuses == ['failed', 'queued']
+    assert watch.poll() == 0
+
+
+def test_run_goes_on_after_a_failed_poll(folder, monkeypatch):
+    watch = WatchFolder(str(folder), 1, 'test')
+    polls = []
+    sleeps = []
+
+    def poll():
+        polls.append(1)
+        raise OSError("gone")
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 2:
+            raise Stop()
+
+    monkeypatch.setattr(watch, 'poll', poll)
+    monkeypatch.setattr(watchfolder.time, 'sleep', sleep)
+    with pytest.raises(Stop):
+        watch.run()
+    assert len(polls) == 2
@@ -0,0 +1,16 @@
+#!python
+# Ingest the manifests dropped in a folder (WATCH_FOLDER in the configuration)
+# Usage: ./watch_folder.py [folder] [number of ingest workers]
+import sys
+from SPARMETSViewer import app, db
+from SPARMETSViewer.ingestqueue import start_workers
+from SPARMETSViewer.watchfolder import WatchFolder
+if __name__ == '__main__':
+    folder = sys.argv[1] if len(sys.argv) > 1 else app.config['WATCH_FOLDER']
+    if not folder:
+        sys.exit('No watch folder')
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else max(app.config['INGEST_WORKERS'], 1)
+    start_workers(count)
+    with app.app_context():
+        db.create_all()
+        WatchFolder(folder).run()